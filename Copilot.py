@@ -2,48 +2,301 @@
 import os
 import re
 import json
+import math
+import heapq
+import time
+import random
+import base64
+import zlib
+import hashlib
+import sqlite3
 import logging
-from typing import Dict, Any, Optional, List, Tuple
+import email.utils
+import threading
+import zipfile
+import csv
+import itertools
+import unicodedata
+import contextvars
+import importlib.util
+from typing import Dict, Any, Optional, List, Tuple, Iterator, Callable, Sequence, TYPE_CHECKING
 from functools import lru_cache
+from contextlib import contextmanager
 from io import BytesIO
-import textstat  # Add this import for readability calculations
-from collections import Counter
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to a character-based estimate
+    tiktoken = None
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import pickle
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
-import PyPDF2
-import docx
-from openai import OpenAI
-from docx import Document
-from docx.shared import Pt, Inches
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-import tempfile
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_JUSTIFY, TA_CENTER
-from lifelines import KaplanMeierFitter
-import seaborn as sns
-from matplotlib.colors import LinearSegmentedColormap
-import markdown2
-from docx.oxml.ns import nsdecls
-from docx.oxml import parse_xml
-from reportlab.lib import colors
-from reportlab.platypus import Table, TableStyle
+import numpy as np
+# The plotting, survival, PDF, Word, readability and OpenAI libraries take seconds to import, so the
+# functions that need them import them on first use (see benchmarks/bench_startup.py)
+
+if TYPE_CHECKING:
+    import networkx as nx
+
+# Optional packages, imported on first use when installed
+PDFPLUMBER_AVAILABLE = importlib.util.find_spec("pdfplumber") is not None  # Otherwise ruled PDF tables are extracted as plain page text
+OPENPYXL_AVAILABLE = importlib.util.find_spec("openpyxl") is not None  # Otherwise XLSX sheets are read whole by pandas (which needs openpyxl as well)
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
 
-# Initialize OpenAI with the API key from Streamlit secrets
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# OpenAI request settings; the timeouts and retry count can be overridden with environment variables
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get("PUBLICATION_OPENAI_TIMEOUT", "600"))  # Full-document generations take minutes
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("PUBLICATION_OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_RETRIES = int(os.environ.get("PUBLICATION_OPENAI_MAX_RETRIES", "4"))
+OPENAI_BACKOFF_BASE_SECONDS = 1.0
+OPENAI_BACKOFF_MAX_SECONDS = 60.0
+# Longer Retry-After values are capped, so a request never sleeps for more than this per retry
+OPENAI_RETRY_AFTER_MAX_SECONDS = 120.0
+OPENAI_RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+@st.cache_resource
+def get_openai_client():
+    """
+    Returns the shared OpenAI client, created on first use with the API key from Streamlit secrets.
+
+    One client, and with it one keep-alive HTTP connection pool, serves every request and thread.
+    The SDK's own retries are disabled because chat_completion retries with its own backoff.
+    """
+    import openai
+    return openai.OpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        timeout=openai.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+        max_retries=0,
+    )
+
+def is_retryable_openai_error(error: Exception) -> bool:
+    """
+    True for connection errors, timeouts, 408/409/429 and 5xx responses, except for an exhausted quota.
+    """
+    import openai
+    if isinstance(error, openai.APIConnectionError):  # Includes APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in OPENAI_RETRYABLE_STATUS_CODES and getattr(error, "code", None) != "insufficient_quota"
+    return False
+
+def openai_retry_delay(attempt: int, error: Exception) -> float:
+    """
+    Returns the seconds to wait before retry attempt + 1: the server's Retry-After (or
+    retry-after-ms) when present, otherwise exponential backoff with full jitter.
+    """
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    delay = None
+    try:
+        if headers.get("retry-after-ms"):
+            delay = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                delay = float(value)
+            except ValueError:
+                # HTTP-date form
+                delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        delay = None
+    if delay is not None and delay >= 0:
+        return min(delay, OPENAI_RETRY_AFTER_MAX_SECONDS)
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+# Organization rate limits for MODEL_NAME, shared by every session and batch job in this process (0 disables a limit)
+OPENAI_REQUESTS_PER_MINUTE = float(os.environ.get("PUBLICATION_OPENAI_RPM", "500"))
+OPENAI_TOKENS_PER_MINUTE = float(os.environ.get("PUBLICATION_OPENAI_TPM", "300000"))
+# Requests waiting beyond this are rejected instead of queueing without bound
+OPENAI_MAX_QUEUED_REQUESTS = int(os.environ.get("PUBLICATION_OPENAI_MAX_QUEUE", "64"))
+# Request priorities, lowest value first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background", PRIORITY_BATCH: "batch"}
+
+_request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_INTERACTIVE)
+
+@contextmanager
+def request_priority(priority: int):
+    """
+    Runs the enclosed model requests at priority, or at the enclosing priority if that is lower
+    (a batch job's quality assessment stays a batch request).
+
+    Worker threads do not inherit the priority unless the task is submitted with
+    contextvars.copy_context().run.
+    """
+    token = _request_priority.set(max(priority, _request_priority.get()))
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+class SchedulerQueueFullError(RuntimeError):
+    pass
+
+class TokenBucket:
+    """
+    Bucket refilling continuously at rate_per_minute, holding at most one minute's worth.
+    Not thread-safe; RequestScheduler guards it with its lock.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.level = rate_per_minute
+        self._updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def seconds_until(self, amount: float) -> float:
+        # Amounts above the capacity wait for a full bucket
+        if self.rate <= 0:
+            return 0.0
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        if self.rate > 0:
+            self.level -= min(amount, self.capacity)
+
+class RequestScheduler:
+    """
+    Process-wide admission control for model requests.
+
+    Each request takes one slot from the requests-per-minute bucket and its estimated tokens from the
+    tokens-per-minute bucket. Waiting requests are admitted strictly by priority, then in arrival order.
+    At most max_queued requests can wait; further requests raise SchedulerQueueFullError.
+    """
+
+    def __init__(self, requests_per_minute: float = OPENAI_REQUESTS_PER_MINUTE, tokens_per_minute: float = OPENAI_TOKENS_PER_MINUTE, max_queued: int = OPENAI_MAX_QUEUED_REQUESTS):
+        self._condition = threading.Condition()
+        self._waiting = []  # Heap of (priority, sequence)
+        self._sequence = itertools.count()
+        self.max_queued = max_queued
+        self.configure(requests_per_minute, tokens_per_minute)
+        self.granted = Counter()
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        with self._condition:
+            self.requests = TokenBucket(max(0.0, requests_per_minute))
+            self.tokens = TokenBucket(max(0.0, tokens_per_minute))
+            self._condition.notify_all()
+
+    def acquire(self, estimated_tokens: int, priority: int = PRIORITY_INTERACTIVE) -> float:
+        """
+        Blocks until the request may be sent.
+
+        Returns:
+        - float: Seconds spent waiting.
+
+        Raises:
+        - SchedulerQueueFullError: If max_queued requests are already waiting.
+        """
+        start = time.monotonic()
+        with self._condition:
+            if len(self._waiting) >= self.max_queued:
+                self.rejected += 1
+                raise SchedulerQueueFullError(f"Too many model requests are waiting ({len(self._waiting)}); try again shortly.")
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    if self._waiting[0] == entry:
+                        delay = max(self.requests.seconds_until(1), self.tokens.seconds_until(estimated_tokens))
+                        if delay <= 0:
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+                heapq.heappop(self._waiting)
+                self.requests.take(1)
+                self.tokens.take(estimated_tokens)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                self._condition.notify_all()
+            waited = time.monotonic() - start
+            self.granted[priority] += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            granted = sum(self.granted.values())
+            return {
+                "queued": len(self._waiting),
+                "queued_by_priority": {PRIORITY_NAMES.get(priority, str(priority)): count for priority, count in Counter(priority for priority, _ in self._waiting).items()},
+                "granted": granted,
+                "granted_by_priority": {PRIORITY_NAMES.get(priority, str(priority)): count for priority, count in self.granted.items()},
+                "rejected": self.rejected,
+                "mean_wait": self.total_wait / granted if granted else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+@st.cache_resource
+def get_request_scheduler() -> RequestScheduler:
+    # Held by st.cache_resource so all sessions share one scheduler and its rate limits
+    return RequestScheduler()
+
+def estimate_request_tokens(kwargs: Dict[str, Any]) -> int:
+    """
+    Tokens a chat completion counts against the TPM limit: the prompt estimate plus max_tokens,
+    which OpenAI reserves when it accepts the request.
+    """
+    prompt_tokens = sum(estimate_tokens(message.get("content") or "") + 4 for message in kwargs.get("messages", []))
+    return prompt_tokens + kwargs.get("max_tokens", MAX_OUTPUT_TOKENS)
+
+def chat_completion(**kwargs):
+    """
+    Creates a chat completion with the shared client, retrying transient failures (see
+    is_retryable_openai_error) up to OPENAI_MAX_RETRIES times.
+
+    Every attempt is admitted by the process-wide request scheduler at the current request_priority.
+    Streaming requests are retried until the stream is open; errors while reading it are raised.
+
+    Raises:
+    - SchedulerQueueFullError: If the scheduler queue is full.
+    - openai.OpenAIError: The last error, once it is not retryable or the retries are used up.
+    """
+    estimated_tokens = estimate_request_tokens(kwargs)
+    for attempt in itertools.count():
+        waited = get_request_scheduler().acquire(estimated_tokens, _request_priority.get())
+        if waited >= 1:
+            logging.info(f"Model request waited {waited:.1f}s for rate limit capacity")
+        try:
+            return get_openai_client().chat.completions.create(**kwargs)
+        except Exception as e:
+            if attempt >= OPENAI_MAX_RETRIES or not is_retryable_openai_error(e):
+                raise
+            delay = openai_retry_delay(attempt, e)
+            logging.warning(f"OpenAI request failed ({type(e).__name__}: {str(e)}); retry {attempt + 1}/{OPENAI_MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
 
-# Optional: Verify that the API key is loaded (for debugging purposes only; remove in production)
-# st.write(f"OpenAI API Key Loaded: {'Yes' if openai.api_key else 'No'}")
-  # Replace with your actual API key
+def import_chart_libraries() -> None:
+    """
+    Imports the plotting libraries and selects the off-screen Agg backend. Worker processes call it
+    when they start (see process_workers.warm_up), so their first chart does not pay for the imports.
+    """
+    import matplotlib
+    matplotlib.use("Agg")  # Charts are rendered off-screen to PNG, including in worker processes
+    import seaborn  # noqa: F401
+    import lifelines.plotting  # noqa: F401
 
 # Update the PUBLICATION_TYPES dictionary
 PUBLICATION_TYPES = {
@@ -302,10 +555,374 @@ ANALYSIS_TYPES = {
 # The ANALYSIS_SOURCE_RECOMMENDATIONS dictionary is already correct and complete
 # as it includes all the analysis types from the table you provided.
 
-# Cache the document generation to improve performance (unchanged)
-@lru_cache(maxsize=128)
+MODEL_NAME = "gpt-4o-2024-08-06"
+
+# Bump whenever the prompts in generate_document change so cached documents from older templates are not served
+PROMPT_TEMPLATE_VERSION = "2"
+
+# Persistent cache settings (override the location with PUBLICATION_CACHE_DIR)
+CACHE_DIR = os.environ.get("PUBLICATION_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "publication_copilot"))
+GENERATION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+GENERATION_CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# Near-duplicate detection: MinHash signatures over word shingles, indexed by LSH bands in the generation cache
+NEAR_DUPLICATE_THRESHOLD = 0.95  # Default minimum estimated Jaccard similarity for reusing a cached result
+NEAR_DUPLICATE_SHINGLE_WORDS = 5
+NEAR_DUPLICATE_INSTRUCTION_SHINGLE_WORDS = 2  # Instructions are short, so they are compared on word pairs
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 32  # 4 rows per band: texts at least 80% similar share a band with near certainty
+MINHASH_PRIME = (1 << 61) - 1
+# Fixed seed, since signatures are stored and compared across processes and restarts
+_minhash_rng = np.random.default_rng(20240806)
+MINHASH_A = _minhash_rng.integers(1, 1 << 31, MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _minhash_rng.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+MATCHING_WORD_PATTERN = re.compile(r"\w+")
+SPACE_RUN_PATTERN = re.compile(r" {2,}")
+
+def normalize_text(text: str) -> str:
+    """
+    Canonical form of text for cache keys: NFKC-normalized, with \\r\\n and \\r line endings turned
+    into \\n, runs of spaces within a line collapsed to one and trailing spaces removed. Line breaks
+    and tabs are kept, since they carry the structure of tables and lists.
+    """
+    text = unicodedata.normalize("NFKC", text).replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(SPACE_RUN_PATTERN.sub(" ", line).rstrip(" ") for line in text.split("\n")).strip("\n ")
+
+def minhash_signature(text: str, shingle_words: int = NEAR_DUPLICATE_SHINGLE_WORDS) -> np.ndarray:
+    """
+    MinHash signature of the set of lower-cased word shingles in text. The fraction of equal
+    positions in two signatures estimates the Jaccard similarity of the two shingle sets.
+
+    Parameters:
+    - text (str): The text to fingerprint.
+    - shingle_words (int): Words per shingle (fewer for texts shorter than that).
+
+    Returns:
+    - np.ndarray: MINHASH_PERMUTATIONS uint64 values; empty text gives all MINHASH_PRIME.
+    """
+    words = MATCHING_WORD_PATTERN.findall(normalize_text(text).lower())
+    if not words:
+        return np.full(MINHASH_PERMUTATIONS, MINHASH_PRIME, dtype=np.uint64)
+    word_hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64, count=len(words))
+    width = min(shingle_words, len(words))
+    count = len(words) - width + 1
+    shingles = np.zeros(count, dtype=np.uint64)
+    for offset in range(width):
+        shingles = shingles * np.uint64(1000003) + word_hashes[offset:offset + count]
+    # Folded to 32 bits so that a * x + b cannot overflow 64 bits
+    shingles = np.unique((shingles >> np.uint64(32)) ^ (shingles & np.uint64(0xFFFFFFFF)))
+    prime = np.uint64(MINHASH_PRIME)
+    return np.array([((a * shingles + b) % prime).min() for a, b in zip(MINHASH_A, MINHASH_B)], dtype=np.uint64)
+
+def lsh_buckets(namespace: str, signature: np.ndarray) -> List[str]:
+    """
+    One bucket id per LSH band of signature. Texts sharing any bucket are similarity candidates.
+    """
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    prefix = namespace.encode("utf-8")
+    return [
+        hashlib.sha1(prefix + band.to_bytes(2, "big") + signature[band * rows:(band + 1) * rows].tobytes()).hexdigest()
+        for band in range(MINHASH_BANDS)
+    ]
+
+
+class GenerationCache:
+    """
+    Disk-backed, content-addressed cache for generated documents.
+
+    Entries live in a SQLite database so they survive server restarts and are shared by every
+    worker process on the host. Entries older than max_age_seconds are dropped, and the least
+    recently used entries are evicted once the total payload exceeds max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = GENERATION_CACHE_MAX_BYTES, max_age_seconds: float = GENERATION_CACHE_MAX_AGE_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS fingerprints (key TEXT PRIMARY KEY, namespace TEXT NOT NULL, signature BLOB NOT NULL, target TEXT)")
+            # Databases created before fingerprints could point at another entry lack the target column
+            if "target" not in [row[1] for row in conn.execute("PRAGMA table_info(fingerprints)")]:
+                conn.execute("ALTER TABLE fingerprints ADD COLUMN target TEXT")
+            conn.execute("CREATE TABLE IF NOT EXISTS lsh_buckets (bucket TEXT NOT NULL, key TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS lsh_buckets_bucket ON lsh_buckets (bucket)")
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def _bump(self, conn: sqlite3.Connection, name: str) -> None:
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            conn = self._connect()
+            try:
+                now = time.time()
+                row = conn.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None or now - row[1] > self.max_age_seconds:
+                    if row is not None:
+                        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    self._bump(conn, "misses")
+                    conn.commit()
+                    return None
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                self._bump(conn, "hits")
+                conn.commit()
+                return json.loads(row[0])
+            finally:
+                conn.close()
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Error reading generation cache: {str(e)}")
+            return None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        try:
+            payload = json.dumps(value)
+            now = time.time()
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, payload, len(payload), now, now)
+                )
+                self._evict(conn, now)
+                conn.commit()
+            finally:
+                conn.close()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.error(f"Error writing generation cache: {str(e)}")
+
+    def add_fingerprint(self, key: str, namespace: str, signature: np.ndarray, target: Optional[str] = None) -> None:
+        """
+        Indexes a MinHash signature under key for find_similar. The fingerprint points at the entry
+        stored under target (key if None) and is dropped once that entry expires or is evicted.
+
+        signature has one row per compared text (e.g. source and instructions); the LSH buckets
+        are built from the first row.
+        """
+        try:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO fingerprints (key, namespace, signature, target) VALUES (?, ?, ?, ?)",
+                    (key, namespace, signature.astype(np.uint64).tobytes(), target)
+                )
+                conn.execute("DELETE FROM lsh_buckets WHERE key = ?", (key,))
+                conn.executemany("INSERT INTO lsh_buckets (bucket, key) VALUES (?, ?)", [(bucket, key) for bucket in lsh_buckets(namespace, signature[0])])
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Error writing generation cache fingerprint: {str(e)}")
+
+    def find_similar(self, namespace: str, signature: np.ndarray, threshold: float) -> List[Tuple[str, str, np.ndarray]]:
+        """
+        Finds fingerprints in namespace that are at least threshold similar to signature in every
+        row and point at a live entry.
+
+        Returns:
+        - List[Tuple[str, str, np.ndarray]]: (fingerprint key, entry key, estimated similarity per row),
+          most similar first.
+        """
+        buckets = lsh_buckets(namespace, signature[0])
+        matches = []
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute(
+                    "SELECT DISTINCT f.key, e.key, f.signature FROM lsh_buckets b "
+                    "JOIN fingerprints f ON f.key = b.key JOIN entries e ON e.key = COALESCE(f.target, f.key) "
+                    f"WHERE b.bucket IN ({', '.join('?' * len(buckets))}) AND f.namespace = ? AND e.created_at >= ?",
+                    (*buckets, namespace, time.time() - self.max_age_seconds)
+                ).fetchall()
+                for key, target, blob in rows:
+                    if len(blob) != signature.size * 8:
+                        continue
+                    similarities = (np.frombuffer(blob, dtype=np.uint64).reshape(signature.shape) == signature).mean(axis=1)
+                    if similarities.min() >= threshold:
+                        matches.append((key, target, similarities))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Error searching generation cache fingerprints: {str(e)}")
+        matches.sort(key=lambda match: match[2].min(), reverse=True)
+        return matches
+
+    def record_similar_hit(self) -> None:
+        """
+        Counts a result found by find_similar that was actually reused.
+        """
+        try:
+            conn = self._connect()
+            try:
+                self._bump(conn, "similar_hits")
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Error writing generation cache statistics: {str(e)}")
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        expired = conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.max_age_seconds,)).rowcount
+        evicted = 0
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size > self.max_bytes:
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                evicted += 1
+                total_size -= size
+                if total_size <= self.max_bytes:
+                    break
+        if expired or evicted:
+            conn.execute("DELETE FROM fingerprints WHERE COALESCE(target, key) NOT IN (SELECT key FROM entries)")
+            conn.execute("DELETE FROM lsh_buckets WHERE key NOT IN (SELECT key FROM fingerprints)")
+            logging.debug(f"Generation cache evicted {expired} expired and {evicted} least recently used entries.")
+
+    def stats(self) -> Dict[str, int]:
+        try:
+            conn = self._connect()
+            try:
+                counters = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+                entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading generation cache statistics: {str(e)}")
+            counters, entries, size = {}, 0, 0
+        return {"hits": counters.get("hits", 0), "misses": counters.get("misses", 0), "similar_hits": counters.get("similar_hits", 0), "entries": entries, "size_bytes": size}
+
+    def clear(self) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM stats")
+            conn.execute("DELETE FROM fingerprints")
+            conn.execute("DELETE FROM lsh_buckets")
+            conn.commit()
+        finally:
+            conn.close()
+
+
+generation_cache = GenerationCache(os.path.join(CACHE_DIR, "generation_cache.sqlite3"))
+# Map-step chunk digests (see summarize_chunk) have their own file, so their lookups do not count as document hits or misses
+digest_cache = GenerationCache(os.path.join(CACHE_DIR, "digest_cache.sqlite3"))
+
+
+def generation_cache_key(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str, model: str = MODEL_NAME, pipeline: str = "single") -> str:
+    """
+    Builds the content-addressed cache key for a generation request.
+
+    The key covers everything that influences the model output, including the model name,
+    PROMPT_TEMPLATE_VERSION and the generation pipeline, so changing any of them invalidates
+    previously cached documents. Source and instructions are hashed in normalize_text form.
+    """
+    key_material = json.dumps(
+        [PROMPT_TEMPLATE_VERSION, model, pipeline, publication_type, analysis_type, normalize_text(user_input), normalize_text(additional_instructions)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+def is_generation_error(result: Optional[Dict[str, Any]]) -> bool:
+    # Empty or whitespace-only content (e.g. a stream that ended without deltas) counts as a failure
+    content = (result or {}).get("content") or ""
+    return not content.strip() or content.startswith("An error occurred")
+
+
+def sections_pipeline(top_k: Optional[int] = None) -> str:
+    # The pipeline part of generation_cache_key for generate_document_by_sections_cached
+    return f"sections:top_k={top_k}" if top_k else "sections"
+
 def generate_document_cached(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str) -> Optional[Dict[str, Any]]:
-    return generate_document(publication_type, analysis_type, user_input, additional_instructions)
+    """
+    Returns the generated document from the persistent cache, generating and storing it on a miss.
+    Failed generations are never cached.
+    """
+    key = generation_cache_key(publication_type, analysis_type, user_input, additional_instructions)
+    return cached_generation(key, lambda: generate_document(publication_type, analysis_type, user_input, additional_instructions))
+
+def cached_generation(key: str, produce: Callable[[], Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """
+    Returns the cached result for key, or calls produce and caches its result unless it failed.
+    """
+    cached = generation_cache.get(key)
+    if cached is not None:
+        logging.debug(f"Generation cache hit for key {key}")
+        return cached
+    result = produce()
+    if not is_generation_error(result):
+        generation_cache.set(key, result)
+    return result
+
+def similar_generation_namespace(settings_key: str) -> str:
+    return f"document:{PROMPT_TEMPLATE_VERSION}:{MODEL_NAME}:{settings_key}"
+
+def similar_generation_key(settings_key: str, user_input: str, additional_instructions: str) -> str:
+    key_material = json.dumps(
+        ["similar", PROMPT_TEMPLATE_VERSION, MODEL_NAME, settings_key, normalize_text(user_input), normalize_text(additional_instructions)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+def generation_fingerprint(user_input: str, additional_instructions: str) -> np.ndarray:
+    return np.vstack([
+        minhash_signature(user_input, NEAR_DUPLICATE_SHINGLE_WORDS),
+        minhash_signature(additional_instructions, NEAR_DUPLICATE_INSTRUCTION_SHINGLE_WORDS),
+    ])
+
+def remember_generation(settings_key: str, user_input: str, additional_instructions: str, document_key: str) -> None:
+    """
+    Indexes the fingerprint of a generated document's source and instructions, so later
+    near-identical requests with the same settings can find it with find_similar_generation.
+    The document itself stays a single generation_cache entry that the fingerprint points at.
+
+    Parameters:
+    - settings_key (str): Hash of every generation setting other than the source and instructions.
+    - user_input (str): The source text as entered or extracted, before retrieval or condensing.
+    - additional_instructions (str): The user's additional instructions.
+    - document_key (str): The generation_cache_key the document was cached under.
+    """
+    key = similar_generation_key(settings_key, user_input, additional_instructions)
+    generation_cache.add_fingerprint(key, similar_generation_namespace(settings_key), generation_fingerprint(user_input, additional_instructions), target=document_key)
+
+def find_similar_generation(settings_key: str, user_input: str, additional_instructions: str, threshold: float = NEAR_DUPLICATE_THRESHOLD) -> Optional[Dict[str, Any]]:
+    """
+    Finds the cached document whose source and instructions are both most similar to these,
+    with an estimated similarity of at least threshold.
+
+    Returns:
+    - Optional[Dict[str, Any]]: {"key", "source_similarity", "instruction_similarity", "exact"}, where key
+      is the document's generation_cache key and exact means identical after normalize_text, or None
+      if there is no match.
+    """
+    matches = generation_cache.find_similar(
+        similar_generation_namespace(settings_key), generation_fingerprint(user_input, additional_instructions), threshold
+    )
+    if not matches:
+        return None
+    fingerprint_key, key, similarities = matches[0]
+    return {
+        "key": key,
+        "source_similarity": float(similarities[0]),
+        "instruction_similarity": float(similarities[1]),
+        "exact": fingerprint_key == similar_generation_key(settings_key, user_input, additional_instructions),
+    }
 
 def get_section_requirements(publication_type: str) -> str:
     if publication_type == "Congress Abstract":
@@ -386,121 +1003,100 @@ def get_section_requirements(publication_type: str) -> str:
     else:
         return ""
 
-def calculate_flesch_kincaid_grade(text: str) -> float:
-    return textstat.flesch_kincaid_grade(text)
-
-def assess_content_quality(content: str, publication_type: str, analysis_type: str) -> Dict[str, Any]:
-    assessment = {}
-
-    # 1. Readability Scores
-    assessment["readability"] = {
-        "flesch_kincaid_grade": textstat.flesch_kincaid_grade(content),
-        "flesch_reading_ease": textstat.flesch_reading_ease(content),
-        "smog_index": textstat.smog_index(content),
-    }
+# Tokenization follows textstat's English defaults so the scores match its separate calls:
+# sentences are runs ending in . ! or ?, sentences of two words or fewer are not counted,
+# and words are whitespace-separated after removing punctuation (contraction apostrophes kept)
+SENTENCE_PATTERN = re.compile(r"\b[^.!?]+[.!?]*")
+NON_CONTRACTION_APOSTROPHE_PATTERN = re.compile(r"\'(?![tsd]|ve|ll|re)")
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s\']")
+SECTION_HEADING_PATTERN = re.compile(r'\n##\s+')
+CITATION_PATTERN = re.compile(r'\(\w+\s+et\s+al\.,\s+\d{4}\)|\[\d+\]')
+POLYSYLLABLE_THRESHOLD = 3
+KEYWORD_DENSITY_TOP_N = 10
+
+@lru_cache(maxsize=65536)
+def count_word_syllables(word: str) -> int:
+    # Manuscripts reuse a small vocabulary, so each distinct word is syllabified once
+    import textstat
+    return textstat.syllable_count(word)
+
+def compute_text_metrics(content: str) -> Dict[str, Any]:
+    """
+    Computes the local quality metrics of generated content in a single tokenization pass.
 
-    # 2. Word Count and Section Balance
-    sections = re.split(r'\n##\s+', content)
-    section_word_counts = {section.split('\n')[0]: len(section.split()) for section in sections if section.strip()}
-    assessment["word_counts"] = section_word_counts
-    total_words = sum(section_word_counts.values())
-    assessment["total_words"] = total_words
+    Parameters:
+    - content (str): The generated content (Markdown).
 
-    # 3. Character Count (for Congress Abstract)
-    if publication_type == "Congress Abstract":
-        assessment["total_characters"] = len(content)
-
-    # 4. Keyword Density
-    words = re.findall(r'\w+', content.lower())
-    word_freq = Counter(words)
-    total_words = len(words)
-    keyword_density = {word: count/total_words for word, count in word_freq.most_common(10)}
-    assessment["keyword_density"] = keyword_density
-
-    # 5. Citation Check
-    citation_pattern = r'\(\w+\s+et\s+al\.,\s+\d{4}\)|\[\d+\]'
-    citations = re.findall(citation_pattern, content)
-    assessment["citation_count"] = len(citations)
-
-    # 6. AI-powered Content Evaluation
-    openai_api_key = st.secrets['openai']["OPENAI_API_KEY"]
-    
-    # Truncate content to approximately 128000 tokens (assuming 4 characters per token)
-    max_input_chars = 128000 * 4
-    truncated_content = content[:max_input_chars]
-    
-    if publication_type == "Plain Language Summary":
-        prompt = f"""
-        Evaluate the following Plain Language Summary for a {analysis_type}. 
-        Provide a comprehensive assessment of its quality, focusing on:
-        1. Clarity and simplicity of language (aim for 6th to 8th-grade reading level)
-        2. Avoidance of jargon and technical terms
-        3. Logical flow and organization of information
-        4. Relevance to patient audience
-        5. Inclusion of key sections (Background, Purpose, Methods, Results, Implications)
-        6. Use of everyday examples or analogies to explain complex concepts
-        7. Appropriate length (200-750 words)
-
-        Highlight any areas that need improvement and suggest specific enhancements.
-
-        Content:
-        {truncated_content}
-
-        Evaluation:
-        """
+    Returns:
+    - Dict[str, Any]: readability scores, per-section word counts, total words, keyword density,
+      citation count and total characters.
+    """
+    word_freq = Counter()
+    section_word_counts = {}
+    sentence_count = 0
+    syllable_count = 0
+    polysyllable_count = 0
+
+    for section in SECTION_HEADING_PATTERN.split(content):
+        if not section.strip():
+            continue
+        section_words = 0
+        for sentence in SENTENCE_PATTERN.findall(section):
+            sentence = NON_CONTRACTION_APOSTROPHE_PATTERN.sub("", sentence)
+            words = PUNCTUATION_PATTERN.sub("", sentence).lower().split()
+            if len(words) > 2:
+                sentence_count += 1
+            section_words += len(words)
+            word_freq.update(words)
+        section_word_counts[section.split('\n', 1)[0]] = section_words
+
+    for word, count in word_freq.items():
+        syllables = count_word_syllables(word)
+        syllable_count += syllables * count
+        if syllables >= POLYSYLLABLE_THRESHOLD:
+            polysyllable_count += count
+
+    total_words = sum(word_freq.values())
+    sentence_count = max(1, sentence_count) if total_words else 0
+    if total_words:
+        words_per_sentence = total_words / sentence_count
+        syllables_per_word = syllable_count / total_words
+        readability = {
+            "flesch_kincaid_grade": round(0.39 * words_per_sentence + 11.8 * syllables_per_word - 15.59, 2),
+            "flesch_reading_ease": round(206.835 - 1.015 * words_per_sentence - 84.6 * syllables_per_word, 2),
+            "smog_index": round(1.043 * math.sqrt(30 * polysyllable_count / sentence_count) + 3.1291, 2),
+        }
     else:
-        prompt = f"""
-        Evaluate the following {publication_type} content for a {analysis_type}. 
-        Provide a comprehensive assessment of its quality, coherence, and adherence to scientific writing standards.
-        Highlight any areas that need improvement and suggest specific enhancements.
+        readability = {"flesch_kincaid_grade": 0.0, "flesch_reading_ease": 0.0, "smog_index": 0.0}
+
+    return {
+        "readability": readability,
+        "word_counts": section_word_counts,
+        "total_words": total_words,
+        "keyword_density": {word: count / total_words for word, count in word_freq.most_common(KEYWORD_DENSITY_TOP_N)},
+        "citation_count": len(CITATION_PATTERN.findall(content)),
+        "total_characters": len(content),
+    }
 
-        Content:
-        {truncated_content}
+# Generated content beyond this many tokens is not sent to the AI evaluation
+QUALITY_MAX_INPUT_TOKENS = 16000
 
-        Evaluation:
-        """
 def assess_content_quality(content: str, publication_type: str, analysis_type: str) -> Dict[str, Any]:
     assessment = {}
     try:
-        # 1. Readability Scores
-        assessment["readability"] = {
-            "flesch_kincaid_grade": textstat.flesch_kincaid_grade(content),
-            "flesch_reading_ease": textstat.flesch_reading_ease(content),
-            "smog_index": textstat.smog_index(content),
-        }
-
-        # 2. Word Count and Section Balance
-        try:
-            sections = re.split(r'\n##\s+', content)
-            section_word_counts = {section.split('\n')[0]: len(section.split()) for section in sections if section.strip()}
-            assessment["word_counts"] = section_word_counts
-            total_words = sum(section_word_counts.values())
-            assessment["total_words"] = total_words
-        except Exception as e:
-            logging.error(f"Error calculating word counts: {str(e)}")
-            assessment["word_counts"] = {}
-            assessment["total_words"] = len(content.split())  # Fallback to simple word count
-
-        # 3. Character Count (for Congress Abstract)
+        # 1-5. Readability, section balance, keyword density and citations
+        metrics = compute_text_metrics(content)
+        assessment["readability"] = metrics["readability"]
+        assessment["word_counts"] = metrics["word_counts"]
+        assessment["total_words"] = metrics["total_words"]
         if publication_type == "Congress Abstract":
-            assessment["total_characters"] = len(content)
-
-        # 4. Keyword Density
-        words = re.findall(r'\w+', content.lower())
-        word_freq = Counter(words)
-        total_words = len(words)
-        keyword_density = {word: count/total_words for word, count in word_freq.most_common(10)}
-        assessment["keyword_density"] = keyword_density
-
-        # 5. Citation Check
-        citation_pattern = r'\(\w+\s+et\s+al\.,\s+\d{4}\)|\[\d+\]'
-        citations = re.findall(citation_pattern, content)
-        assessment["citation_count"] = len(citations)
+            assessment["total_characters"] = metrics["total_characters"]
+        assessment["keyword_density"] = metrics["keyword_density"]
+        assessment["citation_count"] = metrics["citation_count"]
 
         # 6. AI-powered Content Evaluation
         try:
-            max_input_chars = 16000 * 4
-            truncated_content = content[:max_input_chars]
+            truncated_content = truncate_to_tokens(content, QUALITY_MAX_INPUT_TOKENS)
             
             prompt = f"""
             Evaluate the following {publication_type} content for a {analysis_type}. 
@@ -513,14 +1109,15 @@ def assess_content_quality(content: str, publication_type: str, analysis_type: s
             Evaluation:
             """
             
-            response = client.chat.completions.create(
-                model="gpt-4o-2024-08-06",
-                messages=[
-                    {"role": "system", "content": "You are a scientific writing expert."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=1000
-            )
+            with request_priority(PRIORITY_BACKGROUND):
+                response = chat_completion(
+                    model=MODEL_NAME,
+                    messages=[
+                        {"role": "system", "content": "You are a scientific writing expert."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=1000
+                )
             
             assessment["ai_evaluation"] = response.choices[0].message.content
         except Exception as e:
@@ -532,230 +1129,487 @@ def assess_content_quality(content: str, publication_type: str, analysis_type: s
         assessment["error"] = str(e)
 
     return assessment
-    
-    assessment["ai_evaluation"] = response.choices[0].message.content
 
-    return assessment
+# Tables extracted from DOCX and ruled PDF tables are embedded in the source text as compact CSV blocks:
+#   [Table 3: Summary of adverse events]
+#   header,row...
+#   [/Table]
+TABLE_BLOCK_PATTERN = re.compile(r'^\[Table [^\]\n]*\]\n.*?\n\[/Table\]$', re.MULTILINE | re.DOTALL)
+TABLE_CAPTION_PATTERN = re.compile(r'^(Table|Tab\.)\s+[\w.\-]+', re.IGNORECASE)
+# Lines-only detection keeps free text that happens to be aligned in columns out of the tables
+PDF_TABLE_SETTINGS = {"vertical_strategy": "lines", "horizontal_strategy": "lines"}
+# Line ("x y l") and rectangle ("x y w h re") drawing operators in a page content stream. pdfplumber's
+# layout parsing is slow, so only pages drawing at least PDF_TABLE_MIN_RULES of them are parsed for tables
+PDF_RULE_PATTERN = re.compile(rb'(?:-?[\d.]+\s+){2}l\b|(?:-?[\d.]+\s+){4}re\b')
+PDF_TABLE_MIN_RULES = 4
+
+def clean_table_cell(value: Optional[str]) -> str:
+    return " ".join(str(value).split()) if value is not None else ""
+
+def normalize_table(rows: List[List[Optional[str]]]) -> Optional[pd.DataFrame]:
+    """
+    Turns raw table rows into a compact DataFrame: whitespace is collapsed, empty rows and columns
+    and duplicate rows are dropped, columns without data or repeated by merged cells are removed, and the first row
+    becomes a header of unique, non-empty names.
+
+    Returns:
+    - Optional[pd.DataFrame]: The table, or None when fewer than two rows or columns remain.
+    """
+    width = max((len(row) for row in rows), default=0)
+    cleaned = [[clean_table_cell(cell) for cell in row] + [""] * (width - len(row)) for row in rows]
+    cleaned = [row for row in cleaned if any(row)]
+    if len(cleaned) < 2:
+        return None
+    keep_columns = [i for i in range(width) if any(row[i] for row in cleaned[1:])]
+    # Horizontally merged cells repeat the same text in every spanned column
+    keep_columns = [i for n, i in enumerate(keep_columns) if n == 0 or any(row[i] != row[keep_columns[n - 1]] for row in cleaned)]
+    if len(keep_columns) < 2:
+        return None
+
+    header = []
+    for position, i in enumerate(keep_columns):
+        name = cleaned[0][i] or f"Column {position + 1}"
+        while name in header:
+            name = f"{name} ({position + 1})"
+        header.append(name)
+    df = pd.DataFrame([[row[i] for i in keep_columns] for row in cleaned[1:]], columns=header)
+    df = df.drop_duplicates(ignore_index=True)
+    return df if not df.empty else None
+
+def table_label(table_number: int, caption: str) -> str:
+    # The caption ("Table 14.3.1 Adverse events") names the table when the source has one
+    if not TABLE_CAPTION_PATTERN.match(caption):
+        return f"Table {table_number}"
+    return caption if caption.lower().startswith("table ") else f"Table {table_number}: {caption}"
+
+def serialize_table(df: pd.DataFrame, label: str) -> str:
+    return f"[{label}]\n{df.to_csv(index=False, lineterminator=chr(10)).rstrip()}\n[/Table]"
+
+def strip_table_blocks(text: str) -> str:
+    """
+    Replaces the embedded table blocks by a one-line reference, for prompts that already include
+    the tables in their extracted tabular data slot.
+    """
+    return TABLE_BLOCK_PATTERN.sub(lambda match: match.group(0).split("\n", 1)[0] + " (see extracted tabular data)", text)
 
 def extract_tabular_data(text: str) -> str:
     """
-    Extracts potential tabular data from the input text.
-    This is a simple implementation and might need to be enhanced based on the actual format of your source documents.
+    Extracts tabular data from the input text: the CSV table blocks written by the DOCX and PDF
+    extractors and any Markdown pipe tables.
     """
+    tables = TABLE_BLOCK_PATTERN.findall(text)
     # Look for patterns that might indicate tabular data
     table_pattern = r'(\|.*\|[\n\r])+\|.*\|'
-    tables = re.findall(table_pattern, text)
+    tables += re.findall(table_pattern, text)
     
     # Join all found tables
     extracted_data = "\n\n".join(tables)
     
     return extracted_data if extracted_data else "No tabular data found in the source document."
 
-def generate_document(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str) -> Optional[Dict[str, Any]]:
-    try:
-        pub_type_info = PUBLICATION_TYPES[publication_type]
-        analysis_type_info = ANALYSIS_TYPES[analysis_type]
-        
-        max_length_pub = pub_type_info.get("max_words", pub_type_info.get("max_characters", ""))
-        length_type_pub = "words" if "max_words" in pub_type_info else "characters"
-        
-        max_length_analysis = analysis_type_info.get("max_words", analysis_type_info.get("max_characters", ""))
-        length_type_analysis = "words" if "max_words" in analysis_type_info else "characters"
-        
-        font_sizes = {**pub_type_info["font_sizes"], **analysis_type_info["font_sizes"]}
-        font_size_info = ", ".join([f"{k.capitalize()}: {v}pt" for k, v in font_sizes.items()])
+# Retrieval settings: only the passages relevant to each section are sent to the model
+RETRIEVAL_TOP_K = 5
+RETRIEVAL_MAX_PASSAGE_WORDS = 250
+RETRIEVAL_MAX_TABLE_ROWS = 40
+
+# Extra query terms for common sections; sections not listed are queried by their own name
+SECTION_QUERY_TERMS = {
+    "Title": "study title phase randomized trial drug indication",
+    "Abstract": "objective primary endpoint results conclusion randomized patients",
+    "Background": "background disease rationale unmet need treatment",
+    "Introduction": "background disease rationale unmet need objective hypothesis",
+    "Methods": "study design randomized inclusion exclusion criteria dose endpoint statistical analysis",
+    "Study Design": "study design phase randomized double-blind placebo arms allocation",
+    "Results": "results patients primary endpoint hazard ratio confidence interval p-value",
+    "Primary Results": "primary endpoint efficacy hazard ratio odds ratio confidence interval p-value",
+    "Safety Results": "adverse events treatment-emergent serious discontinuation deaths grade laboratory",
+    "PK Results": "pharmacokinetic cmax auc tmax half-life clearance exposure concentration",
+    "Subgroup Results": "subgroup age sex region baseline forest hazard ratio interaction",
+    "Interim Results": "interim analysis data cut-off efficacy boundary idmc",
+    "Post-hoc Results": "post-hoc exploratory analysis results",
+    "Baseline Characteristics": "baseline demographics age sex race weight disease characteristics prior therapy",
+    "Discussion": "results compared limitations implications",
+    "Conclusion": "conclusion efficacy safety benefit",
+    "Conclusions": "conclusion efficacy safety benefit",
+    "Funding": "funding sponsor supported grant",
+    "Objectives": "primary secondary objectives endpoints",
+    "Interim Objectives": "interim analysis objectives endpoints",
+    "Current Status": "enrollment recruitment sites status",
+    "Tables and Figures": "table figure summary results",
+    "Key Points": "primary endpoint results safety conclusion",
+    "What were the results?": "results primary endpoint patients improvement",
+    "How was the study done?": "study design randomized patients treatment",
+}
 
-        structure = list(dict.fromkeys(pub_type_info["structure"] + analysis_type_info["structure"]))
-        structure_info = "\n".join([f"- {section}" for section in structure])
+RETRIEVAL_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it of on or that the their this to was were with".split()
+)
 
-        extracted_data = extract_tabular_data(user_input)
+def retrieval_tokenize(text: str) -> List[str]:
+    return [token for token in re.findall(r'[a-z0-9]+', text.lower()) if token not in RETRIEVAL_STOPWORDS]
 
-        if publication_type == "Plain Language Summary":
-            prompt = f"""
-            You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types.
-
-            You are tasked with generating a comprehensive Plain Language Summary that combines the structure and guidelines of the following:
-
-            **Publication Type:** {publication_type}
-            **Analysis Type:** {analysis_type}
-
-            ### **Guidelines:**
-
-            **Target Reading Level:**
-            - Write the summary at a 6th to 8th-grade reading level.
-            - Aim for short sentences averaging 15 words or fewer.
-            - Use simple sentence structures; avoid complex or compound sentences.
-
-            **Language and Style:**
-            - Use common, everyday words instead of medical jargon.
-            - If medical terms are necessary, explain them in simple language.
-            - Write in active voice and present tense where appropriate.
-            - Engage the reader by addressing them directly when suitable.
-
-            **Structure and Content:**
-            - **Title:** Simple and clear, reflecting the main message (10-15 words).
-            - **Key Points:** 3-5 bullet points summarizing the most important takeaways.
-            - **Background:** Brief context about the condition and why the study was done (2-3 sentences).
-            - **What Was the Study About?:** Clear statement of the study's purpose (1-2 sentences).
-            - **How Was the Study Done?:** Simple description of the study methods, avoiding technical details (2-3 sentences).
-            - **What Were the Results?:** Key findings in plain language, focusing on what's most relevant to patients (3-4 sentences).
-            - **What Do the Results Mean for Patients?:** Practical implications for patient care or decision-making (2-3 sentences).
-            - **What's Next?:** Mention any study limitations or ongoing research (1-2 sentences).
-            - **Disclosures:** Include funding sources and any potential conflicts of interest.
-            - **Review Statement:** State that the summary was reviewed by a medical expert and a patient advocate (if applicable).
-
-            **Acronyms and Abbreviations:**
-            - Spell out acronyms upon first use and provide a simple explanation if necessary.
-
-            **Visual Aids:**
-            - If helpful, include simple visual elements to explain key concepts.
-            - Ensure visuals are clearly labeled and easy to understand.
-
-            **Writing Tips:**
-            - Keep paragraphs brief (3-5 sentences).
-            - Use bullet points or numbered lists where appropriate.
-            - Address common questions patients might have.
-            - Avoid unnecessary words or filler content.
-
-            **Final Review:**
-            - Before finalizing, read the summary aloud to ensure it flows naturally.
-            - Verify that the FKGL is between 6 and 8 using readability assessment tools.
-            - Make adjustments to sentence length and word choice as needed to achieve the target reading level.
-
-            Input:
-            {user_input}
-
-            Additional Instructions:
-            {additional_instructions}
-            """
-        elif publication_type == "Congress Abstract":
-            prompt = f"""
-            You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types.
+def table_header_lines(lines: List[str]) -> int:
+    """
+    Number of header lines to repeat in every row group if lines form a table, else 0.
 
-            You are tasked with generating a scientific congress abstract following these guidelines:
+    Tables are [Table ...] blocks written by the extractors (label and column header), Markdown
+    pipe tables (header and separator) and CSV rows with the same number of fields on every line.
+    Hard-wrapped prose with a few commas per line is not a table.
+    """
+    if len(lines) <= 2:
+        return 0
+    if lines[0].startswith("[Table ") and lines[-1] == "[/Table]":
+        return 2
+    if all(line.count('|') >= 2 for line in lines):
+        return 2 if MARKDOWN_TABLE_SEPARATOR_PATTERN.match(lines[1]) else 1
+    field_counts = {len(row) for row in csv.reader(lines)}
+    return 1 if len(field_counts) == 1 and field_counts.pop() >= 3 else 0
+
+def split_into_passages(text: str) -> List[str]:
+    """
+    Splits source text into retrievable passages.
 
-            **Publication Type:** {publication_type}
-            **Analysis Type:** {analysis_type}
+    Paragraphs longer than RETRIEVAL_MAX_PASSAGE_WORDS are split into word windows. Table blocks
+    (see table_header_lines) are split into row groups that repeat the header.
+    """
+    passages = []
+    for block in re.split(r'\n\s*\n', text):
+        block = block.strip()
+        if not block:
+            continue
+        lines = block.split('\n')
+        header_count = table_header_lines(lines)
+        if header_count:
+            header, rows = lines[:header_count], lines[header_count:]
+            if rows and rows[-1] == "[/Table]":
+                rows = rows[:-1]
+            for start in range(0, len(rows), RETRIEVAL_MAX_TABLE_ROWS):
+                passages.append("\n".join(header + rows[start:start + RETRIEVAL_MAX_TABLE_ROWS]))
+            continue
+        words = block.split()
+        for start in range(0, len(words), RETRIEVAL_MAX_PASSAGE_WORDS):
+            passages.append(" ".join(words[start:start + RETRIEVAL_MAX_PASSAGE_WORDS]))
+    return passages
 
-            ### **Guidelines:**
+class SourceIndex:
+    """
+    In-process BM25 index over the passages of an uploaded source.
+    """
 
-            1. **Structure:**
-               Create an abstract with the following four sections:
-               a) Background: Provide a brief introduction explaining the study's rationale.
-               b) Methods: Describe the key methodological procedures concisely.
-               c) Results: Summarize the main findings of the research.
-               d) Conclusions: State the primary conclusions drawn from the study.
+    def __init__(self, text: str, k1: float = 1.5, b: float = 0.75):
+        start_time = time.perf_counter()
+        self.k1 = k1
+        self.b = b
+        self.passages = split_into_passages(text)
+        self.term_frequencies = [Counter(retrieval_tokenize(passage)) for passage in self.passages]
+        self.lengths = [sum(tf.values()) for tf in self.term_frequencies]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        document_frequencies = Counter()
+        for tf in self.term_frequencies:
+            document_frequencies.update(tf.keys())
+        count = len(self.passages)
+        self.idf = {term: math.log(1 + (count - df + 0.5) / (df + 0.5)) for term, df in document_frequencies.items()}
+        self.build_seconds = time.perf_counter() - start_time
+
+    def search(self, query: str, top_k: int = RETRIEVAL_TOP_K) -> List[Tuple[int, float]]:
+        """
+        Returns up to top_k (passage index, score) pairs, best first.
+        """
+        terms = [term for term in set(retrieval_tokenize(query)) if term in self.idf]
+        if not terms or not self.passages:
+            return []
+        scores = []
+        for index, tf in enumerate(self.term_frequencies):
+            length_norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / (self.average_length or 1))
+            score = 0.0
+            for term in terms:
+                frequency = tf.get(term)
+                if frequency:
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + length_norm)
+            if score > 0:
+                scores.append((index, score))
+        return heapq.nlargest(top_k, scores, key=lambda item: item[1])
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _cached_source_index(source_hash: str, _text: str) -> SourceIndex:
+    return SourceIndex(_text)
+
+def get_source_index(text: str) -> SourceIndex:
+    """
+    Returns the retrieval index for the source, building it only once per source content hash.
+    """
+    return _cached_source_index(hashlib.sha256(text.encode("utf-8")).hexdigest(), text)
 
-            2. **Title:**
-               - Craft a title that reflects the abstract's content using significant words.
-               - Do not include study results or conclusions in the title.
-               - Avoid using commercial names in the title.
+def get_combined_structure(publication_type: str, analysis_type: str) -> List[str]:
+    return list(dict.fromkeys(PUBLICATION_TYPES[publication_type]["structure"] + ANALYSIS_TYPES[analysis_type]["structure"]))
 
-            3. **Content Guidelines:**
-               - Use generic names for compounds in lower case.
-               - If including commercial names in the text, use the ® symbol and place them in brackets after the generic name, e.g., "generic (Commercial®)".
-               - Provide the name(s) of the legal entity/entities responsible for the study's governance, coordination, and execution.
-               - Include the name(s) of organizations providing funding.
+def section_query(section: str) -> str:
+    return f"{section} {SECTION_QUERY_TERMS.get(section, '')}"
 
-            4. **Abbreviations:**
-               - Define all abbreviations upon first use.
-               - Spell out terms in full at first mention, followed by the abbreviation in parentheses.
-               - Take extra care to identify complex chemotherapeutic regimens clearly.
+def build_retrieval_context(user_input: str, structure: List[str], top_k: int = RETRIEVAL_TOP_K) -> str:
+    """
+    Builds a condensed source containing the top-k passages for each target section.
+    Passages relevant to several sections are included once and referenced by label afterwards.
 
-            5. **Length:**
-               - Limit the abstract to 2,000 characters, excluding spaces.
+    Parameters:
+    - user_input (str): The combined source text.
+    - structure (List[str]): The target sections.
+    - top_k (int): Passages retrieved per section.
 
-            6. **Additional Notes:**
-               - Ensure all information is accurate and reflects the study correctly.
-               - Maintain a professional and scientific tone throughout the abstract.
-               - Focus on presenting the most crucial and impactful aspects of the study within the limited space.
+    Returns:
+    - str: The condensed source grouped by section, or user_input itself when no passage matches any
+      section (the generation then trims it to the token budget as usual).
+    """
+    index = get_source_index(user_input)
+    included = set()
+    blocks = []
+    for section in structure:
+        hits = index.search(section_query(section), top_k)
+        if not hits:
+            continue
+        lines = [f"### Passages relevant to {section} ###"]
+        for passage_index, _ in hits:
+            if passage_index in included:
+                lines.append(f"(See [P{passage_index + 1}] above.)")
+            else:
+                included.add(passage_index)
+                lines.append(f"[P{passage_index + 1}] {index.passages[passage_index]}")
+        blocks.append("\n\n".join(lines))
+    if not blocks:
+        logging.warning("Retrieval found no passages relevant to any section; using the full source.")
+        return user_input
+    return "\n\n".join(blocks)
+
+def build_generation_prompt(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str) -> str:
+    """
+    Builds the user prompt for the selected publication and analysis types.
+    """
+    pub_type_info = PUBLICATION_TYPES[publication_type]
+    analysis_type_info = ANALYSIS_TYPES[analysis_type]
+    
+    max_length_pub = pub_type_info.get("max_words", pub_type_info.get("max_characters", ""))
+    length_type_pub = "words" if "max_words" in pub_type_info else "characters"
+    
+    max_length_analysis = analysis_type_info.get("max_words", analysis_type_info.get("max_characters", ""))
+    length_type_analysis = "words" if "max_words" in analysis_type_info else "characters"
+    
+    font_sizes = {**pub_type_info["font_sizes"], **analysis_type_info["font_sizes"]}
+    font_size_info = ", ".join([f"{k.capitalize()}: {v}pt" for k, v in font_sizes.items()])
 
-            Input:
-            {user_input}
+    structure = get_combined_structure(publication_type, analysis_type)
+    structure_info = "\n".join([f"- {section}" for section in structure])
 
-            Additional Instructions:
-            {additional_instructions}
-            """
-        else:
-            prompt = f"""
-            You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types.
-
-            You are tasked with generating a comprehensive document that combines the structure and guidelines of the following:
-
-            **Publication Type:** {publication_type}
-            **Analysis Type:** {analysis_type}
-
-            ### **Guidelines:**
-
-            1. **Document Length:**
-               - **Publication:** Maximum {max_length_pub} {length_type_pub}.
-               - **Analysis:** Maximum {max_length_analysis} {length_type_analysis}.
-
-            2. **Font Sizes:**
-               - {font_size_info}
-
-            3. **Structure:**
-               - The document should include all sections from both the publication type and analysis type. Ensure that each section is clearly marked using Markdown syntax (e.g., ## Title, ### Methods).
-               - Provide detailed and comprehensive content for each section. Aim for at least 2-3 sentences per section, unless otherwise specified.
-
-            4. **Content Generation:**
-               - Use clear and concise language appropriate for a scientific publication.
-               - If specific information is not provided in the input, use placeholder text or general statements that would be appropriate for the section.
-
-            5. **Visualizations:**
-               - Extract key numerical data from the input and suggest up to 2 relevant charts or visualizations.
-               - For each chart, provide the following in JSON format, enclosed within triple backticks and specify the language as JSON:
-
-            ```json
-            {{
-              "type": "Chart Type (e.g., Bar Chart, Line Chart)",
-              "title": "Chart Title",
-              "x_label": "X-axis Label",
-              "y_label": "Y-axis Label",
-              "data_series": ["Numerical Series1", "Numerical Series2", ...],
-              "data": [
-                {{"X-axis Value": ..., "Numerical Series1": ..., "Numerical Series2": ...}},
-                ...
-              ]
-            }}
-            ```
-
-            After completing the publication and analysis content, provide a separate section titled "## Visualizations" containing all chart JSON data.
-
-            6. **Tables:**
-               - Include up to 5-7 essential tables that complement the text.
-               - For each table:
-                 - Provide a detailed title
-                 - List column headers
-                 - Use actual data from the source document if available. Here's the extracted tabular data:
-                   {extracted_data}
-                 - If actual data is not available or incomplete, provide placeholder data or ranges based on the study information
-               - Use Markdown table syntax for creating tables.
-
-            7. **Acknowledgement:**
-               - ALWAYS include an Acknowledgement section at the end of the document with the following text:
-                 "This [publication type] was created with the assistance of generative AI technology."
-
-            Adherence to Guidelines:
-            Strictly adhere to the format and guidelines for both the publication type and analysis type.
-            Ensure that ALL sections specified in the combined structure are present and contain at least minimal content.
-
-            Combined Structure:
-            {structure_info}
-
-            Input:
-            {user_input}
-
-            Additional Instructions:
-            {additional_instructions}
-            """
+    extracted_data = extract_tabular_data(user_input)
+
+    if publication_type == "Plain Language Summary":
+        prompt = f"""
+        You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types.
+
+        You are tasked with generating a comprehensive Plain Language Summary that combines the structure and guidelines of the following:
+
+        **Publication Type:** {publication_type}
+        **Analysis Type:** {analysis_type}
+
+        ### **Guidelines:**
+
+        **Target Reading Level:**
+        - Write the summary at a 6th to 8th-grade reading level.
+        - Aim for short sentences averaging 15 words or fewer.
+        - Use simple sentence structures; avoid complex or compound sentences.
+
+        **Language and Style:**
+        - Use common, everyday words instead of medical jargon.
+        - If medical terms are necessary, explain them in simple language.
+        - Write in active voice and present tense where appropriate.
+        - Engage the reader by addressing them directly when suitable.
+
+        **Structure and Content:**
+        - **Title:** Simple and clear, reflecting the main message (10-15 words).
+        - **Key Points:** 3-5 bullet points summarizing the most important takeaways.
+        - **Background:** Brief context about the condition and why the study was done (2-3 sentences).
+        - **What Was the Study About?:** Clear statement of the study's purpose (1-2 sentences).
+        - **How Was the Study Done?:** Simple description of the study methods, avoiding technical details (2-3 sentences).
+        - **What Were the Results?:** Key findings in plain language, focusing on what's most relevant to patients (3-4 sentences).
+        - **What Do the Results Mean for Patients?:** Practical implications for patient care or decision-making (2-3 sentences).
+        - **What's Next?:** Mention any study limitations or ongoing research (1-2 sentences).
+        - **Disclosures:** Include funding sources and any potential conflicts of interest.
+        - **Review Statement:** State that the summary was reviewed by a medical expert and a patient advocate (if applicable).
+
+        **Acronyms and Abbreviations:**
+        - Spell out acronyms upon first use and provide a simple explanation if necessary.
+
+        **Visual Aids:**
+        - If helpful, include simple visual elements to explain key concepts.
+        - Ensure visuals are clearly labeled and easy to understand.
+
+        **Writing Tips:**
+        - Keep paragraphs brief (3-5 sentences).
+        - Use bullet points or numbered lists where appropriate.
+        - Address common questions patients might have.
+        - Avoid unnecessary words or filler content.
+
+        **Final Review:**
+        - Before finalizing, read the summary aloud to ensure it flows naturally.
+        - Verify that the FKGL is between 6 and 8 using readability assessment tools.
+        - Make adjustments to sentence length and word choice as needed to achieve the target reading level.
+
+        Extracted tabular data:
+        {extracted_data}
+
+        Input:
+        {strip_table_blocks(user_input)}
+
+        Additional Instructions:
+        {additional_instructions}
+        """
+    elif publication_type == "Congress Abstract":
+        prompt = f"""
+        You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types.
+
+        You are tasked with generating a scientific congress abstract following these guidelines:
+
+        **Publication Type:** {publication_type}
+        **Analysis Type:** {analysis_type}
+
+        ### **Guidelines:**
+
+        1. **Structure:**
+           Create an abstract with the following four sections:
+           a) Background: Provide a brief introduction explaining the study's rationale.
+           b) Methods: Describe the key methodological procedures concisely.
+           c) Results: Summarize the main findings of the research.
+           d) Conclusions: State the primary conclusions drawn from the study.
+
+        2. **Title:**
+           - Craft a title that reflects the abstract's content using significant words.
+           - Do not include study results or conclusions in the title.
+           - Avoid using commercial names in the title.
+
+        3. **Content Guidelines:**
+           - Use generic names for compounds in lower case.
+           - If including commercial names in the text, use the ® symbol and place them in brackets after the generic name, e.g., "generic (Commercial®)".
+           - Provide the name(s) of the legal entity/entities responsible for the study's governance, coordination, and execution.
+           - Include the name(s) of organizations providing funding.
+
+        4. **Abbreviations:**
+           - Define all abbreviations upon first use.
+           - Spell out terms in full at first mention, followed by the abbreviation in parentheses.
+           - Take extra care to identify complex chemotherapeutic regimens clearly.
+
+        5. **Length:**
+           - Limit the abstract to 2,000 characters, excluding spaces.
 
-        client = OpenAI()
+        6. **Additional Notes:**
+           - Ensure all information is accurate and reflects the study correctly.
+           - Maintain a professional and scientific tone throughout the abstract.
+           - Focus on presenting the most crucial and impactful aspects of the study within the limited space.
+
+        Extracted tabular data:
+        {extracted_data}
+
+        Input:
+        {strip_table_blocks(user_input)}
+
+        Additional Instructions:
+        {additional_instructions}
+        """
+    else:
+        prompt = f"""
+        You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types.
+
+        You are tasked with generating a comprehensive document that combines the structure and guidelines of the following:
+
+        **Publication Type:** {publication_type}
+        **Analysis Type:** {analysis_type}
+
+        ### **Guidelines:**
+
+        1. **Document Length:**
+           - **Publication:** Maximum {max_length_pub} {length_type_pub}.
+           - **Analysis:** Maximum {max_length_analysis} {length_type_analysis}.
+
+        2. **Font Sizes:**
+           - {font_size_info}
+
+        3. **Structure:**
+           - The document should include all sections from both the publication type and analysis type. Ensure that each section is clearly marked using Markdown syntax (e.g., ## Title, ### Methods).
+           - Provide detailed and comprehensive content for each section. Aim for at least 2-3 sentences per section, unless otherwise specified.
+
+        4. **Content Generation:**
+           - Use clear and concise language appropriate for a scientific publication.
+           - If specific information is not provided in the input, use placeholder text or general statements that would be appropriate for the section.
+
+        5. **Visualizations:**
+           - Extract key numerical data from the input and suggest up to 2 relevant charts or visualizations.
+           - For each chart, provide the following in JSON format, enclosed within triple backticks and specify the language as JSON:
+
+        ```json
+        {{
+          "type": "Chart Type (e.g., Bar Chart, Line Chart)",
+          "title": "Chart Title",
+          "x_label": "X-axis Label",
+          "y_label": "Y-axis Label",
+          "data_series": ["Numerical Series1", "Numerical Series2", ...],
+          "data": [
+            {{"X-axis Value": ..., "Numerical Series1": ..., "Numerical Series2": ...}},
+            ...
+          ]
+        }}
+        ```
+
+        After completing the publication and analysis content, provide a separate section titled "## Visualizations" containing all chart JSON data.
+
+        6. **Tables:**
+           - Include up to 5-7 essential tables that complement the text.
+           - For each table:
+             - Provide a detailed title
+             - List column headers
+             - Use actual data from the source document if available. Here's the extracted tabular data:
+               {extracted_data}
+             - If actual data is not available or incomplete, provide placeholder data or ranges based on the study information
+           - Use Markdown table syntax for creating tables.
+
+        7. **Acknowledgement:**
+           - ALWAYS include an Acknowledgement section at the end of the document with the following text:
+             "This [publication type] was created with the assistance of generative AI technology."
+
+        Adherence to Guidelines:
+        Strictly adhere to the format and guidelines for both the publication type and analysis type.
+        Ensure that ALL sections specified in the combined structure are present and contain at least minimal content.
+
+        Combined Structure:
+        {structure_info}
+
+        Input:
+        {strip_table_blocks(user_input)}
+
+        Additional Instructions:
+        {additional_instructions}
+        """
+    return prompt
+
+SYSTEM_PROMPT = "You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types."
+
+def build_generation_result(full_content: str) -> Dict[str, Any]:
+    """
+    Packages generated Markdown into the result dictionary used by caching, charts and export.
+    """
+    # Extract chart information
+    charts = extract_chart_info(full_content)
+    
+    logging.debug(f"Extracted charts: {charts}")
+
+    return {"content": full_content, "charts": charts}
+
+def generate_document(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str) -> Optional[Dict[str, Any]]:
+    try:
+        user_input = prepare_source_for_prompt(publication_type, analysis_type, user_input, additional_instructions)
+        prompt = build_generation_prompt(publication_type, analysis_type, user_input, additional_instructions)
 
-        response = client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
+        response = chat_completion(
+            model=MODEL_NAME,
             messages=[
-                {"role": "system", "content": "You are a professional scientific medical writing assistant specializing in transforming Clinical Study Reports (CSRs) and other source documents into various publication types."},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             max_tokens=16000,
@@ -764,52 +1618,645 @@ def generate_document(publication_type: str, analysis_type: str, user_input: str
 
         full_content = response.choices[0].message.content
 
-        # Extract chart information
-        charts = extract_chart_info(full_content)
-        
-        logging.debug(f"Extracted charts: {charts}")
-
-        return {"content": full_content, "charts": charts}
+        return build_generation_result(full_content)
 
     except Exception as e:
         logging.error(f"Error in generate_document: {str(e)}")
         return {"content": f"An error occurred while generating the document: {str(e)}", "charts": []}
 
-def extract_chart_info(content: str) -> List[Dict[str, Any]]:
+def generate_document_stream(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str, metrics: Optional[Dict[str, float]] = None) -> Iterator[str]:
     """
-    Extracts chart information from the '## Visualizations' section of the generated content.
+    Streams the generated document as content deltas while the model produces them.
 
     Parameters:
-    - content (str): The full generated content containing chart JSON.
+    - metrics (Optional[Dict[str, float]]): If given, filled with 'time_to_first_token' and
+      'total_latency' in seconds.
 
     Returns:
-    - List[Dict[str, Any]]: A list of chart information dictionaries.
+    - Iterator[str]: Content deltas in the order they arrive.
     """
-    charts = []
-    # Locate the '## Visualizations' section
-    visualizations_match = re.search(r'##\s+Visualizations\s*([\s\S]*)', content, re.IGNORECASE)
-    if visualizations_match:
-        visualizations_content = visualizations_match.group(1)
-        logging.debug(f"Found 'Visualizations' section:\n{visualizations_content}")
-        # Find all JSON blocks within the 'Visualizations' section
-        json_blocks = re.findall(r'```json\s*([\s\S]*?)```', visualizations_content, re.DOTALL | re.IGNORECASE)
-        logging.debug(f"Found {len(json_blocks)} JSON blocks in 'Visualizations' section.")
-        for idx, json_str in enumerate(json_blocks, 1):
-            try:
-                json_str = json_str.strip()
-                chart_info = json.loads(json_str)
-                # Validate required fields
-                if not validate_chart_data(chart_info):
-                    logging.warning(f"Chart {idx} is missing required fields or has invalid data.")
-                    continue
-                charts.append(chart_info)
-                logging.debug(f"Chart {idx} extracted successfully.")
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON decoding error in chart {idx}: {e} in block: {json_str}")
-                continue
-    else:
-        logging.warning("No 'Visualizations' section found in the generated content.")
-    return charts
+    if metrics is None:
+        metrics = {}
+    start_time = time.perf_counter()
+    user_input = prepare_source_for_prompt(publication_type, analysis_type, user_input, additional_instructions)
+    prompt = build_generation_prompt(publication_type, analysis_type, user_input, additional_instructions)
+
+    stream = chat_completion(
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=16000,
+        temperature=0,  # Ensures consistency
+        stream=True
+    )
+
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if "time_to_first_token" not in metrics:
+                metrics["time_to_first_token"] = time.perf_counter() - start_time
+            yield delta
+
+    metrics["total_latency"] = time.perf_counter() - start_time
+    logging.debug(f"Streaming generation metrics: {metrics}")
+
+def generate_document_streaming_cached(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str, write_stream: Callable[[Iterator[str]], Any], metrics: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    Streaming counterpart of generate_document_cached.
+
+    On a cache miss the content deltas are handed to write_stream (e.g. st.write_stream) so they
+    render as they arrive. The final result has the same shape as generate_document and is
+    stored in the persistent cache unless generation failed.
+    """
+    if metrics is None:
+        metrics = {}
+    key = generation_cache_key(publication_type, analysis_type, user_input, additional_instructions)
+    cached = generation_cache.get(key)
+    if cached is not None:
+        metrics["cache_hit"] = True
+        return cached
+
+    parts = []
+
+    def collect(deltas: Iterator[str]) -> Iterator[str]:
+        for delta in deltas:
+            parts.append(delta)
+            yield delta
+
+    try:
+        write_stream(collect(generate_document_stream(publication_type, analysis_type, user_input, additional_instructions, metrics)))
+        result = build_generation_result("".join(parts))
+    except Exception as e:
+        logging.error(f"Error in generate_document_stream: {str(e)}")
+        return {"content": f"An error occurred while generating the document: {str(e)}", "charts": []}
+
+    if not is_generation_error(result):
+        generation_cache.set(key, result)
+    return result
+
+# Token budget settings
+MODEL_CONTEXT_WINDOW = 128000
+MAX_OUTPUT_TOKENS = 16000
+# Tokens per word for English scientific prose, used to estimate the expected output length
+TOKENS_PER_WORD = 1.35
+# USD per million tokens
+MODEL_PRICING = {
+    "gpt-4o-2024-08-06": {"input": 2.50, "output": 10.00},
+}
+
+# Source paragraphs matching these patterns are kept first when the source has to be trimmed
+SOURCE_PRIORITY_PATTERNS = [
+    (3, re.compile(r'synopsis|abstract|primary (?:end ?point|outcome)|efficacy|hazard ratio|odds ratio|confidence interval|\bp\s*[<=]|adverse event|baseline', re.IGNORECASE)),
+    (2, re.compile(r'method|design|randomi[sz]|end ?point|objective|population|statistical|conclusion', re.IGNORECASE)),
+    (1, re.compile(r'\d+(?:\.\d+)?\s*%|\bn\s*=\s*\d+', re.IGNORECASE)),
+    (-3, re.compile(r'appendix|listing|table of contents|signature page|copyright|page \d+ of \d+', re.IGNORECASE)),
+]
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token estimate (about 4 characters per token for English text).
+    """
+    return (len(text) + 3) // 4
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model: str = MODEL_NAME):
+    """
+    Returns the local tiktoken encoding for model, or None when tiktoken or its encoding file
+    is unavailable (token counts then fall back to estimate_tokens).
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Models tiktoken does not know yet use the encoding of the current OpenAI models
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"Tokenizer unavailable, falling back to estimated token counts: {str(e)}")
+        return None
+
+def count_tokens(text: str, model: str = MODEL_NAME) -> int:
+    encoding = get_tokenizer(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = MODEL_NAME) -> str:
+    """
+    Returns the longest prefix of text that fits in max_tokens.
+    """
+    encoding = get_tokenizer(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+def split_text_by_tokens(text: str, max_tokens: int, model: str = MODEL_NAME) -> List[str]:
+    """
+    Hard-splits text into consecutive pieces of at most max_tokens each.
+    """
+    encoding = get_tokenizer(model)
+    if encoding is None:
+        max_chars = max_tokens * 4
+        return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+def expected_output_tokens(publication_type: str, analysis_type: str) -> int:
+    """
+    Estimates the output length from the publication and analysis length limits.
+    """
+    estimates = []
+    for info in (PUBLICATION_TYPES[publication_type], ANALYSIS_TYPES[analysis_type]):
+        if "max_words" in info:
+            estimates.append(info["max_words"] * TOKENS_PER_WORD)
+        elif "max_characters" in info:
+            estimates.append(info["max_characters"] / 4)
+    # Tables and chart JSON come on top of the prose
+    return min(MAX_OUTPUT_TOKENS, int(max(estimates, default=0)) + 1500)
+
+def plan_token_budget(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str, max_output_tokens: int = MAX_OUTPUT_TOKENS, context_window: int = MODEL_CONTEXT_WINDOW) -> Dict[str, Any]:
+    """
+    Counts the tokens of a generation request before it is sent.
+
+    Returns:
+    - Dict[str, Any]: Token counts for the source, the extracted tabular data, the instructions
+      (system prompt, prompt template and additional instructions) and the output, the number of
+      source tokens that fit into the context window, whether the request overflows, and the
+      estimated cost in USD for the expected and the maximum output length.
+    """
+    instruction_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(build_generation_prompt(publication_type, analysis_type, "", additional_instructions))
+    source_tokens = count_tokens(user_input)
+    tabular_tokens = 0
+    # Every template sends the extracted tables in their own slot and replaces the table blocks in
+    # the source by a one-line reference
+    tabular_data = extract_tabular_data(user_input)
+    if not tabular_data.startswith("No tabular data found"):
+        tabular_tokens = count_tokens(tabular_data)
+        source_tokens = count_tokens(strip_table_blocks(user_input))
+    prompt_tokens = instruction_tokens + source_tokens + tabular_tokens
+    expected_tokens = expected_output_tokens(publication_type, analysis_type)
+    available_source_tokens = max(0, context_window - max_output_tokens - instruction_tokens - tabular_tokens)
+    pricing = MODEL_PRICING.get(MODEL_NAME, {"input": 0.0, "output": 0.0})
+    return {
+        "source_tokens": source_tokens,
+        "tabular_tokens": tabular_tokens,
+        "instruction_tokens": instruction_tokens,
+        "prompt_tokens": prompt_tokens,
+        "expected_output_tokens": expected_tokens,
+        "max_output_tokens": max_output_tokens,
+        "context_window": context_window,
+        "available_source_tokens": available_source_tokens,
+        "overflow": source_tokens > available_source_tokens,
+        "estimated_cost": (prompt_tokens * pricing["input"] + expected_tokens * pricing["output"]) / 1e6,
+        "max_cost": (prompt_tokens * pricing["input"] + max_output_tokens * pricing["output"]) / 1e6,
+    }
+
+def source_block_priority(block: str) -> int:
+    return sum(weight for weight, pattern in SOURCE_PRIORITY_PATTERNS if pattern.search(block))
+
+def fit_source_to_budget(user_input: str, max_tokens: int) -> str:
+    """
+    Trims the source to max_tokens by dropping its lowest-priority paragraphs.
+
+    Paragraphs are ranked with SOURCE_PRIORITY_PATTERNS (results, safety and design content first,
+    appendices and listings last; earlier paragraphs win ties) and the kept paragraphs are emitted
+    in their original order. File headers are always kept.
+    """
+    if count_tokens(user_input) <= max_tokens:
+        return user_input
+    blocks = [block for block in re.split(r'\n\s*\n', user_input) if block.strip()]
+    block_tokens = [count_tokens(block) + 1 for block in blocks]
+    is_header = [bool(re.fullmatch(r'###\s.*\s###', block.strip())) for block in blocks]
+    ranked = sorted(range(len(blocks)), key=lambda i: (not is_header[i], -source_block_priority(blocks[i]), i))
+    kept = set()
+    used = 0
+    for i in ranked:
+        if used + block_tokens[i] <= max_tokens:
+            kept.add(i)
+            used += block_tokens[i]
+    dropped = len(blocks) - len(kept)
+    logging.info(f"Trimmed source to {used:,} tokens by dropping {dropped} low-priority paragraphs.")
+    return "\n\n".join(blocks[i] for i in sorted(kept))
+
+def prepare_source_for_prompt(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str) -> str:
+    """
+    Returns the source unchanged when the request fits the context window, otherwise trimmed by priority.
+    """
+    plan = plan_token_budget(publication_type, analysis_type, user_input, additional_instructions)
+    if plan["overflow"]:
+        logging.warning(f"Source of {plan['source_tokens']:,} tokens exceeds the budget of {plan['available_source_tokens']:,} tokens; trimming by priority.")
+        return fit_source_to_budget(user_input, plan["available_source_tokens"])
+    return user_input
+
+# Map-reduce settings for sources that do not fit into a single prompt
+MAP_REDUCE_CHUNK_TOKENS = 12000
+MAP_REDUCE_CONCURRENCY = 4
+MAP_REDUCE_AUTO_THRESHOLD_TOKENS = 90000
+MAP_REDUCE_MAX_DIGEST_TOKENS = 2000
+
+MAP_PROMPT = """
+You are condensing part {index} of {total} of the source documents for a clinical study publication.
+
+Extract every fact from the excerpt below that a medical writer would need, keeping the original wording for key statements:
+- Study design, objectives, population, inclusion/exclusion criteria and interventions
+- Endpoints and statistical methods
+- All numerical results with units, confidence intervals, p-values and patient counts
+- Safety findings, adverse events and discontinuations
+- Tables: reproduce relevant tables as Markdown tables with their titles
+
+Do not interpret, add or invent information. Omit boilerplate, page headers and repeated text.
+If the excerpt contains nothing relevant, answer "No relevant content."
+
+Excerpt:
+{chunk}
+"""
+
+def split_into_chunks(text: str, max_tokens: int = MAP_REDUCE_CHUNK_TOKENS) -> List[str]:
+    """
+    Splits text into chunks of at most max_tokens, breaking at paragraph boundaries where possible.
+
+    Parameters:
+    - text (str): The source text.
+    - max_tokens (int): The token budget per chunk.
+
+    Returns:
+    - List[str]: The chunks in source order.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in re.split(r'\n\s*\n', text):
+        if not paragraph.strip():
+            continue
+        paragraph_tokens = count_tokens(paragraph)
+        if paragraph_tokens > max_tokens:
+            # Oversized paragraphs (e.g. long listings) are split at line boundaries, then hard-split
+            pieces = []
+            for line in paragraph.split('\n'):
+                pieces.extend(split_text_by_tokens(line, max_tokens) if count_tokens(line) > max_tokens else [line])
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append("\n\n".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def summarize_chunk(chunk: str, index: int, total: int) -> str:
+    """
+    Map step: extracts the publication-relevant facts from one chunk.
+    Digests are cached by normalized chunk content so reruns only pay for chunks that changed.
+    Near-identical chunks are not reused, since a changed number (e.g. a hazard ratio) barely moves their similarity.
+    """
+    key = hashlib.sha256(json.dumps(["map", PROMPT_TEMPLATE_VERSION, MODEL_NAME, normalize_text(chunk)], ensure_ascii=False).encode("utf-8")).hexdigest()
+    cached = digest_cache.get(key)
+    if cached is not None:
+        return cached["digest"]
+
+    response = chat_completion(
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": MAP_PROMPT.format(index=index, total=total, chunk=chunk)}
+        ],
+        max_tokens=MAP_REDUCE_MAX_DIGEST_TOKENS,
+        temperature=0
+    )
+    digest = response.choices[0].message.content or ""
+    if digest:
+        digest_cache.set(key, {"digest": digest})
+    return digest
+
+def condense_source(user_input: str, chunk_tokens: int = MAP_REDUCE_CHUNK_TOKENS, concurrency: int = MAP_REDUCE_CONCURRENCY, metrics: Optional[Dict[str, float]] = None) -> str:
+    """
+    Splits a large source into token-bounded chunks and condenses them in parallel.
+
+    The resulting digest keeps the chunks in source order and is used as the input of the final
+    publication prompt (the reduce step).
+
+    Parameters:
+    - user_input (str): The combined source text.
+    - chunk_tokens (int): Token budget per chunk.
+    - concurrency (int): Maximum number of chunks summarized at the same time.
+    - metrics (Optional[Dict[str, float]]): If given, filled with 'chunk_count', 'failed_chunks',
+      'split_latency' and 'map_latency' in seconds.
+
+    Returns:
+    - str: The condensed digest. A chunk whose map request failed (after the retries in
+      chat_completion) is included as raw text, so one failure does not abort the generation.
+    """
+    if metrics is None:
+        metrics = {}
+    start_time = time.perf_counter()
+    chunks = split_into_chunks(user_input, chunk_tokens)
+    metrics["chunk_count"] = len(chunks)
+    metrics["split_latency"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # Each task runs in a copy of this context so the chunks keep the caller's request priority
+        futures = [
+            executor.submit(contextvars.copy_context().run, summarize_chunk, chunk, index, len(chunks))
+            for index, chunk in enumerate(chunks, 1)
+        ]
+        digests = []
+        metrics["failed_chunks"] = 0
+        for index, (chunk, future) in enumerate(zip(chunks, futures), 1):
+            try:
+                digests.append(future.result())
+            except Exception as e:
+                logging.error(f"Condensing chunk {index} of {len(chunks)} failed, using its raw text instead: {str(e)}")
+                metrics["failed_chunks"] += 1
+                digests.append(chunk)
+    metrics["map_latency"] = time.perf_counter() - start_time
+    logging.debug(f"Map-reduce condensing metrics: {metrics}")
+
+    return "\n\n".join(
+        f"### Source excerpt {index} of {len(chunks)} ###\n\n{digest}"
+        for index, digest in enumerate(digests, 1)
+    )
+
+# Section-parallel generation settings
+SECTION_PARALLEL_CONCURRENCY = 6
+SECTION_MAX_TOKENS = 4000
+
+# Sections written from the finished body sections instead of directly from the source
+SUMMARY_SECTIONS = {"Title", "Abstract", "Conclusion", "Conclusions", "Key Points", "Keywords"}
+# Sections that need the results sections to be finished first
+INTERPRETATION_SECTIONS = {"Discussion", "What do the results mean for patients?", "What's next?"}
+# Sections excluded when splitting the length budget
+FRONT_MATTER_SECTIONS = {"Title", "Authors", "Affiliations", "Keywords", "Funding", "Disclosures", "Review", "References", "Acknowledgements"}
+
+SECTION_PROMPT = """
+You are writing one section of a {publication_type} for a {analysis_type}.
+
+**Section to write:** {section}
+
+### **Guidelines:**
+- Target length for this section: about {section_budget} {length_type}.
+- Write only the content of the "{section}" section. Do not repeat the section heading and do not write any other section.
+- Use clear and concise language appropriate for a scientific publication.
+- If specific information is not provided in the input, use placeholder text or general statements that would be appropriate for the section.
+- Use Markdown table syntax for tables and use actual data from the source document where available.
+{extra_guidelines}
+{context_label}:
+{context}
+
+Additional Instructions:
+{additional_instructions}
+"""
+
+VISUALIZATIONS_PROMPT = """
+Extract key numerical data from the input below and suggest up to 2 relevant charts or visualizations for a {publication_type} ({analysis_type}).
+For each chart, provide the following in JSON format, enclosed within triple backticks and specify the language as JSON:
+
+```json
+{{
+  "type": "Chart Type (e.g., Bar Chart, Line Chart)",
+  "title": "Chart Title",
+  "x_label": "X-axis Label",
+  "y_label": "Y-axis Label",
+  "data_series": ["Numerical Series1", "Numerical Series2", ...],
+  "data": [
+    {{"X-axis Value": ..., "Numerical Series1": ..., "Numerical Series2": ...}},
+    ...
+  ]
+}}
+```
+
+Respond with the JSON blocks only.
+
+Input:
+{context}
+"""
+
+def build_section_graph(structure: List[str]) -> "nx.DiGraph":
+    """
+    Turns the combined structure into a DAG of section jobs.
+
+    Body sections have no dependencies. Interpretation sections (e.g. Discussion) depend on the
+    results sections, and summary sections (e.g. Abstract, Conclusion) depend on every other section.
+    """
+    import networkx as nx
+    graph = nx.DiGraph()
+    graph.add_nodes_from(structure)
+    results_sections = [section for section in structure if "result" in section.lower()]
+    for section in structure:
+        if section in SUMMARY_SECTIONS:
+            for other in structure:
+                if other not in SUMMARY_SECTIONS:
+                    graph.add_edge(other, section)
+        elif section in INTERPRETATION_SECTIONS:
+            for other in results_sections:
+                graph.add_edge(other, section)
+    return graph
+
+def get_section_requirement(publication_type: str, section: str) -> str:
+    """
+    Returns the requirement bullet (with its sub-bullets) for one section of the publication type.
+    """
+    requirements = get_section_requirements(publication_type) or ""
+    lines = requirements.split('\n')
+    pattern = re.compile(r'^(\s*)-\s+(\*\*)?' + re.escape(section) + r'(\*\*)?\s*:', re.IGNORECASE)
+    for index, line in enumerate(lines):
+        match = pattern.match(line)
+        if match:
+            indent = len(match.group(1))
+            block = [line.strip()]
+            for following in lines[index + 1:]:
+                if not following.strip() or len(following) - len(following.lstrip()) <= indent:
+                    break
+                block.append(following.strip())
+            return "\n".join(block)
+    return ""
+
+def strip_section_heading(section: str, content: str) -> str:
+    content = content.strip()
+    first_line = content.split('\n', 1)[0]
+    if first_line.lstrip('#* ').rstrip('*: ').strip().lower() == section.lower():
+        content = content[len(first_line):].strip()
+    return content
+
+def fit_context_to_prompt(prompt_template: str, context: str, max_output_tokens: int = SECTION_MAX_TOKENS, **fields: Any) -> str:
+    """
+    Trims context by priority (see fit_source_to_budget) so that the system prompt, prompt_template
+    filled with fields and context, and max_output_tokens fit the model context window.
+    """
+    prompt_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(prompt_template.format(context="", **fields))
+    return fit_source_to_budget(context, max(0, MODEL_CONTEXT_WINDOW - max_output_tokens - prompt_tokens))
+
+def generate_section(publication_type: str, analysis_type: str, section: str, context_label: str, context: str, additional_instructions: str, section_budget: int, length_type: str) -> str:
+    extra_guidelines = []
+    requirement = get_section_requirement(publication_type, section)
+    if requirement:
+        extra_guidelines.append(f"- Section requirements: {requirement}")
+    if publication_type == "Plain Language Summary":
+        extra_guidelines.append("- Write at a 6th to 8th-grade reading level with short sentences and everyday words; explain any medical terms.")
+    if section.lower().startswith("acknowledgement"):
+        extra_guidelines.append(f'- ALWAYS include the text: "This {publication_type} was created with the assistance of generative AI technology."')
+
+    fields = {
+        "publication_type": publication_type,
+        "analysis_type": analysis_type,
+        "section": section,
+        "section_budget": section_budget,
+        "length_type": length_type,
+        "extra_guidelines": "\n".join(extra_guidelines) + ("\n" if extra_guidelines else ""),
+        "context_label": context_label,
+        "additional_instructions": additional_instructions,
+    }
+    # Every section request gets the same token budget trimming as a single-request generation
+    prompt = SECTION_PROMPT.format(context=fit_context_to_prompt(SECTION_PROMPT, context, **fields), **fields)
+    response = chat_completion(
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=SECTION_MAX_TOKENS,
+        temperature=0
+    )
+    return strip_section_heading(section, response.choices[0].message.content or "")
+
+def generate_visualizations(publication_type: str, analysis_type: str, context: str) -> str:
+    response = chat_completion(
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": VISUALIZATIONS_PROMPT.format(
+                publication_type=publication_type,
+                analysis_type=analysis_type,
+                context=fit_context_to_prompt(VISUALIZATIONS_PROMPT, context, publication_type=publication_type, analysis_type=analysis_type)
+            )}
+        ],
+        max_tokens=SECTION_MAX_TOKENS,
+        temperature=0
+    )
+    return response.choices[0].message.content or ""
+
+def generate_document_by_sections(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str, concurrency: int = SECTION_PARALLEL_CONCURRENCY, top_k: Optional[int] = None, metrics: Optional[Dict[str, Any]] = None, on_section_complete: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """
+    Generates the document section by section, running independent sections concurrently.
+
+    Sections are scheduled in the topological generations of build_section_graph, so summary
+    sections such as the Abstract and Conclusion are written last from the finished sections.
+    The sections are stitched back together in structure order.
+
+    Parameters:
+    - concurrency (int): Maximum number of section requests in flight.
+    - top_k (Optional[int]): If set, each body section only receives its top-k retrieved source
+      passages instead of the full source.
+    - metrics (Optional[Dict[str, Any]]): If given, filled with 'stages' (sections and latency per
+      DAG level) and 'total_latency' in seconds.
+    - on_section_complete (Optional[Callable[[str], None]]): Called with each finished section name.
+
+    Returns:
+    - Dict[str, Any]: The same {"content", "charts"} result as generate_document.
+    """
+    if metrics is None:
+        metrics = {}
+    metrics["stages"] = []
+    start_time = time.perf_counter()
+    try:
+        structure = get_combined_structure(publication_type, analysis_type)
+        pub_type_info = PUBLICATION_TYPES[publication_type]
+        length_type = "words" if "max_words" in pub_type_info else "characters"
+        max_length = pub_type_info.get("max_words", pub_type_info.get("max_characters", 0))
+        body_count = max(1, len([section for section in structure if section not in FRONT_MATTER_SECTIONS]))
+        section_budget = max(50, max_length // body_count)
+        index = get_source_index(user_input) if top_k else None
+
+        def section_source(section: str) -> str:
+            if index is None:
+                return user_input
+            return "\n\n".join(index.passages[i] for i, _ in index.search(section_query(section), top_k)) or user_input
+
+        import networkx as nx
+        sections = {}
+        graph = build_section_graph(structure)
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for level in nx.topological_generations(graph):
+                level_start = time.perf_counter()
+                futures = {}
+                for section in level:
+                    if graph.in_degree(section):
+                        dependencies = nx.ancestors(graph, section)
+                        finished = "\n\n".join(f"## {name}\n\n{sections[name]}" for name in structure if name in dependencies)
+                        futures[section] = executor.submit(contextvars.copy_context().run, generate_section, publication_type, analysis_type, section, "Finished sections", finished, additional_instructions, section_budget, length_type)
+                    else:
+                        futures[section] = executor.submit(contextvars.copy_context().run, generate_section, publication_type, analysis_type, section, "Input", section_source(section), additional_instructions, section_budget, length_type)
+                if not metrics["stages"] and publication_type not in ("Plain Language Summary", "Congress Abstract"):
+                    futures["Visualizations"] = executor.submit(contextvars.copy_context().run, generate_visualizations, publication_type, analysis_type, section_source("Results"))
+                for section, future in futures.items():
+                    sections[section] = future.result()
+                    if on_section_complete:
+                        on_section_complete(section)
+                metrics["stages"].append({"sections": list(futures), "latency": time.perf_counter() - level_start})
+
+        parts = [f"## {section}\n\n{sections[section]}" for section in structure]
+        if "Visualizations" in sections:
+            parts.append(f"## Visualizations\n\n{sections['Visualizations']}")
+        metrics["total_latency"] = time.perf_counter() - start_time
+        logging.debug(f"Section-parallel generation metrics: {metrics}")
+        return build_generation_result("\n\n".join(parts))
+
+    except Exception as e:
+        logging.error(f"Error in generate_document_by_sections: {str(e)}")
+        return {"content": f"An error occurred while generating the document: {str(e)}", "charts": []}
+
+def generate_document_by_sections_cached(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str, concurrency: int = SECTION_PARALLEL_CONCURRENCY, top_k: Optional[int] = None, metrics: Optional[Dict[str, Any]] = None, on_section_complete: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    key = generation_cache_key(publication_type, analysis_type, user_input, additional_instructions, pipeline=sections_pipeline(top_k))
+    return cached_generation(key, lambda: generate_document_by_sections(
+        publication_type, analysis_type, user_input, additional_instructions, concurrency, top_k, metrics, on_section_complete
+    ))
+
+def extract_chart_info(content: str) -> List[Dict[str, Any]]:
+    """
+    Extracts chart information from the '## Visualizations' section of the generated content.
+
+    Parameters:
+    - content (str): The full generated content containing chart JSON.
+
+    Returns:
+    - List[Dict[str, Any]]: A list of chart information dictionaries.
+    """
+    charts = []
+    # Locate the '## Visualizations' section
+    visualizations_match = re.search(r'##\s+Visualizations\s*([\s\S]*)', content, re.IGNORECASE)
+    if visualizations_match:
+        visualizations_content = visualizations_match.group(1)
+        logging.debug(f"Found 'Visualizations' section:\n{visualizations_content}")
+        # Find all JSON blocks within the 'Visualizations' section
+        json_blocks = re.findall(r'```json\s*([\s\S]*?)```', visualizations_content, re.DOTALL | re.IGNORECASE)
+        logging.debug(f"Found {len(json_blocks)} JSON blocks in 'Visualizations' section.")
+        for idx, json_str in enumerate(json_blocks, 1):
+            try:
+                json_str = json_str.strip()
+                chart_info = json.loads(json_str)
+                # Validate required fields
+                if not validate_chart_data(chart_info):
+                    logging.warning(f"Chart {idx} is missing required fields or has invalid data.")
+                    continue
+                charts.append(chart_info)
+                logging.debug(f"Chart {idx} extracted successfully.")
+            except json.JSONDecodeError as e:
+                logging.error(f"JSON decoding error in chart {idx}: {e} in block: {json_str}")
+                continue
+    else:
+        logging.warning("No 'Visualizations' section found in the generated content.")
+    return charts
 
 def validate_chart_data(chart_info: Dict[str, Any]) -> bool:
     required_fields = {"type", "title", "x_label", "y_label", "data_series", "data"}
@@ -866,15 +2313,93 @@ def validate_chart_data(chart_info: Dict[str, Any]) -> bool:
 
     return True
 
+# Charts with more rows than CHART_LARGE_DATA_THRESHOLD (e.g. driven by an uploaded listing) switch to a
+# large-dataset path: series are downsampled, bars are drawn as one filled outline, and only a few
+# selected points are annotated, so rendering time stays bounded regardless of row count
+CHART_LARGE_DATA_THRESHOLD = 100
+CHART_MAX_LINE_POINTS = 1000
+CHART_MAX_SCATTER_POINTS = 5000
+CHART_MAX_BARS = 300
+CHART_MAX_ANNOTATIONS = 6
+CHART_MAX_TICK_LABELS = 30
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Selects threshold points of a series with Largest-Triangle-Three-Buckets downsampling, which
+    keeps the peaks, troughs and overall shape of the line.
+
+    Parameters:
+    - x (np.ndarray): Ascending x positions.
+    - y (np.ndarray): Values at x, without NaNs.
+    - threshold (int): Number of points to keep.
+
+    Returns:
+    - np.ndarray: Ascending indices of the selected points.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third vertex of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+def downsample_series(x: np.ndarray, y: np.ndarray, threshold: int = CHART_MAX_LINE_POINTS) -> np.ndarray:
+    # LTTB over the finite points only; returns indices into the original arrays
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    return finite[lttb_indices(x[finite], y[finite], threshold)]
+
+def select_annotation_indices(values: np.ndarray, limit: int = CHART_MAX_ANNOTATIONS) -> List[int]:
+    """
+    Picks the points worth labelling in a large series: the first, last, minimum and maximum,
+    then the largest remaining magnitudes, up to limit points spaced apart so labels do not overlap.
+    """
+    finite = np.flatnonzero(np.isfinite(values))
+    if len(finite) == 0:
+        return []
+    finite_values = values[finite]
+    candidates = [finite[0], finite[-1], finite[np.argmin(finite_values)], finite[np.argmax(finite_values)]]
+    candidates.extend(finite[np.argsort(-np.abs(finite_values))])
+    min_gap = len(values) // (limit * 2)
+    selected = []
+    for i in candidates:
+        if len(selected) == limit:
+            break
+        if all(abs(int(i) - j) > min_gap for j in selected):
+            selected.append(int(i))
+    return sorted(selected)
+
+def thin_tick_labels(ax, positions: np.ndarray, labels: List[Any], max_labels: int = CHART_MAX_TICK_LABELS) -> None:
+    step = max(1, math.ceil(len(positions) / max_labels))
+    ax.set_xticks(positions[::step])
+    ax.set_xticklabels([str(label) for label in labels[::step]], rotation=45, ha='right')
+
 def create_chart(chart_info: Dict[str, Any]):
     """
     Creates a Matplotlib figure based on the provided chart information.
 
+    Uses the object-oriented Figure API rather than pyplot, so no global figure state is created
+    and figures need no explicit closing. Bar, line, scatter and waterfall charts with more than
+    CHART_LARGE_DATA_THRESHOLD rows take the large-dataset path.
+
     Parameters:
     - chart_info (Dict[str, Any]): Dictionary containing chart specifications.
 
     Returns:
-    - plt.Figure: The created Matplotlib figure.
+    - Figure: The created Matplotlib figure.
     """
     chart_type = chart_info.get('type', '').lower()
     title = chart_info.get('title', '')
@@ -887,23 +2412,65 @@ def create_chart(chart_info: Dict[str, Any]):
         raise ValueError("No data available for chart creation")
 
     df = pd.DataFrame(data)
-    # Convert numeric columns to numbers, if possible
+    # Convert numeric columns to numbers, if possible; category columns (arms, subgroups) are kept
     for col in df.columns:
         if col != x_label and df[col].dtype == object:
-            df[col] = pd.to_numeric(df[col].astype(str).str.replace('%', ''), errors='coerce')
+            converted = pd.to_numeric(df[col].astype(str).str.replace('%', ''), errors='coerce')
+            if converted.notna().sum() == df[col].notna().sum():
+                df[col] = converted
+
+    import_chart_libraries()
+    import seaborn as sns
+    from matplotlib.figure import Figure
+    from lifelines import KaplanMeierFitter
+    from lifelines.plotting import add_at_risk_counts
 
-    fig, ax = plt.subplots(figsize=(10, 6))  # Adjust figure size
+    fig = Figure(figsize=(10, 6))  # Adjust figure size
+    ax = fig.subplots()
+    large_data = len(df) > CHART_LARGE_DATA_THRESHOLD
 
     try:
         if 'bar' in chart_type:
-            if x_label in df.columns:
+            if x_label in df.columns and len(df) > CHART_MAX_BARS:
+                # One filled step outline per series instead of one rectangle per bar
+                positions = np.arange(len(df), dtype=float)
+                for series in data_series:
+                    values = df[series].to_numpy(dtype=float)
+                    kept = downsample_series(positions, values)
+                    ax.fill_between(positions[kept], 0, values[kept], step='mid', alpha=0.6, label=series)
+                    for i in select_annotation_indices(values):
+                        ax.annotate(f'{values[i]:.2f}', (positions[i], values[i]), ha='center', va='bottom')
+                thin_tick_labels(ax, positions, df[x_label].tolist())
+                ax.set_xlabel(x_label)
+                ax.legend(loc='upper right')
+            elif x_label in df.columns:
                 bars = df.plot(kind='bar', x=x_label, y=data_series, ax=ax)
                 for bar in bars.containers:
-                    ax.bar_label(bar, label_type='edge')
+                    if large_data:
+                        values = np.asarray(bar.datavalues, dtype=float)
+                        selected = set(select_annotation_indices(values))
+                        ax.bar_label(bar, labels=[f'{v:g}' if i in selected else '' for i, v in enumerate(values)], label_type='edge')
+                    else:
+                        ax.bar_label(bar, label_type='edge')
+                if large_data:
+                    thin_tick_labels(ax, np.arange(len(df)), df[x_label].tolist())
             else:
                 raise ValueError(f"X-axis label '{x_label}' not found in data columns.")
         elif 'line' in chart_type:
-            if x_label in df.columns:
+            if x_label in df.columns and large_data:
+                # Plot the union of the LTTB-selected rows of every series, without markers
+                x_values = pd.to_numeric(df[x_label], errors='coerce').to_numpy(dtype=float)
+                positions = x_values if np.isfinite(x_values).all() else np.arange(len(df), dtype=float)
+                kept = set()
+                for series in data_series:
+                    kept.update(downsample_series(positions, df[series].to_numpy(dtype=float)).tolist())
+                lines = df.iloc[sorted(kept)].plot(kind='line', x=x_label, y=data_series, ax=ax)
+                for line in lines.get_lines():
+                    xdata = np.asarray(line.get_xdata())
+                    ydata = np.asarray(line.get_ydata(), dtype=float)
+                    for i in select_annotation_indices(ydata):
+                        ax.text(xdata[i], ydata[i], f'{ydata[i]:.2f}', ha='center', va='bottom')
+            elif x_label in df.columns:
                 lines = df.plot(kind='line', x=x_label, y=data_series, ax=ax, marker='o')
                 for line in lines.get_lines():
                     for x, y in zip(line.get_xdata(), line.get_ydata()):
@@ -919,7 +2486,15 @@ def create_chart(chart_info: Dict[str, Any]):
             else:
                 raise ValueError("Pie chart requires exactly one data series.")
         elif 'scatter' in chart_type:
-            if len(data_series) == 2:
+            if len(data_series) == 2 and large_data:
+                plot_df = df.sample(n=CHART_MAX_SCATTER_POINTS, random_state=0) if len(df) > CHART_MAX_SCATTER_POINTS else df
+                plot_df.plot(kind='scatter', x=data_series[0], y=data_series[1], ax=ax, s=8, alpha=0.5)
+                # Label only the extreme points, taken from the full data so sampling cannot drop them
+                y_values = df[data_series[1]].to_numpy(dtype=float)
+                for i in select_annotation_indices(y_values):
+                    label = df[x_label].iloc[i] if x_label in df.columns else f'{y_values[i]:.2f}'
+                    ax.annotate(label, (df[data_series[0]].iloc[i], y_values[i]))
+            elif len(data_series) == 2:
                 scatter = df.plot(kind='scatter', x=data_series[0], y=data_series[1], ax=ax)
                 for i, txt in enumerate(df[x_label]):
                     ax.annotate(txt, (df[data_series[0]][i], df[data_series[1]][i]))
@@ -934,19 +2509,25 @@ def create_chart(chart_info: Dict[str, Any]):
                 raise ValueError("Histogram requires exactly one data series.")
         elif 'kaplan-meier curve' in chart_type:
             if len(data_series) >= 2:
-                kmf = KaplanMeierFitter()
                 # Assume first series is duration and second is event observed
                 duration_col = data_series[0]
                 event_col = data_series[1]
+                fitters = []
                 if len(data_series) > 2:
                     groups = data_series[2]
                     for group in df[groups].unique():
                         mask = df[groups] == group
+                        kmf = KaplanMeierFitter()
                         kmf.fit(df[duration_col][mask], event_observed=df[event_col][mask], label=str(group))
                         kmf.plot_survival_function(ax=ax)
+                        fitters.append(kmf)
                 else:
+                    kmf = KaplanMeierFitter()
                     kmf.fit(df[duration_col], event_observed=df[event_col], label="All")
                     kmf.plot_survival_function(ax=ax)
+                    fitters.append(kmf)
+                if chart_info.get('at_risk_counts'):
+                    add_at_risk_counts(*fitters, ax=ax, fig=fig, rows_to_show=["At risk"])
                 ax.set_xlabel(x_label, fontsize=12)
                 ax.set_ylabel(y_label, fontsize=12)
             else:
@@ -965,16 +2546,31 @@ def create_chart(chart_info: Dict[str, Any]):
                 df['cumulative'] = df[data_series[1]].cumsum()
                 df['base'] = df['cumulative'] - df[data_series[1]]
                 
-                colors = ['g' if x >= 0 else 'r' for x in df[data_series[1]]]
-                ax.bar(df[data_series[0]], df[data_series[1]], bottom=df['base'], color=colors)
-                
-                for i, (index, row) in enumerate(df.iterrows()):
-                    ax.text(i, row['cumulative'], f'{row[data_series[1]]:.1f}', 
-                            ha='center', va='bottom' if row[data_series[1]] >= 0 else 'top')
+                if large_data:
+                    positions = np.arange(len(df), dtype=float)
+                    values = df[data_series[1]].to_numpy(dtype=float)
+                    cumulative = df['cumulative'].to_numpy(dtype=float)
+                    if len(df) > CHART_MAX_BARS:
+                        # Filled outline of the floating bars, downsampled along the cumulative edge
+                        kept = downsample_series(positions, cumulative)
+                        for color, mask in (('g', values[kept] >= 0), ('r', values[kept] < 0)):
+                            ax.fill_between(positions[kept], df['base'].to_numpy(dtype=float)[kept], cumulative[kept], where=mask, color=color, step='mid')
+                    else:
+                        ax.bar(positions, values, bottom=df['base'], color=['g' if x >= 0 else 'r' for x in values])
+                    for i in select_annotation_indices(values):
+                        ax.text(i, cumulative[i], f'{values[i]:.1f}', ha='center', va='bottom' if values[i] >= 0 else 'top')
+                    thin_tick_labels(ax, positions, df[data_series[0]].tolist())
+                else:
+                    colors = ['g' if x >= 0 else 'r' for x in df[data_series[1]]]
+                    ax.bar(df[data_series[0]], df[data_series[1]], bottom=df['base'], color=colors)
+                    
+                    for i, (index, row) in enumerate(df.iterrows()):
+                        ax.text(i, row['cumulative'], f'{row[data_series[1]]:.1f}', 
+                                ha='center', va='bottom' if row[data_series[1]] >= 0 else 'top')
+                    ax.set_xticklabels(df[data_series[0]], rotation=45, ha='right')
                 
                 ax.set_xlabel(data_series[0], fontsize=12)
                 ax.set_ylabel(data_series[1], fontsize=12)
-                ax.set_xticklabels(df[data_series[0]], rotation=45, ha='right')
             else:
                 raise ValueError("Waterfall chart requires at least two data series: categories and values.")
         elif 'box plot' in chart_type:
@@ -994,31 +2590,376 @@ def create_chart(chart_info: Dict[str, Any]):
         else:
             raise ValueError(f"Unsupported chart type: {chart_type}")
 
+        if large_data and ax.get_legend() is not None:
+            # The default 'best' placement scans every plotted artist
+            ax.legend(loc='upper right')
         ax.set_title(title, fontsize=14)
-        plt.tight_layout()
+        fig.tight_layout()
 
         return fig
 
     except Exception as e:
-        plt.close(fig)
         logging.error(f"Error creating chart '{title}': {str(e)}")
         raise
 
-def extract_text_from_pdf(file):
+# One long-lived pool of worker processes is shared by file extraction and chart rendering
+PROCESS_POOL_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+@st.cache_resource(show_spinner=False)
+def get_process_pool(max_workers: int = PROCESS_POOL_MAX_WORKERS) -> ProcessPoolExecutor:
+    """
+    Returns the worker process pool, created on first use and kept for the life of the server.
+
+    Workers are started by a forkserver (spawned where that is unavailable) rather than forked from
+    this multi-threaded process, where a child could inherit a lock held by another thread. The
+    forkserver preloads Copilot once, and each worker imports the parsers and plotting libraries
+    as soon as it starts.
+    """
+    import process_workers
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["Copilot"])
+    else:
+        context = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+    for _ in range(max_workers):
+        pool.submit(process_workers.warm_up)
+    return pool
+
+def run_in_process_pool(function: Callable, *iterables, max_workers: int = PROCESS_POOL_MAX_WORKERS) -> Optional[List[Any]]:
+    """
+    Maps a process_workers function over iterables in the shared worker pool.
+
+    Returns:
+    - Optional[List[Any]]: The results in order, or None if the pool is unavailable, in which case the
+      caller does the work in-process. A broken pool is discarded, so the next call starts a new one.
+    """
+    pool = None
+    try:
+        pool = get_process_pool(max_workers)
+        return list(pool.map(function, *iterables))
+    except (BrokenProcessPool, OSError, pickle.PicklingError) as e:
+        logging.warning(f"Worker processes unavailable, running in-process instead: {str(e)}")
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        get_process_pool.clear()
+        return None
+
+# Charts are rendered once per spec at both resolutions: on screen and in the DOCX/PDF exports
+CHART_SCREEN_DPI = 100
+CHART_PRINT_DPI = 300
+CHART_DPIS = (CHART_SCREEN_DPI, CHART_PRINT_DPI)
+CHART_IMAGE_CACHE_MAX_BYTES = 128 * 1024 * 1024
+CHART_RENDER_MAX_WORKERS = PROCESS_POOL_MAX_WORKERS
+# Fewer charts are rendered in the calling thread, where the round trip to the pool would cost about as much as it saves
+CHART_PROCESS_POOL_MIN_CHARTS = 3
+
+class ChartImageCache:
+    """
+    Size-bounded LRU of rendered chart images keyed by a hash of the chart spec.
+
+    Each entry maps DPI to PNG bytes, so the UI and both exporters read the same render.
+    """
+
+    def __init__(self, max_bytes: int = CHART_IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[int, bytes]]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def contains(self, key: str) -> bool:
+        # Lookup without touching the hit/miss counters or the LRU order
+        with self._lock:
+            return key in self._entries
+
+    def set(self, key: str, images: Dict[int, bytes]) -> None:
+        size = sum(len(image) for image in images.values())
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= sum(len(image) for image in self._entries.pop(key).values())
+            self._entries[key] = images
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= sum(len(image) for image in evicted.values())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+@st.cache_resource
+def get_chart_image_cache() -> ChartImageCache:
+    # Held by st.cache_resource so rendered charts survive Streamlit reruns of this script
+    return ChartImageCache()
+
+def chart_spec_key(chart_info: Dict[str, Any]) -> str:
+    key_material = json.dumps(chart_info, sort_keys=True, default=str)
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+def render_chart(chart_info: Dict[str, Any]) -> Dict[int, bytes]:
+    """
+    Builds the chart figure once and saves it as PNG at every resolution in CHART_DPIS.
+    """
+    fig = create_chart(chart_info)
+    images = {}
+    for dpi in CHART_DPIS:
+        buffer = BytesIO()
+        fig.savefig(buffer, format='png', bbox_inches='tight', dpi=dpi)
+        images[dpi] = buffer.getvalue()
+    return images
+
+def get_chart_image(chart_info: Dict[str, Any], dpi: int = CHART_SCREEN_DPI) -> bytes:
+    """
+    Returns the chart as PNG bytes at dpi, rendering it only if this spec is not cached yet.
+
+    Raises:
+    - ValueError: If the chart cannot be created from chart_info.
+    """
+    cache = get_chart_image_cache()
+    key = chart_spec_key(chart_info)
+    images = cache.get(key)
+    if images is None:
+        images = render_chart(chart_info)
+        cache.set(key, images)
+    return images[dpi]
+
+def render_chart_safely(chart_info: Dict[str, Any]) -> Tuple[Optional[Dict[int, bytes]], Optional[str]]:
+    # Usually runs in a worker process, so failures come back as a message rather than an exception
+    # (create_chart has already logged them)
+    try:
+        return render_chart(chart_info), None
+    except Exception as e:
+        return None, str(e)
+
+def ensure_chart_images(charts: List[Dict[str, Any]], max_workers: int = CHART_RENDER_MAX_WORKERS) -> Dict[str, str]:
+    """
+    Renders every chart spec that is not cached yet, in the shared worker pool when at least
+    CHART_PROCESS_POOL_MIN_CHARTS charts are pending and more than one worker is available.
+    Rendering is CPU-bound and holds the GIL, so threads would not help.
+
+    Parameters:
+    - charts (List[Dict[str, Any]]): Chart information dictionaries.
+    - max_workers (int): Upper bound on worker processes.
+
+    Returns:
+    - Dict[str, str]: Error message by chart spec key for charts that could not be rendered.
+    """
+    cache = get_chart_image_cache()
+    pending = {}
+    for chart_info in charts:
+        key = chart_spec_key(chart_info)
+        if key not in pending and not cache.contains(key):
+            pending[key] = chart_info
+    if not pending:
+        return {}
+
+    results = None
+    if max_workers > 1 and len(pending) >= CHART_PROCESS_POOL_MIN_CHARTS:
+        import process_workers
+        results = run_in_process_pool(process_workers.render_chart_safely, list(pending.values()), max_workers=max_workers)
+    if results is None:
+        results = [render_chart_safely(chart_info) for chart_info in pending.values()]
+
+    errors = {}
+    for key, (images, error) in zip(pending, results):
+        if error is None:
+            cache.set(key, images)
+        else:
+            errors[key] = error
+    return errors
+
+def parse_page_ranges(spec: str) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a page selection such as "1-5, 20-30, 42" into 1-based inclusive (start, end) ranges.
+
+    Returns:
+    - Optional[List[Tuple[int, int]]]: The ranges, or None when spec is empty.
+
+    Raises:
+    - ValueError: If spec is not a valid page selection.
+    """
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)\s*(?:-\s*(\d+))?', part)
+        if not match:
+            raise ValueError(f"Invalid page range: '{part}'")
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        if start < 1 or end < start:
+            raise ValueError(f"Invalid page range: '{part}'")
+        ranges.append((start, end))
+    return ranges or None
+
+def extract_pdf_page_tables(page, table_number: int) -> Tuple[Optional[str], int]:
+    """
+    Extracts the ruled tables of a pdfplumber page as CSV blocks, followed by the page text outside them.
+
+    Parameters:
+    - page: The pdfplumber page.
+    - table_number (int): Number of tables extracted from the document so far.
+
+    Returns:
+    - Tuple[Optional[str], int]: The page text (None when the page has no usable table) and the
+      updated table count.
+    """
+    tables = []
+    for table in page.find_tables(PDF_TABLE_SETTINGS):
+        df = normalize_table(table.extract())
+        if df is not None:
+            tables.append((table.bbox, df))
+    if not tables:
+        return None, table_number
+
+    def outside_tables(obj: Dict[str, Any]) -> bool:
+        if "x0" not in obj or "top" not in obj:
+            return True
+        x = (obj["x0"] + obj["x1"]) / 2
+        y = (obj["top"] + obj["bottom"]) / 2
+        return not any(x0 <= x <= x1 and top <= y <= bottom for (x0, top, x1, bottom), _ in tables)
+
+    parts = [page.filter(outside_tables).extract_text() or ""]
+    for (x0, top, x1, bottom), df in tables:
+        table_number += 1
+        caption_lines = (page.crop((0, max(0, top - 40), page.width, top)).extract_text() or "").strip().splitlines()
+        caption = caption_lines[-1].strip() if caption_lines else ""
+        parts.append(serialize_table(df, f"{table_label(table_number, caption)}, page {page.page_number}"))
+    return "\n".join(parts), table_number
+
+def pdf_page_has_rules(page) -> bool:
+    """
+    Checks the raw content stream of a PyPDF2 page for enough drawn lines to form a ruled table.
+    """
+    try:
+        contents = page.get_contents()
+        data = contents.get_data() if contents is not None else b""
+    except Exception:
+        return True
+    return len(PDF_RULE_PATTERN.findall(data)) >= PDF_TABLE_MIN_RULES
+
+def iter_pdf_pages(file, page_ranges: Optional[List[Tuple[int, int]]] = None, extract_tables: bool = False) -> Iterator[Tuple[int, str]]:
+    """
+    Yields (page number, text) for the selected pages of a PDF, one page at a time.
+
+    Parameters:
+    - file: The PDF file.
+    - page_ranges (Optional[List[Tuple[int, int]]]): 1-based inclusive page ranges; all pages when None.
+    - extract_tables (bool): Replace the text of ruled tables by CSV blocks (requires pdfplumber).
+    """
+    import PyPDF2
     pdf_reader = PyPDF2.PdfReader(file)
-    text = ""
-    for page in pdf_reader.pages:
-        page_text = page.extract_text()
-        if page_text:
-            text += page_text + "\n"
-    return text
+    page_count = len(pdf_reader.pages)
+    if page_ranges:
+        page_numbers = sorted({number for start, end in page_ranges for number in range(start, min(end, page_count) + 1)})
+    else:
+        page_numbers = range(1, page_count + 1)
+    table_pdf = None
+    if extract_tables and PDFPLUMBER_AVAILABLE:
+        import pdfplumber
+        file.seek(0)
+        # A separate stream, so the two parsers do not move each other's file position
+        table_pdf = pdfplumber.open(BytesIO(file.read()))
+    table_number = 0
+    try:
+        for number in page_numbers:
+            page_text = None
+            if table_pdf is not None and pdf_page_has_rules(pdf_reader.pages[number - 1]):
+                table_page = table_pdf.pages[number - 1]
+                page_text, table_number = extract_pdf_page_tables(table_page, table_number)
+                # Release the parsed layout of the page; a CSR can have hundreds of pages
+                table_page.close()
+            if page_text is None:
+                page_text = pdf_reader.pages[number - 1].extract_text()
+            if page_text:
+                yield number, page_text
+    finally:
+        if table_pdf is not None:
+            table_pdf.close()
+
+def extract_text_from_pdf(file, page_ranges: Optional[List[Tuple[int, int]]] = None, max_chars: Optional[int] = None, max_tokens: Optional[int] = None, extract_tables: bool = False) -> str:
+    """
+    Extracts text from a PDF file page by page.
+
+    Parameters:
+    - file: The uploaded PDF file.
+    - page_ranges (Optional[List[Tuple[int, int]]]): 1-based inclusive page ranges to extract.
+    - extract_tables (bool): Extract ruled tables as CSV blocks (requires pdfplumber).
+    - max_chars (Optional[int]): Stop once this many characters have been extracted.
+    - max_tokens (Optional[int]): Stop once this many (estimated) tokens have been extracted.
 
-def extract_text_from_docx(file):
+    Returns:
+    - str: The extracted text.
+    """
+    budget = None
+    if max_chars:
+        budget = max_chars
+    if max_tokens:
+        budget = min(budget or max_tokens * 4, max_tokens * 4)
+    parts = []
+    used = 0
+    for number, page_text in iter_pdf_pages(file, page_ranges, extract_tables):
+        if budget is not None and used + len(page_text) + 1 > budget:
+            parts.append(page_text[:max(budget - used, 0)])
+            logging.info(f"PDF extraction stopped at page {number}: budget of {budget:,} characters reached.")
+            break
+        parts.append(page_text)
+        parts.append("\n")
+        used += len(page_text) + 1
+    return "".join(parts)
+
+def extract_text_from_docx(file, extract_tables: bool = True):
+    """
+    Extracts text from a Word document in document order, including its tables as compact CSV blocks.
+
+    Parameters:
+    - file: The uploaded DOCX file.
+    - extract_tables (bool): Include tables; when False only paragraphs are extracted.
+
+    Returns:
+    - str: The extracted text.
+    """
+    import docx
+    from docx.oxml.ns import qn
+    from docx.table import Table as DocxTable
+    from docx.text.paragraph import Paragraph as DocxParagraph
     doc = docx.Document(file)
-    text = ""
-    for para in doc.paragraphs:
-        text += para.text + "\n"
-    return text
+    parts = []
+    table_number = 0
+    caption = ""
+    for element in doc.element.body.iterchildren():
+        if element.tag == qn("w:p"):
+            text = DocxParagraph(element, doc).text
+            parts.append(text + "\n")
+            if text.strip():
+                caption = text.strip()
+        elif element.tag == qn("w:tbl") and extract_tables:
+            rows = [[cell.text for cell in row.cells] for row in DocxTable(element, doc).rows]
+            df = normalize_table(rows)
+            if df is not None:
+                table_number += 1
+                parts.append(serialize_table(df, table_label(table_number, caption)) + "\n")
+            caption = ""
+    return "".join(parts)
 
 def extract_text_from_txt(file):
     """
@@ -1032,139 +2973,1131 @@ def extract_text_from_txt(file):
     """
     return file.read().decode('utf-8')
 
-def extract_text_from_excel(file):
+# Spreadsheets and CSV files with more rows than this are sent as a statistical profile instead of
+# every row (tabular_mode "auto"); "profile" always profiles and "raw" always sends every row
+TABULAR_PROFILE_MIN_ROWS = 200
+TABULAR_MODES = ("auto", "profile", "raw")
+# Rows read per chunk while profiling, which bounds memory for large files
+TABULAR_CHUNK_ROWS = 20000
+# Values kept per numeric column (a uniform reservoir sample) to estimate medians and quartiles
+TABULAR_MEDIAN_SAMPLE_SIZE = 100000
+# Distinct values counted per column; columns with more are reported as identifiers or free text
+TABULAR_MAX_TRACKED_VALUES = 200
+TABULAR_TOP_VALUES = 8
+# Columns whose means and frequencies are broken down by group (treatment arm, visit), with exact
+# names preferred over names that merely contain the pattern
+TABULAR_GROUP_PATTERNS = {
+    "arm": (r'^(arm|actarm|trt\w*|treatment|group|cohort)$', r'arm|treat|group|cohort'),
+    "visit": (r'^(a?visit\w*|timepoint|period|cycle)$', r'visit|timepoint|period|cycle'),
+}
+TABULAR_MAX_GROUPS = 12
+TABULAR_MAX_BREAKDOWN_COLUMNS = 12
+
+def combine_moments(a: Tuple[int, float, float], b: Tuple[int, float, float]) -> Tuple[int, float, float]:
+    # Merges (count, mean, sum of squared deviations) of two chunks (Chan et al.), which is stable for large sums
+    n = a[0] + b[0]
+    if not b[0]:
+        return a
+    if not a[0]:
+        return b
+    delta = b[1] - a[1]
+    return n, a[1] + delta * b[0] / n, a[2] + b[2] + delta * delta * a[0] * b[0] / n
+
+def format_profile_number(value: float) -> str:
+    if not math.isfinite(value):
+        return "n/a"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return f"{int(value):,}"
+    if abs(value) >= 1000:
+        return f"{value:,.1f}"
+    return f"{value:#.4g}"
+
+class TableProfiler:
+    """
+    Builds a compact statistical profile of one sheet from chunks of rows, so that large sheets
+    never have to be held in memory or sent to the model row by row.
+
+    Numeric columns get counts, mean with 95% CI, SD, median and quartiles (from a reservoir
+    sample), categorical columns get value frequencies, and both are broken down by treatment
+    arm and visit columns when present. Optionally the first rows are kept verbatim up to a
+    token budget.
+    """
+
+    def __init__(self, name: str, raw_rows_tokens: int = 0, keep_first_chunk: bool = False, seed: int = 0):
+        self.name = name
+        self.rows = 0
+        self.columns: List[str] = []
+        self.kinds: Dict[str, str] = {}
+        self.moments: Dict[str, Tuple[int, float, float]] = {}
+        self.counts: Dict[str, int] = {}
+        self.ranges: Dict[str, List[Any]] = {}
+        self.samples: Dict[str, np.ndarray] = {}
+        self.seen: Dict[str, int] = {}
+        self.values: Dict[str, Optional[Counter]] = {}
+        self.group_columns: List[str] = []
+        self.groups: Dict[str, Dict[Any, Dict[str, Any]]] = {}
+        self.raw_rows_tokens = raw_rows_tokens
+        self.raw_lines: List[str] = []
+        self.raw_row_count = 0
+        self.first_chunk: Optional[pd.DataFrame] = None
+        self.keep_first_chunk = keep_first_chunk
+        self._rng = np.random.default_rng(seed)
+
+    def _start(self, chunk: pd.DataFrame) -> None:
+        self.columns = [str(col) for col in chunk.columns]
+        for col in chunk.columns:
+            series = chunk[col]
+            if pd.api.types.is_bool_dtype(series):
+                kind = "categorical"
+            elif pd.api.types.is_numeric_dtype(series):
+                kind = "numeric"
+            elif pd.api.types.is_datetime64_any_dtype(series):
+                kind = "date"
+            else:
+                kind = "categorical"
+            self.kinds[str(col)] = kind
+            self.counts[str(col)] = 0
+            if kind == "numeric":
+                self.moments[str(col)] = (0, 0.0, 0.0)
+                self.samples[str(col)] = np.empty(0)
+                self.seen[str(col)] = 0
+            else:
+                self.values[str(col)] = Counter()
+        for patterns in TABULAR_GROUP_PATTERNS.values():
+            candidates = [col for col in self.columns if col not in self.group_columns and 1 < chunk[col].nunique() <= TABULAR_MAX_GROUPS]
+            for pattern in patterns:
+                match = next((col for col in candidates if re.search(pattern, col, re.IGNORECASE)), None)
+                if match is not None:
+                    self.group_columns.append(match)
+                    self.groups[match] = {}
+                    break
+        if self.raw_rows_tokens > 0:
+            self.raw_lines.append(chunk.iloc[:0].to_csv(index=False))
+            self.raw_rows_tokens -= count_tokens(self.raw_lines[0])
+
+    def _sample(self, col: str, values: np.ndarray) -> None:
+        # Reservoir sampling (Algorithm R), vectorized per chunk
+        sample = self.samples[col]
+        space = TABULAR_MEDIAN_SAMPLE_SIZE - len(sample)
+        if space > 0:
+            sample = np.concatenate([sample, values[:space]])
+            self.seen[col] += min(space, len(values))
+            values = values[space:]
+        if len(values):
+            positions = self._rng.integers(0, self.seen[col] + np.arange(1, len(values) + 1))
+            keep = positions < TABULAR_MEDIAN_SAMPLE_SIZE
+            sample[positions[keep]] = values[keep]
+            self.seen[col] += len(values)
+        self.samples[col] = sample
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        """
+        Adds a chunk of rows (with the same columns as the first chunk) to the profile.
+        """
+        original = chunk
+        # A copy, since numeric columns are coerced in place below
+        chunk = chunk.dropna(how="all").copy()
+        if chunk.empty:
+            return
+        chunk.columns = [str(col) for col in chunk.columns]
+        if not self.columns:
+            self._start(chunk)
+        if self.keep_first_chunk and self.first_chunk is None:
+            # Small sheets are sent as uploaded, before blank rows are dropped and numbers coerced below
+            self.first_chunk = original
+        self.rows += len(chunk)
+        for col in self.columns:
+            kind = self.kinds[col]
+            if kind == "numeric":
+                chunk[col] = pd.to_numeric(chunk[col], errors="coerce")
+                values = chunk[col].dropna().to_numpy(dtype=float)
+                self.counts[col] += len(values)
+                if len(values):
+                    mean = float(values.mean())
+                    self.moments[col] = combine_moments(self.moments[col], (len(values), mean, float(((values - mean) ** 2).sum())))
+                    low, high = float(values.min()), float(values.max())
+                    current = self.ranges.get(col)
+                    self.ranges[col] = [min(low, current[0]), max(high, current[1])] if current else [low, high]
+                    self._sample(col, values)
+            elif kind == "date":
+                values = pd.to_datetime(chunk[col], errors="coerce").dropna()
+                self.counts[col] += len(values)
+                if len(values):
+                    current = self.ranges.get(col)
+                    self.ranges[col] = [min(values.min(), current[0]), max(values.max(), current[1])] if current else [values.min(), values.max()]
+            else:
+                counts = chunk[col].value_counts(dropna=True)
+                self.counts[col] += int(counts.sum())
+                if self.values[col] is not None:
+                    self.values[col].update({str(value): int(count) for value, count in counts.items()})
+                    if len(self.values[col]) > TABULAR_MAX_TRACKED_VALUES:
+                        self.values[col] = None
+        self._update_groups(chunk)
+        if self.raw_rows_tokens > 0:
+            self._keep_raw_rows(chunk)
+
+    def _breakdown_columns(self, group_col: str) -> Tuple[List[str], List[str]]:
+        numeric = [col for col in self.columns if self.kinds[col] == "numeric" and col not in self.group_columns]
+        categorical = [col for col in self.columns if self.kinds[col] == "categorical" and col not in self.group_columns and self.values[col] is not None]
+        return numeric[:TABULAR_MAX_BREAKDOWN_COLUMNS], categorical[:TABULAR_MAX_BREAKDOWN_COLUMNS]
+
+    def _update_groups(self, chunk: pd.DataFrame) -> None:
+        for group_col in self.group_columns:
+            groups = self.groups.get(group_col)
+            if groups is None:
+                continue
+            numeric, categorical = self._breakdown_columns(group_col)
+            grouped = chunk.groupby(chunk[group_col].astype(str).where(chunk[group_col].notna()), sort=False)
+            sizes = grouped.size()
+            counts = grouped[numeric].count() if numeric else None
+            means = grouped[numeric].mean() if numeric else None
+            m2 = grouped[numeric].var(ddof=0) * counts if numeric else None
+            for group_value, size in sizes.items():
+                group = groups.setdefault(group_value, {"rows": 0, "moments": {}, "values": {}})
+                group["rows"] += int(size)
+                for col in numeric:
+                    n = int(counts.at[group_value, col])
+                    if n:
+                        group["moments"][col] = combine_moments(group["moments"].get(col, (0, 0.0, 0.0)), (n, float(means.at[group_value, col]), float(np.nan_to_num(m2.at[group_value, col]))))
+            for col in categorical:
+                for (group_value, value), count in grouped[col].value_counts().items():
+                    groups[group_value]["values"].setdefault(col, Counter())[str(value)] += int(count)
+            if len(groups) > TABULAR_MAX_GROUPS:
+                # Too many distinct values to be an arm or visit column
+                self.groups[group_col] = None
+
+    def _keep_raw_rows(self, chunk: pd.DataFrame) -> None:
+        for line in chunk.to_csv(index=False, header=False).splitlines(keepends=True):
+            tokens = count_tokens(line)
+            if tokens > self.raw_rows_tokens:
+                self.raw_rows_tokens = 0
+                return
+            self.raw_lines.append(line)
+            self.raw_rows_tokens -= tokens
+            self.raw_row_count += 1
+
+    def _describe_column(self, col: str) -> str:
+        kind = self.kinds[col]
+        n = self.counts[col]
+        missing = self.rows - n
+        counts = f"n={n:,}" + (f" ({missing:,} missing)" if missing else "")
+        if kind == "numeric":
+            if not n:
+                return f"- {col} (numeric): no values"
+            count, mean, m2 = self.moments[col]
+            sd = math.sqrt(m2 / (count - 1)) if count > 1 else 0.0
+            margin = 1.96 * sd / math.sqrt(count)
+            q1, median, q3 = np.percentile(self.samples[col], [25, 50, 75])
+            low, high = self.ranges[col]
+            return (
+                f"- {col} (numeric): {counts}; mean {format_profile_number(mean)} "
+                f"(95% CI {format_profile_number(mean - margin)} to {format_profile_number(mean + margin)}), SD {format_profile_number(sd)}; "
+                f"median {format_profile_number(median)} (IQR {format_profile_number(q1)} to {format_profile_number(q3)}); "
+                f"range {format_profile_number(low)} to {format_profile_number(high)}"
+            )
+        if kind == "date":
+            if not n:
+                return f"- {col} (date): no values"
+            low, high = self.ranges[col]
+            return f"- {col} (date): {counts}; range {low:%Y-%m-%d} to {high:%Y-%m-%d}"
+        values = self.values[col]
+        if values is None:
+            return f"- {col} (text or identifier, over {TABULAR_MAX_TRACKED_VALUES} distinct values): {counts}"
+        if len(values) == n and n > TABULAR_TOP_VALUES:
+            return f"- {col} (identifier, all {n:,} values distinct)" + (f"; {missing:,} missing" if missing else "")
+        top = ", ".join(f"{value} {count:,} ({100 * count / n:.1f}%)" for value, count in values.most_common(TABULAR_TOP_VALUES))
+        more = f", {len(values) - TABULAR_TOP_VALUES} more values" if len(values) > TABULAR_TOP_VALUES else ""
+        return f"- {col} (categorical, {len(values)} distinct): {counts}; {top}{more}"
+
+    def _describe_groups(self, group_col: str) -> List[str]:
+        groups = self.groups[group_col]
+        numeric, categorical = self._breakdown_columns(group_col)
+        # Only columns with few distinct values are broken down, which keeps the block short
+        categorical = [col for col in categorical if len(self.values[col]) <= TABULAR_TOP_VALUES]
+        lines = [f"By {group_col} ({len(groups)} groups):"]
+        for group_value in sorted(groups, key=str):
+            group = groups[group_value]
+            parts = []
+            for col in numeric:
+                count, mean, m2 = group["moments"].get(col, (0, 0.0, 0.0))
+                if count:
+                    sd = math.sqrt(m2 / (count - 1)) if count > 1 else 0.0
+                    parts.append(f"{col} mean {format_profile_number(mean)} (SD {format_profile_number(sd)}, n={count:,})")
+            for col in categorical:
+                values = group["values"].get(col)
+                if values:
+                    total = sum(values.values())
+                    parts.append(f"{col}: " + ", ".join(f"{value} {100 * count / total:.1f}%" for value, count in values.most_common()))
+            lines.append(f"- {group_value} ({group['rows']:,} rows): " + "; ".join(parts))
+        return lines
+
+    def render(self) -> str:
+        """
+        Returns the profile as the text block sent to the model.
+        """
+        title = f"Sheet: {self.name} — statistical profile" if self.name else "Statistical profile"
+        lines = [
+            f"### {title} of {self.rows:,} rows x {len(self.columns)} columns ###",
+            "Computed locally from every row. Medians and IQRs are estimated from a sample of "
+            f"{TABULAR_MEDIAN_SAMPLE_SIZE:,} values for columns with more values.",
+            "Columns:",
+        ]
+        lines.extend(self._describe_column(col) for col in self.columns)
+        for group_col in self.group_columns:
+            if self.groups[group_col]:
+                lines.extend(self._describe_groups(group_col))
+        if self.raw_row_count:
+            lines.append(f"First {self.raw_row_count:,} of {self.rows:,} rows:")
+            lines.append("".join(self.raw_lines).rstrip("\n"))
+        return "\n".join(lines)
+
+def iter_excel_sheet_chunks(file) -> Iterator[Tuple[str, Iterator[pd.DataFrame]]]:
+    """
+    Yields (sheet name, chunks of rows) for each sheet of an Excel file. XLSX workbooks are
+    streamed row by row with read-only openpyxl; XLS workbooks are read whole and then chunked.
+    """
+    if not OPENPYXL_AVAILABLE or not zipfile.is_zipfile(file):
+        file.seek(0)
+        for sheet_name, sheet_data in pd.read_excel(file, sheet_name=None).items():
+            yield str(sheet_name), (sheet_data.iloc[start:start + TABULAR_CHUNK_ROWS] for start in range(0, max(len(sheet_data), 1), TABULAR_CHUNK_ROWS))
+        return
+    from openpyxl import load_workbook
+    file.seek(0)
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            rows = (row for row in worksheet.iter_rows(values_only=True) if any(value is not None for value in row))
+            header = next(rows, None)
+            if header is None:
+                continue
+            columns = [str(value) if value is not None else f"Unnamed: {i}" for i, value in enumerate(header)]
+
+            def chunks(rows=rows, columns=columns):
+                while True:
+                    block = list(itertools.islice(rows, TABULAR_CHUNK_ROWS))
+                    if not block:
+                        return
+                    yield pd.DataFrame([row[:len(columns)] for row in block], columns=columns).infer_objects()
+
+            yield worksheet.title, chunks()
+    finally:
+        workbook.close()
+
+def profile_table_chunks(name: str, chunks: Iterator[pd.DataFrame], tabular_mode: str = "auto", raw_rows_tokens: int = 0) -> str:
+    """
+    Renders one sheet either as CSV (small sheets in "auto" mode) or as a statistical profile.
+
+    Parameters:
+    - name (str): The sheet name ("" for CSV files).
+    - chunks (Iterator[pd.DataFrame]): The sheet's rows in chunks of TABULAR_CHUNK_ROWS.
+    - tabular_mode (str): "auto" or "profile".
+    - raw_rows_tokens (int): Token budget for raw rows appended to a profile (0 = none).
+
+    Returns:
+    - str: The text block for the sheet.
+    """
+    profiler = TableProfiler(name, raw_rows_tokens=raw_rows_tokens, keep_first_chunk=tabular_mode == "auto")
+    for chunk in chunks:
+        profiler.update(chunk)
+    if tabular_mode == "auto" and profiler.rows <= TABULAR_PROFILE_MIN_ROWS:
+        data = profiler.first_chunk if profiler.first_chunk is not None else pd.DataFrame()
+        return data.to_csv(index=False)
+    return profiler.render()
+
+def extract_text_from_excel(file, tabular_mode: str = "auto", raw_rows_tokens: int = 0, summary_sheets: Sequence[str] = ()):
     """
     Extracts text from an Excel file (XLS or XLSX).
 
     Parameters:
     - file: The uploaded Excel file.
+    - tabular_mode (str): "auto" profiles sheets over TABULAR_PROFILE_MIN_ROWS rows, "profile"
+      profiles every sheet and "raw" sends every row.
+    - raw_rows_tokens (int): Token budget for raw rows appended to each profile (0 = none).
+    - summary_sheets (Sequence[str]): Sheets whose rows must not be sent, e.g. patient-level data
+      already summarized by the survival analysis; they are profiled without raw rows.
 
     Returns:
     - str: The extracted text concatenated from all sheets.
     """
-    df = pd.read_excel(file, sheet_name=None)  # Read all sheets
     text = ""
-    for sheet_name, sheet_data in df.items():
-        text += f"### Sheet: {sheet_name} ###\n\n"
-        text += sheet_data.to_csv(index=False)
-        text += "\n\n"
+    if tabular_mode == "raw":
+        df = pd.read_excel(file, sheet_name=None)  # Read all sheets
+        for sheet_name, sheet_data in df.items():
+            if str(sheet_name) in summary_sheets:
+                chunks = (sheet_data.iloc[start:start + TABULAR_CHUNK_ROWS] for start in range(0, max(len(sheet_data), 1), TABULAR_CHUNK_ROWS))
+                block = profile_table_chunks(str(sheet_name), chunks, "profile")
+                text += (block if block.startswith("### ") else f"### Sheet: {sheet_name} ###\n\n{block}") + "\n\n"
+                continue
+            text += f"### Sheet: {sheet_name} ###\n\n"
+            text += sheet_data.to_csv(index=False)
+            text += "\n\n"
+        return text
+    for sheet_name, chunks in iter_excel_sheet_chunks(file):
+        if sheet_name in summary_sheets:
+            block = profile_table_chunks(sheet_name, chunks, "profile")
+        else:
+            block = profile_table_chunks(sheet_name, chunks, tabular_mode, raw_rows_tokens)
+        if not block.startswith("### "):
+            block = f"### Sheet: {sheet_name} ###\n\n{block}"
+        text += block + "\n\n"
     return text
 
-def extract_text_from_csv(file):
+def extract_text_from_csv(file, tabular_mode: str = "auto", raw_rows_tokens: int = 0, summary_sheets: Sequence[str] = ()):
     """
     Extracts text from a CSV file.
 
     Parameters:
     - file: The uploaded CSV file.
+    - tabular_mode (str): "auto" profiles files over TABULAR_PROFILE_MIN_ROWS rows, "profile"
+      always profiles and "raw" sends every row.
+    - raw_rows_tokens (int): Token budget for raw rows appended to the profile (0 = none).
+    - summary_sheets (Sequence[str]): Containing "" (the CSV's only sheet) profiles the file without raw rows.
 
     Returns:
     - str: The extracted text from the CSV.
     """
-    df = pd.read_csv(file)
-    text = df.to_csv(index=False)
-    return text
+    if "" in summary_sheets:
+        tabular_mode, raw_rows_tokens = "profile", 0
+    if tabular_mode == "raw":
+        df = pd.read_csv(file)
+        return df.to_csv(index=False)
+    return profile_table_chunks("", pd.read_csv(file, chunksize=TABULAR_CHUNK_ROWS), tabular_mode, raw_rows_tokens)
+
+# Column-name patterns used to pre-select the survival columns of patient-level uploads (ADaM ADTTE or
+# similar): exact names are preferred over names that merely contain the pattern
+SURVIVAL_COLUMN_PATTERNS = {
+    "duration": (r'^(aval|time|duration|t|os|pfs|dfs|efs|months?|days|weeks|years)$', r'time|duration|month|day|follow'),
+    "event": (r'^(event|status|dead|death|died|observed|e)$', r'event|status|death'),
+    "censor": (r'^(cnsr|censor|censored)$', r'cens'),
+    "arm": TABULAR_GROUP_PATTERNS["arm"],
+}
+SURVIVAL_MIME_TYPES = {
+    "application/vnd.ms-excel",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "text/csv",
+}
+SURVIVAL_LANDMARK_COUNT = 4
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def _cached_tabular_sheets(content_hash: str, file_type: str, _data: bytes) -> Dict[str, pd.DataFrame]:
+    if file_type == "text/csv":
+        return {"": pd.read_csv(BytesIO(_data))}
+    return pd.read_excel(BytesIO(_data), sheet_name=None)
+
+def load_tabular_sheets(uploaded_file) -> Dict[str, pd.DataFrame]:
+    """
+    Reads a CSV or Excel upload into DataFrames by sheet name ("" for CSV), once per file content hash.
+    """
+    data = uploaded_file.getvalue()
+    return _cached_tabular_sheets(hashlib.sha256(data).hexdigest(), uploaded_file.type, data)
+
+def detect_survival_columns(df: pd.DataFrame) -> Dict[str, Any]:
+    """
+    Guesses which columns hold the time to event, the event indicator and the treatment arm.
+
+    Returns:
+    - Dict[str, Any]: "duration", "event" and "arm" column names (None when not found) and
+      "event_is_censor", True when the event column is a censoring flag such as ADaM CNSR.
+    """
+    numeric_columns = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    binary_columns = [col for col in numeric_columns if set(df[col].dropna().unique()) <= {0, 1}]
+
+    def first_match(pattern_name: str, candidates: List[Any]) -> Optional[Any]:
+        for pattern in SURVIVAL_COLUMN_PATTERNS[pattern_name]:
+            match = next((col for col in candidates if re.search(pattern, str(col), re.IGNORECASE)), None)
+            if match is not None:
+                return match
+        return None
+
+    event = first_match("event", binary_columns)
+    censor = None if event else first_match("censor", binary_columns)
+    duration = first_match("duration", [col for col in numeric_columns if col not in binary_columns])
+    arm = first_match("arm", [col for col in df.columns if 1 < df[col].nunique() <= 10])
+    return {"duration": duration, "event": event or censor, "arm": arm, "event_is_censor": censor is not None}
+
+def prepare_survival_data(df: pd.DataFrame, duration: str, event: str, arm: Optional[str] = None, event_is_censor: bool = False) -> pd.DataFrame:
+    """
+    Normalizes the mapped columns to (duration, event, arm) with event = 1 for an observed event,
+    dropping rows without a usable time or status.
+
+    Raises:
+    - ValueError: If no rows remain.
+    """
+    data = pd.DataFrame({
+        "duration": pd.to_numeric(df[duration], errors="coerce"),
+        "event": pd.to_numeric(df[event], errors="coerce"),
+        "arm": df[arm].astype(str) if arm else "All patients",
+    }).dropna(subset=["duration", "event"])
+    data = data[data["duration"] >= 0]
+    if event_is_censor:
+        data["event"] = 1 - data["event"]
+    data["event"] = (data["event"] > 0).astype(int)
+    if data.empty:
+        raise ValueError(f"No rows have a numeric '{duration}' and '{event}'.")
+    return data
+
+def survival_landmarks(max_time: float, count: int = SURVIVAL_LANDMARK_COUNT) -> List[float]:
+    # Round landmark times (e.g. 6, 12, 18, 24) within the follow-up, matching the chart's x ticks
+    from matplotlib.ticker import MaxNLocator
+    ticks = MaxNLocator(nbins=count + 1, steps=[1, 2, 3, 6, 10]).tick_values(0, max_time)
+    return [float(t) for t in ticks if 0 < t < max_time][:count]
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _cached_survival_analysis(dataset_key: str, duration: str, event: str, arm: Optional[str], event_is_censor: bool, _df: pd.DataFrame) -> Dict[str, Any]:
+    from lifelines import KaplanMeierFitter
+    from lifelines.statistics import multivariate_logrank_test
+    from lifelines.utils import median_survival_times
+    data = prepare_survival_data(_df, duration, event, arm, event_is_censor)
+    landmarks = survival_landmarks(data["duration"].max())
+    groups = {}
+    for group_name, group in data.groupby("arm", sort=True):
+        kmf = KaplanMeierFitter()
+        kmf.fit(group["duration"], event_observed=group["event"], label=str(group_name))
+        median_ci = median_survival_times(kmf.confidence_interval_)
+        durations = group["duration"].to_numpy()
+        groups[str(group_name)] = {
+            "fitter": kmf,
+            "patients": len(group),
+            "events": int(group["event"].sum()),
+            "median": float(kmf.median_survival_time_),
+            "median_ci": (float(median_ci.iloc[0, 0]), float(median_ci.iloc[0, 1])),
+            "survival_at": {t: float(kmf.predict(t)) for t in landmarks},
+            "at_risk": {t: int((durations >= t).sum()) for t in [0.0] + landmarks},
+        }
+    analysis = {"patients": len(data), "landmarks": landmarks, "groups": groups, "logrank": None}
+    if len(groups) > 1:
+        test = multivariate_logrank_test(data["duration"], data["arm"], data["event"])
+        analysis["logrank"] = {"statistic": float(test.test_statistic), "p_value": float(test.p_value)}
+    return analysis
+
+def get_survival_analysis(dataset_key: str, df: pd.DataFrame, duration: str, event: str, arm: Optional[str] = None, event_is_censor: bool = False) -> Dict[str, Any]:
+    """
+    Fits Kaplan-Meier curves per arm directly on patient-level data, once per dataset and column mapping.
+
+    Parameters:
+    - dataset_key (str): Hash identifying the dataset (file content hash and sheet).
+    - df (pd.DataFrame): Patient-level data, one row per patient.
+    - duration, event, arm (str): Mapped column names; arm is optional.
+    - event_is_censor (bool): Whether the event column is a censoring flag (1 = censored).
+
+    Returns:
+    - Dict[str, Any]: Per-arm fitted models, patient and event counts, median survival with 95% CI,
+      survival and number at risk at landmark times, and the log-rank test across arms.
+    """
+    return _cached_survival_analysis(dataset_key, duration, event, arm, event_is_censor, df)
+
+def format_survival_value(value: float) -> str:
+    return "NR" if not math.isfinite(value) else f"{value:.1f}"
+
+def format_survival_summary(name: str, analysis: Dict[str, Any], duration: str) -> str:
+    """
+    Formats the computed survival statistics as the compact block sent to the model in place of
+    the patient-level rows.
+    """
+    landmarks = analysis["landmarks"]
+    lines = [
+        f"### Kaplan-Meier analysis of {name} ###",
+        f"Computed from {analysis['patients']} patient records; time unit as in column '{duration}'. NR = not reached.",
+        "",
+        "| Arm | N | Events | Median (95% CI) | " + " | ".join(f"S({t:g})" for t in landmarks) + " |",
+        "|---|---|---|---|" + "---|" * len(landmarks),
+    ]
+    for group_name, group in analysis["groups"].items():
+        lower, upper = group["median_ci"]
+        survival = " | ".join(f"{group['survival_at'][t]:.1%}" for t in landmarks)
+        lines.append(
+            f"| {group_name} | {group['patients']} | {group['events']} | "
+            f"{format_survival_value(group['median'])} ({format_survival_value(lower)}-{format_survival_value(upper)}) | {survival} |"
+        )
+    lines.append("")
+    lines.append("Number at risk at " + ", ".join(f"{t:g}" for t in [0.0] + landmarks) + ": " + "; ".join(
+        f"{group_name} " + ", ".join(str(count) for count in group["at_risk"].values())
+        for group_name, group in analysis["groups"].items()
+    ))
+    if analysis["logrank"]:
+        p_value = analysis['logrank']['p_value']
+        lines.append(f"Log-rank test: chi-square {analysis['logrank']['statistic']:.2f}, " + ("p < 0.0001" if p_value < 0.0001 else f"p = {p_value:.4f}"))
+    lines.append("The Kaplan-Meier curves for these data are added to the document automatically; do not include a Kaplan-Meier chart for them in the Visualizations section.")
+    return "\n".join(lines)
+
+def survival_chart_spec(name: str, df: pd.DataFrame, duration: str, event: str, arm: Optional[str] = None, event_is_censor: bool = False) -> Dict[str, Any]:
+    """
+    Builds a Kaplan-Meier chart spec from the patient-level rows, rendered locally alongside the
+    charts from the Visualizations section and never sent to the model.
+    """
+    data = prepare_survival_data(df, duration, event, arm, event_is_censor)
+    return {
+        "type": "Kaplan-Meier Curve",
+        "title": f"Kaplan-Meier estimate: {name}",
+        "x_label": duration,
+        "y_label": "Survival probability",
+        "data_series": ["duration", "event", "arm"],
+        "data": data.to_dict(orient="records"),
+        "at_risk_counts": True,
+    }
+
+# Maximum number of worker processes used to extract uploaded files in parallel
+EXTRACTION_MAX_WORKERS = PROCESS_POOL_MAX_WORKERS
+
+EXTRACTORS = {
+    "application/pdf": extract_text_from_pdf,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": extract_text_from_docx,
+    "text/plain": extract_text_from_txt,
+    "application/vnd.ms-excel": extract_text_from_excel,
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": extract_text_from_excel,
+    "text/csv": extract_text_from_csv,
+}
+
+# Extraction options understood by each extractor
+EXTRACTOR_OPTIONS = {
+    "application/pdf": ("page_ranges", "max_chars", "max_tokens", "extract_tables"),
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ("extract_tables",),
+    "application/vnd.ms-excel": ("tabular_mode", "raw_rows_tokens", "summary_sheets"),
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ("tabular_mode", "raw_rows_tokens", "summary_sheets"),
+    "text/csv": ("tabular_mode", "raw_rows_tokens", "summary_sheets"),
+}
 
-def combine_uploaded_files(files) -> str:
+def extractor_options(file_type: str, options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Returns the subset of options that applies to the extractor for file_type.
+    """
+    options = options or {}
+    return {name: options[name] for name in EXTRACTOR_OPTIONS.get(file_type, ()) if options.get(name) is not None}
+
+def extract_text_from_bytes(file_type: str, data: bytes, options: Optional[Dict[str, Any]] = None) -> Tuple[str, float]:
+    """
+    Extracts text from the raw bytes of an uploaded file.
+
+    Parameters:
+    - file_type (str): The MIME type reported by the uploader.
+    - data (bytes): The file content.
+    - options (Optional[Dict[str, Any]]): Extraction options, e.g. 'page_ranges' or 'max_tokens'.
+
+    Returns:
+    - Tuple[str, float]: The extracted text and the extraction time in seconds.
+    """
+    start_time = time.perf_counter()
+    text = EXTRACTORS[file_type](BytesIO(data), **extractor_options(file_type, options))
+    return text, time.perf_counter() - start_time
+
+def extract_files(jobs: List[Tuple[str, bytes]], max_workers: int = EXTRACTION_MAX_WORKERS, options: Optional[Dict[str, Any]] = None,
+                  job_options: Optional[List[Optional[Dict[str, Any]]]] = None) -> List[Tuple[str, float]]:
+    """
+    Extracts several files, in the shared worker pool when more than one file and worker are
+    available. PDF parsing is CPU-bound and holds the GIL, so threads would not help here.
+
+    Parameters:
+    - jobs (List[Tuple[str, bytes]]): (MIME type, file content) pairs.
+    - max_workers (int): Upper bound on worker processes.
+    - options (Optional[Dict[str, Any]]): Extraction options passed to every extractor.
+    - job_options (Optional[List[Optional[Dict[str, Any]]]]): Per-job options merged over options.
+
+    Returns:
+    - List[Tuple[str, float]]: (text, seconds) per job, in the order of jobs.
+    """
+    merged_options = [{**(options or {}), **(extra or {})} for extra in (job_options or [None] * len(jobs))]
+    if max_workers > 1 and len(jobs) > 1:
+        import process_workers
+        file_types, contents = zip(*jobs)
+        results = run_in_process_pool(process_workers.extract_text_from_bytes, file_types, contents, merged_options, max_workers=max_workers)
+        if results is not None:
+            return results
+    return [extract_text_from_bytes(file_type, data, job) for (file_type, data), job in zip(jobs, merged_options)]
+
+# Extracted-text cache: an in-memory LRU tier plus an optional disk tier (disable with PUBLICATION_EXTRACTION_DISK_CACHE=0)
+EXTRACTION_MEMORY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+EXTRACTION_DISK_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+EXTRACTION_DISK_CACHE_ENABLED = os.environ.get("PUBLICATION_EXTRACTION_DISK_CACHE", "1") != "0"
+# Bump when the extractors' output changes, so text cached by older extractors is not reused
+EXTRACTOR_VERSION = "3"
+
+class ExtractionCache:
+    """
+    Two-tier cache of extracted source text keyed by file content hash and file type.
+
+    The memory tier is a size-bounded LRU. The optional disk tier stores one UTF-8 file per
+    entry and evicts the least recently used files once it exceeds max_disk_bytes.
+    """
+
+    def __init__(self, max_memory_bytes: int = EXTRACTION_MEMORY_CACHE_MAX_BYTES, disk_dir: Optional[str] = None, max_disk_bytes: int = EXTRACTION_DISK_CACHE_MAX_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.txt")
+
+    def _remember(self, key: str, text: str) -> None:
+        size = len(text)
+        if size > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = text
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    text = f.read()
+                os.utime(path)
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, text)
+                return text
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Error reading extraction cache entry {path}: {str(e)}")
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, text: str) -> None:
+        with self._lock:
+            self._remember(key, text)
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                tmp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(tmp_path, self._disk_path(key))
+                self._evict_disk()
+            except OSError as e:
+                logging.error(f"Error writing extraction cache entry: {str(e)}")
+
+    def _evict_disk(self) -> None:
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".txt"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+            }
+
+@st.cache_resource
+def get_extraction_cache() -> ExtractionCache:
+    # Held by st.cache_resource so the cache survives Streamlit reruns of this script
+    return ExtractionCache(disk_dir=os.path.join(CACHE_DIR, "extracted") if EXTRACTION_DISK_CACHE_ENABLED else None)
+
+def extraction_cache_key(file_type: str, data: bytes, options: Optional[Dict[str, Any]] = None) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    key_material = json.dumps([EXTRACTOR_VERSION, file_type, digest, options or {}], sort_keys=True)
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+def combine_uploaded_files(files, max_workers: int = EXTRACTION_MAX_WORKERS, options: Optional[Dict[str, Any]] = None,
+                           file_options: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
     """
     Combines text extracted from multiple uploaded files.
 
+    Files are extracted in parallel worker processes and reassembled in upload order.
+
     Parameters:
     - files: List of uploaded files.
+    - max_workers (int): Upper bound on extraction worker processes.
+    - options (Optional[Dict[str, Any]]): Extraction options, e.g. PDF 'page_ranges' and 'max_tokens'.
+    - file_options (Optional[Dict[str, Dict[str, Any]]]): Extra options by uploaded file_id, e.g. 'summary_sheets'.
 
     Returns:
     - str: Combined text from all files.
     """
-    combined_text = ""
+    supported_files = []
     for uploaded_file in files:
-        st.write(f"Processing file: {uploaded_file.name}")
-        if uploaded_file.type == "application/pdf":
-            text = extract_text_from_pdf(uploaded_file)
-        elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            text = extract_text_from_docx(uploaded_file)
-        elif uploaded_file.type == "text/plain":
-            text = extract_text_from_txt(uploaded_file)
-        elif uploaded_file.type in ["application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-            text = extract_text_from_excel(uploaded_file)
-        elif uploaded_file.type == "text/csv":
-            text = extract_text_from_csv(uploaded_file)
+        if uploaded_file.type in EXTRACTORS:
+            supported_files.append(uploaded_file)
         else:
             st.warning(f"Unsupported file type: {uploaded_file.type}")
-            continue
-        combined_text += f"\n\n### {uploaded_file.name} ###\n\n{text}"
-    return combined_text
+
+    cache = get_extraction_cache()
+    contents = [uploaded_file.getvalue() for uploaded_file in supported_files]
+    per_file = [{**(options or {}), **(file_options or {}).get(getattr(uploaded_file, "file_id", None), {})} for uploaded_file in supported_files]
+    keys = [extraction_cache_key(uploaded_file.type, data, extractor_options(uploaded_file.type, per_file[i])) for i, (uploaded_file, data) in enumerate(zip(supported_files, contents))]
+    texts = [cache.get(key) for key in keys]
+
+    # Only files not found in the cache are extracted
+    missing = [i for i, text in enumerate(texts) if text is None]
+    results = extract_files([(supported_files[i].type, contents[i]) for i in missing], max_workers, job_options=[per_file[i] for i in missing])
+    seconds = {}
+    for i, (text, elapsed) in zip(missing, results):
+        cache.set(keys[i], text)
+        texts[i] = text
+        seconds[i] = elapsed
+
+    parts = []
+    for i, uploaded_file in enumerate(supported_files):
+        status = f"{seconds[i]:.2f}s" if i in seconds else "cached"
+        st.write(f"Processed file: {uploaded_file.name} ({status})")
+        parts.append(f"\n\n### {uploaded_file.name} ###\n\n{texts[i]}")
+    return "".join(parts)
 
 import re
 from textwrap import wrap
 
-def generate_word_document(content: str, charts: List[Dict[str, Any]], output_format: str = "word") -> BytesIO:
+# Document IR: generated Markdown is parsed once into a list of blocks that the Word and PDF writers
+# both consume. Blocks are dicts with a "type" of "heading" (level, runs), "paragraph" (runs),
+# "list" (ordered, items of {"runs", "children"}) or "table" (header and rows of cell runs), and
+# runs are (text, bold, italic, code) tuples.
+MARKDOWN_HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+MARKDOWN_LIST_ITEM_PATTERN = re.compile(r'^(\s*)([-*+]|\d+[.)])\s+(.*)$')
+MARKDOWN_TABLE_SEPARATOR_PATTERN = re.compile(r'^\s*\|?\s*:?-+:?\s*(?:\|\s*:?-+:?\s*)*\|?\s*$')
+MARKDOWN_RULE_PATTERN = re.compile(r'^\s*(?:(?:-\s*){3,}|(?:\*\s*){3,}|(?:_\s*){3,})$')
+MARKDOWN_INLINE_PATTERN = re.compile(
+    r'\\([\\`*_{}\[\]()#+\-.!|])'            # escaped character
+    r'|`([^`]+)`'                              # code
+    r'|(\*\*\*|___)(?=\S)(.+?)(?<=\S)\3'       # bold italic
+    r'|(\*\*|__)(?=\S)(.+?)(?<=\S)\5'          # bold
+    r'|\*(?=\S)(.+?)(?<=\S)\*'                 # italic
+    r'|(?<!\w)_(?=\S)(.+?)(?<=\S)_(?!\w)'      # italic, not inside snake_case words
+    r'|\[([^\]]+)\]\([^)]*\)'                  # link, kept as its text
+)
+VISUALIZATIONS_SECTION_PATTERN = re.compile(r'##\s+Visualizations\s*[\s\S]*', re.IGNORECASE)
+
+def parse_inline_markdown(text: str, bold: bool = False, italic: bool = False) -> List[Tuple[str, bool, bool, bool]]:
+    """
+    Splits inline Markdown into (text, bold, italic, code) runs.
+    """
+    runs = []
+    position = 0
+    for match in MARKDOWN_INLINE_PATTERN.finditer(text):
+        if match.start() > position:
+            runs.append((text[position:match.start()], bold, italic, False))
+        escaped, code, _, bold_italic, _, strong, emphasis, underscore_emphasis, link = match.groups()
+        if escaped is not None:
+            runs.append((escaped, bold, italic, False))
+        elif code is not None:
+            runs.append((code, bold, italic, True))
+        elif bold_italic is not None:
+            runs.extend(parse_inline_markdown(bold_italic, True, True))
+        elif strong is not None:
+            runs.extend(parse_inline_markdown(strong, True, italic))
+        elif emphasis is not None or underscore_emphasis is not None:
+            runs.extend(parse_inline_markdown(emphasis if emphasis is not None else underscore_emphasis, bold, True))
+        else:
+            runs.extend(parse_inline_markdown(link, bold, italic))
+        position = match.end()
+    if position < len(text):
+        runs.append((text[position:], bold, italic, False))
+    return runs
+
+def split_table_row(line: str) -> List[str]:
+    cells = re.split(r'(?<!\\)\|', line.strip())
+    if cells and not cells[0].strip():
+        cells = cells[1:]
+    if cells and not cells[-1].strip():
+        cells = cells[:-1]
+    return [cell.strip() for cell in cells]
+
+def parse_markdown_blocks(content: str) -> List[Dict[str, Any]]:
+    """
+    Parses Markdown into document blocks in a single pass over its lines.
+
+    Supports ATX headings, paragraphs, nested bullet and numbered lists, pipe tables and inline
+    bold, italic, code and links. Horizontal rules are dropped.
+
+    Parameters:
+    - content (str): The Markdown text.
+
+    Returns:
+    - List[Dict[str, Any]]: The blocks in document order.
+    """
+    blocks = []
+    paragraph = []
+    # Open lists as (indent, list block), outermost first
+    list_stack = []
+    lines = content.splitlines()
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append({"type": "paragraph", "runs": parse_inline_markdown(" ".join(paragraph))})
+            paragraph.clear()
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        i += 1
+        if not stripped:
+            flush_paragraph()
+            continue
+        list_match = MARKDOWN_LIST_ITEM_PATTERN.match(line)
+        if MARKDOWN_RULE_PATTERN.match(line):
+            flush_paragraph()
+            list_stack.clear()
+            continue
+        if list_match:
+            flush_paragraph()
+            indent = len(list_match.group(1).expandtabs(4))
+            ordered = list_match.group(2)[0].isdigit()
+            while list_stack and indent < list_stack[-1][0]:
+                list_stack.pop()
+            if list_stack and indent > list_stack[-1][0] and list_stack[-1][1]["items"]:
+                # Deeper than the open list: a nested list under its last item
+                block = {"type": "list", "ordered": ordered, "items": []}
+                list_stack[-1][1]["items"][-1]["children"].append(block)
+                list_stack.append((indent, block))
+            elif not list_stack or list_stack[-1][1]["ordered"] != ordered:
+                block = {"type": "list", "ordered": ordered, "items": []}
+                if list_stack:
+                    list_stack.pop()
+                    if list_stack:
+                        list_stack[-1][1]["items"][-1]["children"].append(block)
+                    else:
+                        blocks.append(block)
+                else:
+                    blocks.append(block)
+                list_stack.append((indent, block))
+            list_stack[-1][1]["items"].append({"runs": parse_inline_markdown(list_match.group(3).strip()), "children": []})
+            continue
+        if list_stack and line[:1].isspace() and not stripped.startswith("|"):
+            # Indented continuation of the last list item
+            item = list_stack[-1][1]["items"][-1]
+            item["runs"].extend(parse_inline_markdown(" " + stripped))
+            continue
+        list_stack.clear()
+        heading_match = MARKDOWN_HEADING_PATTERN.match(stripped)
+        if heading_match:
+            flush_paragraph()
+            blocks.append({"type": "heading", "level": len(heading_match.group(1)), "runs": parse_inline_markdown(heading_match.group(2))})
+            continue
+        # A pipe table needs a separator row with one cell per header cell
+        if ("|" in stripped and i < len(lines) and MARKDOWN_TABLE_SEPARATOR_PATTERN.match(lines[i]) and "-" in lines[i]
+                and len(split_table_row(lines[i])) == len(split_table_row(stripped))):
+            flush_paragraph()
+            header = split_table_row(stripped)
+            i += 1
+            rows = []
+            while i < len(lines) and "|" in lines[i] and lines[i].strip():
+                cells = split_table_row(lines[i])
+                rows.append(cells[:len(header)] + [""] * (len(header) - len(cells)))
+                i += 1
+            blocks.append({
+                "type": "table",
+                "header": [parse_inline_markdown(cell) for cell in header],
+                "rows": [[parse_inline_markdown(cell) for cell in row] for row in rows],
+            })
+            continue
+        paragraph.append(stripped)
+    flush_paragraph()
+    return blocks
+
+def write_docx_runs(paragraph, runs: List[Tuple[str, bool, bool, bool]]) -> None:
+    for text, bold, italic, code in runs:
+        run = paragraph.add_run(text)
+        if bold:
+            run.bold = True
+        if italic:
+            run.italic = True
+        if code:
+            run.font.name = "Courier New"
+
+def write_docx_blocks(doc, blocks: List[Dict[str, Any]]) -> None:
+    """
+    Appends document blocks to a python-docx Document.
+    """
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+    # Style ids are resolved once: python-docx looks styles up by name with a linear scan per paragraph
+    style_ids = {}
+
+    def add_paragraph(style_name):
+        if style_name not in style_ids:
+            style_ids[style_name] = doc.styles[style_name].style_id
+        paragraph = doc.add_paragraph()
+        paragraph._p.style = style_ids[style_name]
+        return paragraph
+
+    def write_list(block, depth):
+        # The default template has list styles for three nesting levels
+        style = ("List Number" if block["ordered"] else "List Bullet") + (f" {min(depth, 2) + 1}" if depth else "")
+        for item in block["items"]:
+            write_docx_runs(add_paragraph(style), item["runs"])
+            for child in item["children"]:
+                write_list(child, depth + 1)
+
+    for block in blocks:
+        if block["type"] == "heading":
+            write_docx_runs(add_paragraph(f"Heading {block['level']}"), block["runs"])
+        elif block["type"] == "paragraph":
+            write_docx_runs(doc.add_paragraph(), block["runs"])
+        elif block["type"] == "list":
+            write_list(block, 0)
+        elif block["type"] == "table":
+            table = doc.add_table(rows=len(block["rows"]) + 1, cols=len(block["header"]))
+            table.style = 'Table Grid'
+            for row_index, (row, cells) in enumerate(zip(table.rows, [block["header"]] + block["rows"])):
+                for column_index, (cell, runs) in enumerate(zip(row.cells, cells)):
+                    write_docx_runs(cell.paragraphs[0], [(text, bold or row_index == 0, italic, code) for text, bold, italic, code in runs])
+                    if column_index == 0:
+                        cell._element.get_or_add_tcPr().append(parse_xml(r'<w:shd {} w:fill="D9EAD3"/>'.format(nsdecls('w'))))
+
+def pdf_markup(runs: List[Tuple[str, bool, bool, bool]]) -> str:
+    """
+    Converts runs to ReportLab paragraph markup, escaping the text.
+    """
+    parts = []
+    for text, bold, italic, code in runs:
+        text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        if code:
+            text = f'<font face="Courier">{text}</font>'
+        if italic:
+            text = f"<i>{text}</i>"
+        if bold:
+            text = f"<b>{text}</b>"
+        parts.append(text)
+    return "".join(parts)
+
+def build_pdf_flowables(blocks: List[Dict[str, Any]], styles, width: float) -> List[Any]:
+    """
+    Converts document blocks to ReportLab flowables.
+
+    Parameters:
+    - blocks (List[Dict[str, Any]]): The parsed document blocks.
+    - styles: The stylesheet, which must define 'Justify'.
+    - width (float): The frame width available to tables.
+
+    Returns:
+    - List[Any]: Flowables in document order.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.platypus import Paragraph, Spacer, Table, TableStyle
+    cell_style = ParagraphStyle('TableCell', parent=styles['BodyText'], fontSize=9, leading=11)
+    header_style = ParagraphStyle('TableHeader', parent=cell_style, fontName='Helvetica-Bold', textColor=colors.whitesmoke)
+    list_styles = {}
+    elements = []
+
+    def list_style(depth):
+        if depth not in list_styles:
+            list_styles[depth] = ParagraphStyle(f'ListItem{depth}', parent=styles['Justify'], leftIndent=18 * (depth + 1), bulletIndent=18 * depth + 4)
+        return list_styles[depth]
+
+    def add_list(block, depth):
+        for number, item in enumerate(block["items"], 1):
+            elements.append(Paragraph(pdf_markup(item["runs"]), list_style(depth), bulletText=f"{number}." if block["ordered"] else "•"))
+            elements.append(Spacer(1, 6))
+            for child in item["children"]:
+                add_list(child, depth + 1)
+
+    for block in blocks:
+        if block["type"] == "heading":
+            elements.append(Paragraph(pdf_markup(block["runs"]), styles[f"Heading{min(block['level'], 6)}"]))
+            elements.append(Spacer(1, 12 if block["level"] <= 2 else 6))
+        elif block["type"] == "paragraph":
+            elements.append(Paragraph(pdf_markup(block["runs"]), styles['Justify']))
+            elements.append(Spacer(1, 6))
+        elif block["type"] == "list":
+            add_list(block, 0)
+        elif block["type"] == "table":
+            # Cells are paragraphs so that long text wraps within the column
+            data = [[Paragraph(pdf_markup(runs), header_style) for runs in block["header"]]]
+            data.extend([Paragraph(pdf_markup(runs), cell_style) for runs in row] for row in block["rows"])
+            table = Table(data, colWidths=[width / len(block["header"])] * len(block["header"]), repeatRows=1)
+            table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ]))
+            elements.append(table)
+            elements.append(Spacer(1, 12))
+    return elements
+
+def generate_markdown_document(content: str, charts: List[Dict[str, Any]]) -> BytesIO:
+    """
+    Generates a self-contained Markdown document, with the charts embedded as PNG data URIs.
+    """
+    parts = [VISUALIZATIONS_SECTION_PATTERN.sub('', content).rstrip()]
+    if charts:
+        parts.append("## Visualizations")
+        ensure_chart_images(charts)
+        for chart in charts:
+            try:
+                image = base64.b64encode(get_chart_image(chart, CHART_SCREEN_DPI)).decode("ascii")
+            except Exception as e:
+                logging.warning(f"Chart '{chart.get('title', 'Untitled')}' left out of the Markdown export: {str(e)}")
+                continue
+            parts.append(f"![{chart.get('title', 'Chart')}](data:image/png;base64,{image})")
+    return BytesIO(("\n\n".join(parts) + "\n").encode("utf-8"))
+
+def generate_word_document(content: str, charts: List[Dict[str, Any]], output_format: str = "word", blocks: Optional[List[Dict[str, Any]]] = None) -> BytesIO:
     """
-    Generates a Word or PDF document from the generated content and charts.
+    Generates a Word, PDF or Markdown document from the generated content and charts.
 
     Parameters:
     - content (str): The generated document content in Markdown.
     - charts (List[Dict[str, Any]]): List of chart information dictionaries.
-    - output_format (str): 'word' or 'pdf'.
+    - output_format (str): 'word', 'pdf' or 'markdown'.
+    - blocks (Optional[List[Dict[str, Any]]]): The content already parsed by parse_markdown_blocks,
+      so that several formats can be exported from one parse.
 
     Returns:
     - BytesIO: The generated document as a BytesIO object.
     """
+    if output_format not in ("word", "pdf", "markdown"):
+        raise ValueError("Unsupported output format. Choose 'word', 'pdf' or 'markdown'.")
+    if output_format == "markdown":
+        return generate_markdown_document(content, charts)
+    # The '## Visualizations' section is replaced by the rendered charts
+    if blocks is None:
+        blocks = parse_markdown_blocks(VISUALIZATIONS_SECTION_PATTERN.sub('', content))
     if output_format == "word":
+        from docx import Document
+        from docx.shared import Inches
         doc = Document()
-        # Remove the '## Visualizations' section from content
-        content_without_visualizations = re.sub(r'##\s+Visualizations\s*[\s\S]*', '', content, flags=re.IGNORECASE)
-        # Convert Markdown to HTML
-        html_content = markdown2.markdown(content_without_visualizations)
-        # Parse HTML content and add to Word document
-        for line in html_content.split('\n'):
-            if line.startswith("<h2>"):
-                para = doc.add_heading(line.replace("<h2>", "").replace("</h2>", ""), level=2)
-            elif line.startswith("<h3>"):
-                para = doc.add_heading(line.replace("<h3>", "").replace("</h3>", ""), level=3)
-            elif line.startswith("<p>"):
-                para = doc.add_paragraph(line.replace("<p>", "").replace("</p>", ""))
-            elif line.startswith("<ul>"):
-                para = doc.add_paragraph()
-                para.style = 'List Bullet'
-                for item in re.findall(r'<li>(.*?)</li>', line):
-                    para.add_run(item)
-            elif line.startswith("<ol>"):
-                para = doc.add_paragraph()
-                para.style = 'List Number'
-                for item in re.findall(r'<li>(.*?)</li>', line):
-                    para.add_run(item)
-            elif line.startswith("<table>"):
-                table_html = line + "\n"
-                while not line.startswith("</table>"):
-                    line = next(html_content.split('\n'))
-                    table_html += line + "\n"
-                table = doc.add_table(rows=0, cols=0)
-                for row in re.findall(r'<tr>(.*?)</tr>', table_html):
-                    cells = re.findall(r'<t[dh]>(.*?)</t[dh]>', row)
-                    if len(cells) > 0:
-                        row_cells = table.add_row().cells
-                        for i, cell in enumerate(cells):
-                            row_cells[i].text = cell
-                table.style = 'Table Grid'
-                for cell in table.columns[0].cells:
-                    cell._element.get_or_add_tcPr().append(parse_xml(r'<w:shd {} w:fill="D9EAD3"/>'.format(nsdecls('w'))))
-            else:
-                para = doc.add_paragraph(line)
+        write_docx_blocks(doc, blocks)
         # Add charts
         if charts:
             doc.add_heading("Visualizations", level=2)
+            ensure_chart_images(charts)
             for chart in charts:
-                # Create chart using Matplotlib
-                fig = create_chart(chart)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmpfile:
-                    fig.savefig(tmpfile.name, format='png', bbox_inches='tight')
-                    doc.add_picture(tmpfile.name, width=Inches(6))
-                os.unlink(tmpfile.name)
+                doc.add_picture(BytesIO(get_chart_image(chart, CHART_PRINT_DPI)), width=Inches(6))
         # Save to BytesIO
         file_stream = BytesIO()
         doc.save(file_stream)
         file_stream.seek(0)
         return file_stream
-    elif output_format == "pdf":
+    else:
+        from reportlab.lib.enums import TA_JUSTIFY
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        from reportlab.lib.utils import ImageReader
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
         buffer = BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=letter,
                                 rightMargin=inch, leftMargin=inch,
@@ -1173,72 +4106,20 @@ def generate_word_document(content: str, charts: List[Dict[str, Any]], output_fo
         styles = getSampleStyleSheet()
         styles.add(ParagraphStyle(name='Justify', alignment=TA_JUSTIFY))
         
-        elements = []
-
-        # Remove the '## Visualizations' section from content
-        content_without_visualizations = re.sub(r'##\s+Visualizations\s*[\s\S]*', '', content, flags=re.IGNORECASE)
-
-        # Convert Markdown to HTML
-        html_content = markdown2.markdown(content_without_visualizations)
-
-        for line in html_content.split('\n'):
-            if line.startswith("<h2>"):
-                elements.append(Paragraph(line.replace("<h2>", "").replace("</h2>", ""), styles['Heading2']))
-                elements.append(Spacer(1, 12))
-            elif line.startswith("<h3>"):
-                elements.append(Paragraph(line.replace("<h3>", "").replace("</h3>", ""), styles['Heading3']))
-                elements.append(Spacer(1, 6))
-            elif line.startswith("<p>"):
-                elements.append(Paragraph(line.replace("<p>", "").replace("</p>", ""), styles['Justify']))
-                elements.append(Spacer(1, 6))
-            elif line.startswith("<ul>"):
-                for item in re.findall(r'<li>(.*?)</li>', line):
-                    elements.append(Paragraph(f"• {item}", styles['Justify']))
-                    elements.append(Spacer(1, 6))
-            elif line.startswith("<ol>"):
-                for i, item in enumerate(re.findall(r'<li>(.*?)</li>', line), 1):
-                    elements.append(Paragraph(f"{i}. {item}", styles['Justify']))
-                    elements.append(Spacer(1, 6))
-            elif line.startswith("<table>"):
-                table_html = line + "\n"
-                while not line.startswith("</table>"):
-                    line = next(html_content.split('\n'))
-                    table_html += line + "\n"
-                data = []
-                for row in re.findall(r'<tr>(.*?)</tr>', table_html):
-                    cells = re.findall(r'<t[dh]>(.*?)</t[dh]>', row)
-                    if len(cells) > 0:
-                        data.append(cells)
-                table = Table(data)
-                table.setStyle(TableStyle([
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                    ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ]))
-                elements.append(table)
-                elements.append(Spacer(1, 12))
-            else:
-                elements.append(Paragraph(line, styles['Justify']))
-                elements.append(Spacer(1, 6))
+        elements = build_pdf_flowables(blocks, styles, doc.width)
 
         # Add charts
         if charts:
             elements.append(Paragraph("Visualizations", styles['Heading2']))
             elements.append(Spacer(1, 12))
+            ensure_chart_images(charts)
             for chart in charts:
-                fig = create_chart(chart)
-                img_buffer = BytesIO()
-                fig.savefig(img_buffer, format='png', bbox_inches='tight', dpi=300)
-                img_buffer.seek(0)
-                img = Image(img_buffer)
+                image_data = get_chart_image(chart, CHART_PRINT_DPI)
+                img = Image(BytesIO(image_data))
                 
                 # Calculate aspect ratio and adjust image size
-                fig_width, fig_height = fig.get_size_inches()
-                aspect_ratio = fig_height / fig_width
+                image_width, image_height = ImageReader(BytesIO(image_data)).getSize()
+                aspect_ratio = image_height / image_width
                 
                 img_width = 6 * inch  # Set a maximum width
                 img_height = img_width * aspect_ratio
@@ -1262,14 +4143,121 @@ def generate_word_document(content: str, charts: List[Dict[str, Any]], output_fo
                 if 'title' in chart:
                     elements.append(Paragraph(chart['title'], styles['Heading4']))
                     elements.append(Spacer(1, 12))
-                
-                plt.close(fig)
 
         doc.build(elements)
         buffer.seek(0)
         return buffer
-    else:
-        raise ValueError("Unsupported output format. Choose 'word' or 'pdf'.")
+
+# Export formats offered for download: label -> (output_format for generate_word_document, file extension, MIME type)
+EXPORT_FORMATS = {
+    "Word Document": ("word", "docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    "PDF": ("pdf", "pdf", "application/pdf"),
+    "Markdown": ("markdown", "md", "text/markdown"),
+}
+EXPORT_ARTIFACT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+class ExportArtifactCache:
+    """
+    Size-bounded LRU of exported documents keyed by a hash of the content, the chart specs and
+    the output format, so re-downloading or switching formats does not rebuild the document.
+    """
+
+    def __init__(self, max_bytes: int = EXPORT_ARTIFACT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: str, data: bytes) -> None:
+        with self._lock:
+            if len(data) > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+@st.cache_resource
+def get_export_artifact_cache() -> ExportArtifactCache:
+    # Held by st.cache_resource so exported documents survive Streamlit reruns of this script
+    return ExportArtifactCache()
+
+def export_artifact_key(content: str, charts: List[Dict[str, Any]], output_format: str) -> str:
+    key_material = json.dumps([output_format, content, [chart_spec_key(chart) for chart in charts]])
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+def export_documents(content: str, charts: List[Dict[str, Any]], output_formats: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Exports the content to several formats at once, reusing cached artifacts.
+
+    The content is parsed once and the charts are rendered once; the formats that are not cached
+    are then built concurrently from those shared blocks and chart images.
+
+    Parameters:
+    - content (str): The generated document content in Markdown.
+    - charts (List[Dict[str, Any]]): List of chart information dictionaries.
+    - output_formats (List[str]): Formats accepted by generate_word_document ('word', 'pdf', 'markdown').
+
+    Returns:
+    - Dict[str, Dict[str, Any]]: Per format, "data" (the document bytes), "seconds" and "cached",
+      or "error" when that format could not be exported.
+    """
+    cache = get_export_artifact_cache()
+    artifacts = {}
+    pending = {}
+    for output_format in dict.fromkeys(output_formats):
+        key = export_artifact_key(content, charts, output_format)
+        data = cache.get(key)
+        if data is None:
+            pending[output_format] = key
+        else:
+            artifacts[output_format] = {"data": data, "seconds": 0.0, "cached": True}
+    if not pending:
+        return artifacts
+
+    blocks = parse_markdown_blocks(VISUALIZATIONS_SECTION_PATTERN.sub('', content))
+    if charts:
+        ensure_chart_images(charts)
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        futures = {
+            executor.submit(timed, generate_word_document, content, charts, output_format, blocks): output_format
+            for output_format in pending
+        }
+        for future in as_completed(futures):
+            output_format = futures[future]
+            try:
+                document, seconds = future.result()
+            except Exception as e:
+                logging.exception(f"Export to {output_format} failed:")
+                artifacts[output_format] = {"error": str(e)}
+                continue
+            data = document.getvalue()
+            cache.set(pending[output_format], data)
+            artifacts[output_format] = {"data": data, "seconds": seconds, "cached": False}
+    return artifacts
 
 # Add this dictionary to store the recommendations for analysis types
 ANALYSIS_SOURCE_RECOMMENDATIONS = {
@@ -1343,8 +4331,431 @@ def get_source_document_recommendations(analysis_type: str) -> List[str]:
     """
     return ANALYSIS_SOURCE_RECOMMENDATIONS.get(analysis_type, [])
 
+def timed(func: Callable[..., Any], *args, **kwargs) -> Tuple[Any, float]:
+    """
+    Calls func and returns its result together with the elapsed time in seconds.
+    """
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+# Pipeline stages whose last output is kept in session state, so that a rerun (a widget change or a
+# download click) recomputes only the stages whose inputs changed, in display order
+PIPELINE_STAGES = ["extraction", "generation", "charts", "chart images", "quality", "export"]
+
+def stage_key(*inputs: Any) -> str:
+    key_material = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+def get_stage_output(stage: str, key: str) -> Tuple[bool, Any]:
+    """
+    Looks up the output of a pipeline stage stored in this session for the given input key.
+
+    Returns:
+    - Tuple[bool, Any]: (True, output) when the stage last ran with the same inputs, else (False, None).
+    """
+    entry = st.session_state.setdefault("pipeline_stages", {}).get(stage)
+    if entry is None or entry["key"] != key:
+        return False, None
+    st.session_state.setdefault("stage_log", {}).setdefault(stage, None)
+    return True, entry["output"]
+
+def store_stage_output(stage: str, key: str, output: Any, seconds: float) -> None:
+    st.session_state.setdefault("pipeline_stages", {})[stage] = {"key": key, "output": output}
+    st.session_state.setdefault("stage_log", {})[stage] = seconds
+
+def run_stage(stage: str, key: str, compute: Callable[[], Any]) -> Any:
+    """
+    Returns the output of a pipeline stage, computing it only when its inputs changed since the
+    stage last ran in this session.
+    """
+    found, output = get_stage_output(stage, key)
+    if not found:
+        output, seconds = timed(compute)
+        store_stage_output(stage, key, output, seconds)
+    return output
+
+def display_stage_status():
+    stage_log = st.session_state.get("stage_log", {})
+    statuses = [
+        f"{stage} {'cached' if stage_log[stage] is None else f'{stage_log[stage]:.1f}s'}"
+        for stage in PIPELINE_STAGES if stage in stage_log
+    ]
+    if statuses:
+        st.caption(f"Pipeline stages this run: {' | '.join(statuses)}")
+
+def render_chart_images(charts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Renders charts to PNG images for display, reusing cached renders of unchanged chart specs.
+
+    Returns:
+    - List[Dict[str, Any]]: Per chart, {"chart", "image"} with the PNG bytes, or {"chart", "error"}.
+    """
+    valid = [validate_chart_data(chart_info) for chart_info in charts]
+    errors = ensure_chart_images([chart_info for chart_info, is_valid in zip(charts, valid) if is_valid])
+    images = []
+    for chart_info, is_valid in zip(charts, valid):
+        if not is_valid:
+            images.append({"chart": chart_info, "error": "Received invalid chart data."})
+            continue
+        error = errors.get(chart_spec_key(chart_info))
+        if error is not None:
+            images.append({"chart": chart_info, "error": error})
+        else:
+            images.append({"chart": chart_info, "image": get_chart_image(chart_info)})
+    return images
+
+def display_chart_images(chart_images: List[Dict[str, Any]]):
+    if not chart_images:
+        st.info("No charts were generated for this content.")
+        return
+    st.subheader("Visualizations:")
+    for chart_image in chart_images:
+        chart_info = chart_image["chart"]
+        if "image" in chart_image:
+            st.image(chart_image["image"])
+        else:
+            st.warning(f"Could not create chart '{chart_info.get('title', 'Untitled')}': {chart_image['error']} Please check the chart data.")
+            st.write("Chart data:")
+            st.json(chart_info)
+
+def display_quality_assessment(quality_assessment: Dict[str, Any], publication_type: str):
+    # Display user-friendly quality assessment
+    st.subheader("Content Quality Assessment:")
+    if "error" in quality_assessment:
+        st.warning(f"The quality assessment could not be completed: {quality_assessment['error']}")
+        return
+    
+    # Total word count
+    st.write(f"Total Words: {quality_assessment['total_words']}")
+    
+    # Readability score
+    fk_grade = quality_assessment['readability']['flesch_kincaid_grade']
+    if publication_type == "Plain Language Summary":
+        if 6 <= fk_grade <= 8:
+            readability = "Excellent"
+        elif 5 <= fk_grade < 6 or 8 < fk_grade <= 9:
+            readability = "Good"
+        elif 4 <= fk_grade < 5 or 9 < fk_grade <= 10:
+            readability = "Fair"
+        else:
+            readability = "Needs Improvement"
+        st.write(f"Readability: {readability} (Flesch-Kincaid Grade Level: {fk_grade:.1f})")
+        st.write("Note: For Plain Language Summaries, aim for a 6th to 8th-grade reading level.")
+    else:
+        if fk_grade < 10:
+            readability = "Excellent"
+        elif fk_grade < 12:
+            readability = "Good"
+        elif fk_grade < 14:
+            readability = "Fair"
+        else:
+            readability = "Challenging"
+        st.write(f"Readability: {readability} (Flesch-Kincaid Grade Level: {fk_grade:.1f})")
+    
+    # Section balance
+    st.write("Section Balance:")
+    total_words = sum(quality_assessment['word_counts'].values())
+    for section, count in quality_assessment['word_counts'].items():
+        percentage = (count / total_words) * 100
+        st.write(f"- {section}: {count} words ({percentage:.1f}%)")
+    
+    # Top keywords
+    st.write("Top Keywords:")
+    for word, density in list(quality_assessment['keyword_density'].items())[:5]:
+        st.write(f"- {word}: {density:.2%}")
+    
+    # Citation count
+    citation_count = quality_assessment['citation_count']
+    if citation_count == 0:
+        citation_assessment = "No citations found. Consider adding relevant citations to support your arguments."
+    elif citation_count < 5:
+        citation_assessment = "Few citations found. Consider adding more to strengthen your arguments."
+    else:
+        citation_assessment = f"Good number of citations ({citation_count})."
+    st.write(f"Citations: {citation_assessment}")
+    
+    # AI Evaluation
+    st.write("AI Evaluation:")
+    st.write(quality_assessment['ai_evaluation'])
+
+def display_document_downloads(artifacts: Dict[str, Dict[str, Any]], output_formats: List[str], publication_type: str, analysis_type: str):
+    if not output_formats:
+        st.info("Select an output format to download the document.")
+    for label in output_formats:
+        output_format, file_extension, mime_type = EXPORT_FORMATS[label]
+        artifact = artifacts.get(output_format, {"error": "Not exported."})
+        if "error" in artifact:
+            st.error(f"Error generating {label}: {artifact['error']}")
+            continue
+        st.download_button(
+            label=f"Download as {label}",
+            data=artifact["data"],
+            file_name=f"{publication_type.lower().replace(' ', '_')}_{analysis_type.lower().replace(' ', '_')}.{file_extension}",
+            mime=mime_type,
+            key=f"download_{output_format}"
+        )
+    cached = [label for label in output_formats if artifacts.get(EXPORT_FORMATS[label][0], {}).get("cached")]
+    if cached:
+        st.caption(f"Reused previously exported {', '.join(cached)}.")
+
+def display_post_generation_results(content: str, charts: List[Dict[str, Any]], publication_type: str, analysis_type: str, output_formats: List[str]):
+    """
+    Runs chart rendering, quality assessment and document export concurrently and shows each
+    result as soon as it is ready.
+
+    The AI quality evaluation is pure network wait, so it overlaps the CPU-bound chart rendering
+    and export. Charts render in worker processes; export runs after them on the same thread so it
+    reuses the cached chart images instead of rendering them again, and builds every selected
+    format from one parse of the content. Stages whose inputs are unchanged since the last run in
+    this session are shown from session state without being recomputed.
+    """
+    selected_formats = [EXPORT_FORMATS[label][0] for label in output_formats]
+    chart_keys = [chart_spec_key(chart) for chart in charts]
+    stage_keys = {
+        "chart images": stage_key(chart_keys),
+        "quality": stage_key(content, publication_type, analysis_type),
+        "export": stage_key(content, chart_keys, selected_formats),
+    }
+    start_time = time.perf_counter()
+    slots = {"chart images": st.empty(), "quality": st.empty(), "export": st.empty()}
+
+    def display_stage(stage: str, value: Any):
+        with slots[stage].container():
+            if stage == "chart images":
+                display_chart_images(value)
+            elif stage == "quality":
+                display_quality_assessment(value, publication_type)
+            else:
+                display_document_downloads(value, output_formats, publication_type, analysis_type)
+
+    def succeeded(stage: str, value: Any) -> bool:
+        # Failed stages are shown but not kept, so the next run retries them
+        if stage == "chart images":
+            return not any("error" in image for image in value)
+        if stage == "quality":
+            return "error" not in value and not value.get("ai_evaluation", "").startswith("AI evaluation failed")
+        return not any("error" in artifact for artifact in value.values())
+
+    stage_functions = {
+        "chart images": (render_chart_images, charts),
+        "quality": (assess_content_quality, content, publication_type, analysis_type),
+        "export": (export_documents, content, charts, selected_formats),
+    }
+    pending = []
+    for stage in slots:
+        found, value = get_stage_output(stage, stage_keys[stage])
+        if found:
+            display_stage(stage, value)
+        else:
+            pending.append(stage)
+    if not pending:
+        return
+
+    messages = {"chart images": "Rendering charts...", "quality": "Assessing content quality...", "export": "Generating downloadable document..."}
+    for stage in pending:
+        slots[stage].info(messages[stage])
+    stage_seconds = {}
+    with ThreadPoolExecutor(max_workers=1) as render_executor, ThreadPoolExecutor(max_workers=1) as quality_executor:
+        # Session state is only read and written here on the script thread, never by the workers
+        futures = {
+            (quality_executor if stage == "quality" else render_executor).submit(timed, *stage_functions[stage]): stage
+            for stage in pending
+        }
+        for future in as_completed(futures):
+            stage = futures[future]
+            try:
+                value, stage_seconds[stage] = future.result()
+            except Exception as e:
+                with slots[stage].container():
+                    if stage == "export":
+                        st.error(f"Error generating downloadable document: {str(e)}")
+                    else:
+                        st.error(f"Error in {stage} stage: {str(e)}")
+                logging.exception(f"Error in post-generation stage '{stage}':")
+                continue
+            display_stage(stage, value)
+            if succeeded(stage, value):
+                store_stage_output(stage, stage_keys[stage], value, stage_seconds[stage])
+
+    total_seconds = time.perf_counter() - start_time
+    stage_summary = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_seconds.items())
+    st.caption(f"Post-processing finished in {total_seconds:.1f}s ({stage_summary}; {sum(stage_seconds.values()):.1f}s if run sequentially)")
+
+def display_generated_document(result: Dict[str, Any], publication_type: str, analysis_type: str, survival_charts: List[Dict[str, Any]], output_formats: List[str]):
+    """
+    Shows the generated content with its charts, quality assessment and downloads.
+    """
+    st.subheader("Generated Content:")
+    content_without_visualizations = re.sub(r'##\s+Visualizations\s*[\s\S]*', '', result["content"], flags=re.IGNORECASE)
+    st.markdown(content_without_visualizations, unsafe_allow_html=True)
+
+    # Extract charts from the 'Visualizations' section
+    charts = run_stage(
+        "charts",
+        stage_key(result["content"], [chart_spec_key(chart) for chart in survival_charts]),
+        lambda: extract_chart_info(result["content"]) + survival_charts
+    )
+
+    # Render charts, assess quality and export concurrently
+    display_post_generation_results(result["content"], charts, publication_type, analysis_type, output_formats)
+
+    # Optionally, allow downloading raw content
+    st.download_button(
+        label="Download Raw Content as Text",
+        data=result["content"],
+        file_name=f"{publication_type.lower().replace(' ', '_')}_{analysis_type.lower().replace(' ', '_')}.txt",
+        mime="text/plain"
+    )
+    display_stage_status()
+
+def display_survival_settings(uploaded_file) -> Optional[Dict[str, Any]]:
+    """
+    Shows the column mapping for one CSV/Excel upload and, when enabled, its Kaplan-Meier results.
+
+    Returns:
+    - Optional[Dict[str, Any]]: The fitted dataset with its prompt summary and chart spec, or None.
+    """
+    try:
+        sheets = load_tabular_sheets(uploaded_file)
+    except Exception as e:
+        st.warning(f"Could not read {uploaded_file.name} for survival analysis: {str(e)}")
+        return None
+    sheet_names = list(sheets.keys())
+    sheet_name = sheet_names[0]
+    if len(sheet_names) > 1:
+        sheet_name = st.selectbox(f"Sheet of {uploaded_file.name}", sheet_names, key=f"survival_sheet_{uploaded_file.file_id}")
+    df = sheets[sheet_name]
+    detected = detect_survival_columns(df)
+    enabled = st.checkbox(
+        f"Fit Kaplan-Meier curves from {uploaded_file.name}",
+        value=detected["duration"] is not None and detected["event"] is not None,
+        key=f"survival_enabled_{uploaded_file.file_id}"
+    )
+    if not enabled:
+        return None
+
+    columns = list(df.columns)
+    col1, col2, col3 = st.columns(3)
+    duration = col1.selectbox("Time to event", columns, index=columns.index(detected["duration"]) if detected["duration"] in columns else 0, key=f"survival_duration_{uploaded_file.file_id}")
+    event = col2.selectbox("Event / status", columns, index=columns.index(detected["event"]) if detected["event"] in columns else 0, key=f"survival_event_{uploaded_file.file_id}")
+    arm_options = ["(none)"] + columns
+    arm = col3.selectbox("Arm", arm_options, index=arm_options.index(detected["arm"]) if detected["arm"] in columns else 0, key=f"survival_arm_{uploaded_file.file_id}")
+    arm = None if arm == "(none)" else arm
+    event_is_censor = st.checkbox("Status column is a censoring flag (1 = censored, e.g. ADaM CNSR)", value=detected["event_is_censor"], key=f"survival_censor_{uploaded_file.file_id}")
+    include_rows = st.checkbox(
+        "Also send the patient-level rows to the model",
+        value=False,
+        key=f"survival_rows_{uploaded_file.file_id}",
+        help="By default only the computed survival statistics are included in the prompt."
+    )
+
+    name = f"{uploaded_file.name} ({sheet_name})" if len(sheet_names) > 1 else uploaded_file.name
+    dataset_key = hashlib.sha256(f"{hashlib.sha256(uploaded_file.getvalue()).hexdigest()}:{sheet_name}".encode("utf-8")).hexdigest()
+    try:
+        analysis = get_survival_analysis(dataset_key, df, duration, event, arm, event_is_censor)
+        chart = survival_chart_spec(name, df, duration, event, arm, event_is_censor)
+    except Exception as e:
+        st.error(f"Could not fit Kaplan-Meier curves for {name}: {str(e)}")
+        logging.exception(f"Survival analysis of {name} failed:")
+        return None
+
+    summary = format_survival_summary(name, analysis, duration)
+    st.markdown(summary.rsplit("\n", 1)[0])
+    try:
+        st.image(get_chart_image(chart))
+    except Exception as e:
+        st.warning(f"Could not draw the Kaplan-Meier curves: {str(e)}")
+    return {"file_id": uploaded_file.file_id, "sheet_name": sheet_name, "summary": summary, "chart": chart, "include_rows": include_rows}
+
+def reuse_similar_generation(match: Dict[str, Any], generation_key: str) -> bool:
+    """
+    Uses the cached document found by find_similar_generation as this session's generation output.
+
+    Returns:
+    - bool: False if the cached document has been evicted in the meantime.
+    """
+    result = generation_cache.get(match["key"])
+    if result is None:
+        return False
+    generation_cache.record_similar_hit()
+    store_stage_output("generation", generation_key, result, 0.0)
+    st.session_state["near_duplicate_reuse"] = {"generation_key": generation_key, **match}
+    return True
+
+def display_near_duplicate_offer(offer: Dict[str, Any], generation_key: str) -> bool:
+    """
+    Offers the cached document of a near-identical earlier generation instead of generating.
+
+    Returns:
+    - bool: True if the document should be generated (the user declined, or the cached one is gone).
+    """
+    slot = st.empty()
+    with slot.container():
+        st.info(
+            f"A cached document was generated with the same settings from a source estimated {offer['source_similarity']:.0%} similar "
+            f"to this one (instructions {offer['instruction_similarity']:.0%} similar)."
+        )
+        use_column, generate_column = st.columns(2)
+        use_cached = use_column.button("Use the cached document")
+        generate_anyway = generate_column.button("Generate anyway")
+    if not (use_cached or generate_anyway):
+        return False
+    slot.empty()
+    st.session_state.pop("near_duplicate_offer", None)
+    if use_cached and reuse_similar_generation(offer, generation_key):
+        return False
+    if use_cached:
+        st.warning("The cached document is no longer available, so a new one is generated.")
+    return True
+
+def display_cache_statistics():
+    """
+    Shows hit/miss counters for the persistent caches in the sidebar.
+    """
+    st.sidebar.subheader("Cache Statistics")
+    stats = generation_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups if lookups else 0.0
+    st.sidebar.write(
+        f"Generation cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0%} hit rate), "
+        f"{stats['similar_hits']} near-duplicate reuses, {stats['entries']} entries, {stats['size_bytes'] / (1024 * 1024):.1f} MB"
+    )
+    extraction_stats = get_extraction_cache().stats()
+    st.sidebar.write(
+        f"Extraction cache: {extraction_stats['memory_hits']} memory hits, {extraction_stats['disk_hits']} disk hits, "
+        f"{extraction_stats['misses']} misses, {extraction_stats['memory_entries']} files in memory"
+    )
+    digest_stats = digest_cache.stats()
+    st.sidebar.write(
+        f"Chunk digest cache: {digest_stats['hits']} hits, {digest_stats['misses']} misses, {digest_stats['entries']} digests"
+    )
+    chart_stats = get_chart_image_cache().stats()
+    st.sidebar.write(
+        f"Chart cache: {chart_stats['hits']} hits, {chart_stats['misses']} renders, {chart_stats['entries']} charts"
+    )
+    export_stats = get_export_artifact_cache().stats()
+    st.sidebar.write(
+        f"Export cache: {export_stats['hits']} hits, {export_stats['misses']} exports, {export_stats['entries']} documents"
+    )
+    scheduler_stats = get_request_scheduler().stats()
+    st.sidebar.write(
+        f"Request scheduler: {scheduler_stats['queued']} queued, {scheduler_stats['granted']} sent, "
+        f"{scheduler_stats['rejected']} rejected, wait {scheduler_stats['mean_wait']:.1f}s mean / {scheduler_stats['max_wait']:.1f}s max"
+    )
+    if st.sidebar.button("Clear generation cache"):
+        generation_cache.clear()
+        digest_cache.clear()
+        st.sidebar.success("Generation cache cleared.")
+
 def main():
     st.title("Publication Copilot")
+    if PROCESS_POOL_MAX_WORKERS > 1:
+        # Starts the worker processes in the background, so they are warm by the time files are uploaded
+        get_process_pool()
+    display_cache_statistics()
+    # Stages computed or reused during this run, shown under the generated document
+    st.session_state["stage_log"] = {}
 
     publication_type = st.selectbox("Select publication type", list(PUBLICATION_TYPES.keys()))
     analysis_type = st.selectbox("Select analysis type", list(ANALYSIS_TYPES.keys()))
@@ -1362,8 +4773,71 @@ def main():
         accept_multiple_files=True
     )
     
+    extraction_options = {}
+    with st.expander("Source extraction settings"):
+        page_range_spec = st.text_input(
+            "PDF page ranges (optional)",
+            help="Only extract the selected pages of each PDF, e.g. '1-12, 240-410' for the synopsis and sections 11-14."
+        )
+        try:
+            extraction_options["page_ranges"] = parse_page_ranges(page_range_spec)
+        except ValueError as e:
+            st.error(f"{str(e)}. Extracting all pages instead.")
+        pdf_token_budget = st.number_input("Maximum tokens per PDF (0 = no limit)", min_value=0, value=0, step=10000)
+        if pdf_token_budget:
+            extraction_options["max_tokens"] = int(pdf_token_budget)
+        extraction_options["extract_tables"] = st.checkbox(
+            "Extract Word and ruled PDF tables as compact tables",
+            value=True,
+            help="Tables are sent to the model as deduplicated CSV instead of running text. "
+                 "Ruled PDF tables require the optional pdfplumber package and make PDF extraction slower."
+        )
+        if not PDFPLUMBER_AVAILABLE:
+            st.caption("pdfplumber is not installed, so PDF tables are extracted as plain text.")
+        tabular_mode_labels = {
+            "auto": f"Statistical profile for sheets over {TABULAR_PROFILE_MIN_ROWS} rows",
+            "profile": "Always a statistical profile",
+            "raw": "Every row",
+        }
+        extraction_options["tabular_mode"] = st.selectbox(
+            "Excel and CSV data sent to the model",
+            TABULAR_MODES,
+            format_func=tabular_mode_labels.get,
+            help="Profiles list each column's type, counts, mean with 95% CI, median and frequencies, broken down by "
+                 "treatment arm and visit columns. Large files are read in chunks."
+        )
+        if extraction_options["tabular_mode"] != "raw":
+            extraction_options["raw_rows_tokens"] = int(st.number_input(
+                "Raw rows to include with each profile (token budget, 0 = none)", min_value=0, value=0, step=1000
+            ))
+
+    survival_datasets = []
+    tabular_files = [uploaded_file for uploaded_file in uploaded_files or [] if uploaded_file.type in SURVIVAL_MIME_TYPES]
+    if tabular_files:
+        with st.expander("Survival analysis from patient-level data"):
+            st.caption(
+                "Kaplan-Meier curves, number at risk and median survival are computed locally from time-to-event data. "
+                "Only the summary statistics are sent to the model, and the curves are added to the document."
+            )
+            for uploaded_file in tabular_files:
+                dataset = display_survival_settings(uploaded_file)
+                if dataset:
+                    survival_datasets.append(dataset)
+
     if uploaded_files:
-        user_input = combine_uploaded_files(uploaded_files)
+        # The patient-level rows of each analyzed sheet are replaced by their summary; the sheet is still
+        # profiled and the file's other sheets are extracted as usual
+        file_options = {}
+        for dataset in survival_datasets:
+            if not dataset["include_rows"]:
+                file_options.setdefault(dataset["file_id"], {}).setdefault("summary_sheets", []).append(dataset["sheet_name"])
+        extraction_key = stage_key([(f.file_id, f.name, f.size) for f in uploaded_files], extraction_options, file_options)
+        user_input = run_stage(
+            "extraction", extraction_key,
+            lambda: combine_uploaded_files(uploaded_files, options=extraction_options, file_options=file_options)
+        )
+        for dataset in survival_datasets:
+            user_input += f"\n\n{dataset['summary']}"
         st.success(f"{len(uploaded_files)} file(s) uploaded and text extracted successfully!")
     else:
         user_input = st.text_area("Or enter your clinical study information:", height=300)
@@ -1380,137 +4854,205 @@ def main():
         placeholder="E.g., 'Please emphasize the safety profile of the drug.' or 'Focus on the subgroup analysis for patients over 65.'"
     )
 
-    # Select output format
-    output_format = st.selectbox(
-        "Select output format",
-        ["Word Document", "PDF"],
-        help="Choose the format for the generated publication."
+    # Select output formats
+    output_formats = st.multiselect(
+        "Select output formats",
+        list(EXPORT_FORMATS),
+        default=["Word Document"],
+        help="Choose the formats for the generated publication. All selected formats are exported together."
     )
 
-    if st.button("Generate"):
-        if user_input.strip():
-            with st.spinner("Generating content..."):
-                try:
-                    result = generate_document_cached(publication_type, analysis_type, user_input, additional_instructions)
+    with st.expander("Large document settings"):
+        map_reduce_mode = st.selectbox(
+            "Map-reduce condensing",
+            ["Auto (large sources only)", "Always", "Off"],
+            help="Split the source into chunks, extract the key facts from each chunk in parallel, "
+                 "then write the publication from the condensed digest."
+        )
+        chunk_tokens = st.number_input("Chunk size (tokens)", min_value=2000, max_value=60000, value=MAP_REDUCE_CHUNK_TOKENS, step=1000)
+        map_concurrency = st.number_input("Parallel chunk requests", min_value=1, max_value=16, value=MAP_REDUCE_CONCURRENCY)
+        use_retrieval = st.checkbox(
+            "Send only the passages relevant to each section",
+            value=False,
+            help="Index the source locally and include the top passages for every section instead of the full text."
+        )
+        retrieval_top_k = st.number_input("Passages per section", min_value=1, max_value=20, value=RETRIEVAL_TOP_K)
+
+    with st.expander("Near-duplicate reuse"):
+        reuse_similar = st.checkbox(
+            "Offer cached documents for near-identical sources",
+            value=True,
+            help="Sources and instructions are compared locally by MinHash fingerprints of their word shingles. "
+                 "A near-identical match is only used after you confirm it."
+        )
+        similarity_threshold = st.slider(
+            "Similarity threshold", min_value=0.80, max_value=1.0, value=NEAR_DUPLICATE_THRESHOLD, step=0.01,
+            help="Minimum estimated Jaccard similarity of both the source and the instructions."
+        )
 
-                    if result:
-                        if result["content"].startswith("An error occurred"):
-                            st.error(result["content"])
-                        else:
-                            # Display the generated content
-                            st.subheader("Generated Content:")
-                            content_without_visualizations = re.sub(r'##\s+Visualizations\s*[\s\S]*', '', result["content"], flags=re.IGNORECASE)
-                            st.markdown(content_without_visualizations, unsafe_allow_html=True)
-
-                            # Extract charts from the 'Visualizations' section
-                            charts = extract_chart_info(result["content"])
-
-                            if charts:
-                                st.subheader("Visualizations:")
-                                for chart_info in charts:
-                                    if validate_chart_data(chart_info):
-                                        try:
-                                            fig = create_chart(chart_info)
-                                            st.pyplot(fig)
-                                        except Exception as e:
-                                            st.warning(f"Could not create chart '{chart_info.get('title', 'Untitled')}': {str(e)}. Please check the chart data.")
-                                            logging.error(f"Error creating chart '{chart_info.get('title', 'Untitled')}': {str(e)}")
-                                            st.write("Chart data:")
-                                            st.json(chart_info)
-                                    else:
-                                        st.warning("Received invalid chart data. Unable to visualize this chart.")
-                            else:
-                                st.info("No charts were generated for this content.")
-
-                            # Assess content quality
-                            quality_assessment = assess_content_quality(result["content"], publication_type, analysis_type)
-
-                            # Display user-friendly quality assessment
-                            st.subheader("Content Quality Assessment:")
-                            
-                            # Total word count
-                            st.write(f"Total Words: {quality_assessment['total_words']}")
-                            
-                            # Readability score
-                            fk_grade = quality_assessment['readability']['flesch_kincaid_grade']
-                            if publication_type == "Plain Language Summary":
-                                if 6 <= fk_grade <= 8:
-                                    readability = "Excellent"
-                                elif 5 <= fk_grade < 6 or 8 < fk_grade <= 9:
-                                    readability = "Good"
-                                elif 4 <= fk_grade < 5 or 9 < fk_grade <= 10:
-                                    readability = "Fair"
-                                else:
-                                    readability = "Needs Improvement"
-                                st.write(f"Readability: {readability} (Flesch-Kincaid Grade Level: {fk_grade:.1f})")
-                                st.write("Note: For Plain Language Summaries, aim for a 6th to 8th-grade reading level.")
-                            else:
-                                if fk_grade < 10:
-                                    readability = "Excellent"
-                                elif fk_grade < 12:
-                                    readability = "Good"
-                                elif fk_grade < 14:
-                                    readability = "Fair"
-                                else:
-                                    readability = "Challenging"
-                                st.write(f"Readability: {readability} (Flesch-Kincaid Grade Level: {fk_grade:.1f})")
-                            
-                            # Section balance
-                            st.write("Section Balance:")
-                            total_words = sum(quality_assessment['word_counts'].values())
-                            for section, count in quality_assessment['word_counts'].items():
-                                percentage = (count / total_words) * 100
-                                st.write(f"- {section}: {count} words ({percentage:.1f}%)")
-                            
-                            # Top keywords
-                            st.write("Top Keywords:")
-                            for word, density in list(quality_assessment['keyword_density'].items())[:5]:
-                                st.write(f"- {word}: {density:.2%}")
-                            
-                            # Citation count
-                            citation_count = quality_assessment['citation_count']
-                            if citation_count == 0:
-                                citation_assessment = "No citations found. Consider adding relevant citations to support your arguments."
-                            elif citation_count < 5:
-                                citation_assessment = "Few citations found. Consider adding more to strengthen your arguments."
-                            else:
-                                citation_assessment = f"Good number of citations ({citation_count})."
-                            st.write(f"Citations: {citation_assessment}")
-                            
-                            # AI Evaluation
-                            st.write("AI Evaluation:")
-                            st.write(quality_assessment['ai_evaluation'])
-
-                            # Generate downloadable document
-                            with st.spinner("Generating downloadable document..."):
-                                try:
-                                    selected_format = "word" if output_format == "Word Document" else "pdf"
-                                    document = generate_word_document(result["content"], charts, output_format=selected_format)
-                                    file_extension = "docx" if selected_format == "word" else "pdf"
-                                    mime_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document" if selected_format == "word" else "application/pdf"
-                                    st.download_button(
-                                        label=f"Download as {output_format}",
-                                        data=document,
-                                        file_name=f"{publication_type.lower().replace(' ', '_')}_{analysis_type.lower().replace(' ', '_')}.{file_extension}",
-                                        mime=mime_type
-                                    )
-                                except Exception as e:
-                                    st.error(f"Error generating downloadable document: {str(e)}")
-                            
-                            # Optionally, allow downloading raw content
-                            st.download_button(
-                                label="Download Raw Content as Text",
-                                data=result["content"],
-                                file_name=f"{publication_type.lower().replace(' ', '_')}_{analysis_type.lower().replace(' ', '_')}.txt",
-                                mime="text/plain"
-                            )
-                    else:
-                        st.warning("No content was generated. Please try again.")
-                except Exception as e:
-                    st.error(f"An unexpected error occurred: {str(e)}")
-                    logging.exception("An unexpected error occurred in the main application:")
-        else:
+    generation_mode = st.selectbox(
+        "Generation mode",
+        ["Single request", "Parallel sections"],
+        help="Parallel sections writes independent sections concurrently and the Abstract, Conclusion and "
+             "other summary sections last, which is much faster for long publication types."
+    )
+    section_concurrency = SECTION_PARALLEL_CONCURRENCY
+    if generation_mode == "Parallel sections":
+        section_concurrency = st.number_input("Parallel section requests", min_value=1, max_value=16, value=SECTION_PARALLEL_CONCURRENCY)
+
+    stream_output = st.checkbox(
+        "Stream content as it is generated",
+        value=True,
+        help="Render sections progressively while the model writes them instead of waiting for the full document."
+    )
+
+    if user_input.strip():
+        plan = plan_token_budget(publication_type, analysis_type, user_input, additional_instructions)
+        with st.expander(f"Token budget: {plan['prompt_tokens']:,} prompt tokens, estimated cost ${plan['estimated_cost']:.2f}"):
+            st.write(f"- Source: {plan['source_tokens']:,} tokens (extracted tables sent separately: {plan['tabular_tokens']:,})")
+            st.write(f"- Instructions: {plan['instruction_tokens']:,} tokens")
+            st.write(f"- Output: ~{plan['expected_output_tokens']:,} expected, {plan['max_output_tokens']:,} maximum")
+            st.write(f"- Context window: {plan['context_window']:,} tokens, room for {plan['available_source_tokens']:,} source tokens")
+            st.write(f"- Estimated cost: ${plan['estimated_cost']:.2f} (up to ${plan['max_cost']:.2f} at maximum output)")
+            if get_tokenizer(MODEL_NAME) is None:
+                st.caption("Token counts are estimated because the local tokenizer is unavailable.")
+            if plan["overflow"]:
+                st.warning(
+                    f"The source exceeds the context budget by {plan['source_tokens'] - plan['available_source_tokens']:,} tokens. "
+                    "Unless map-reduce or retrieval condenses it, the lowest-priority paragraphs will be dropped."
+                )
+
+    # Settings that change the generated document; rendering options such as streaming do not
+    generation_key = stage_key(
+        publication_type, analysis_type, user_input, additional_instructions, generation_mode,
+        map_reduce_mode, int(chunk_tokens), use_retrieval, int(retrieval_top_k)
+    )
+    # Settings other than the source and instructions; near-duplicate matches must share all of them
+    settings_key = stage_key(
+        publication_type, analysis_type, generation_mode, map_reduce_mode, int(chunk_tokens), use_retrieval, int(retrieval_top_k)
+    )
+    generate_now = False
+    if st.button("Generate"):
+        if not user_input.strip():
             st.warning("Please enter some information or upload at least one file before generating.")
+        elif not get_stage_output("generation", generation_key)[0]:
+            match = find_similar_generation(settings_key, user_input, additional_instructions, similarity_threshold) if reuse_similar else None
+            if match is None:
+                generate_now = True
+            elif not (match["exact"] and reuse_similar_generation(match, generation_key)):
+                st.session_state["near_duplicate_offer"] = {"generation_key": generation_key, **match}
+
+    offer = st.session_state.get("near_duplicate_offer")
+    if offer and offer["generation_key"] == generation_key and not generate_now:
+        generate_now = display_near_duplicate_offer(offer, generation_key)
+
+    if generate_now:
+        st.session_state.pop("near_duplicate_offer", None)
+        st.session_state.pop("near_duplicate_reuse", None)
+        source_text = user_input
+        generation_start = time.perf_counter()
+        with st.spinner("Generating content..."):
+            try:
+                parallel_sections = generation_mode == "Parallel sections"
+                if use_retrieval and not parallel_sections:
+                    full_source_tokens = count_tokens(user_input)
+                    retrieved = build_retrieval_context(
+                        user_input, get_combined_structure(publication_type, analysis_type), int(retrieval_top_k)
+                    )
+                    if retrieved is user_input:
+                        st.caption("Retrieval: no passages matched the sections, so the full source is used")
+                    else:
+                        user_input = retrieved
+                        st.caption(f"Retrieval: source reduced from {full_source_tokens:,} to {count_tokens(user_input):,} tokens")
+
+                source_tokens = count_tokens(user_input)
+                map_metrics = None
+                if map_reduce_mode == "Always" or (map_reduce_mode.startswith("Auto") and source_tokens > MAP_REDUCE_AUTO_THRESHOLD_TOKENS):
+                    map_metrics = {}
+                    with st.spinner(f"Condensing {source_tokens:,} source tokens..."):
+                        user_input = condense_source(user_input, int(chunk_tokens), int(map_concurrency), map_metrics)
+                    map_metrics["digest_tokens"] = count_tokens(user_input)
+                    if map_metrics["failed_chunks"]:
+                        st.warning(
+                            f"{map_metrics['failed_chunks']} of {map_metrics['chunk_count']} chunks could not be condensed "
+                            "and are included as raw text."
+                        )
+
+                reduce_start = time.perf_counter()
+                document_key = generation_cache_key(
+                    publication_type, analysis_type, user_input, additional_instructions,
+                    pipeline=sections_pipeline(int(retrieval_top_k) if use_retrieval else None) if parallel_sections else "single"
+                )
+                if parallel_sections:
+                    section_metrics = {}
+                    structure = get_combined_structure(publication_type, analysis_type)
+                    progress = st.progress(0.0, text="Writing sections...")
+                    completed_sections = []
+
+                    def on_section_complete(section: str):
+                        completed_sections.append(section)
+                        progress.progress(min(1.0, len(completed_sections) / len(structure)), text=f"Finished {section}")
+
+                    result = generate_document_by_sections_cached(
+                        publication_type, analysis_type, user_input, additional_instructions,
+                        concurrency=int(section_concurrency),
+                        top_k=int(retrieval_top_k) if use_retrieval else None,
+                        metrics=section_metrics,
+                        on_section_complete=on_section_complete
+                    )
+                    progress.empty()
+                    if "total_latency" in section_metrics:
+                        stage_summary = " | ".join(f"{len(stage['sections'])} sections {stage['latency']:.1f}s" for stage in section_metrics["stages"])
+                        st.caption(f"Parallel sections: {stage_summary} | total {section_metrics['total_latency']:.1f}s")
+                elif stream_output:
+                    metrics = {}
+                    stream_placeholder = st.empty()
+                    with stream_placeholder.container():
+                        result = generate_document_streaming_cached(
+                            publication_type, analysis_type, user_input, additional_instructions,
+                            write_stream=st.write_stream, metrics=metrics
+                        )
+                    stream_placeholder.empty()
+                    if "total_latency" in metrics:
+                        st.caption(
+                            f"Time to first token: {metrics.get('time_to_first_token', metrics['total_latency']):.2f}s | "
+                            f"Total latency: {metrics['total_latency']:.2f}s"
+                        )
+                    elif metrics.get("cache_hit"):
+                        st.caption("Served from the generation cache.")
+                else:
+                    result = generate_document_cached(publication_type, analysis_type, user_input, additional_instructions)
+                reduce_latency = time.perf_counter() - reduce_start
+                logging.debug(f"Generation (reduce) stage took {reduce_latency:.2f}s")
+                if map_metrics is not None:
+                    st.caption(
+                        f"Map-reduce: {map_metrics['chunk_count']} chunks | split {map_metrics['split_latency']:.2f}s | "
+                        f"map {map_metrics['map_latency']:.2f}s | reduce {reduce_latency:.2f}s | digest {map_metrics['digest_tokens']:,} tokens"
+                    )
+
+                if not result or not (result.get("content") or "").strip():
+                    st.warning("No content was generated. Please try again.")
+                elif is_generation_error(result):
+                    st.error(result["content"])
+                else:
+                    store_stage_output("generation", generation_key, result, time.perf_counter() - generation_start)
+                    remember_generation(settings_key, source_text, additional_instructions, document_key)
+            except Exception as e:
+                st.error(f"An unexpected error occurred: {str(e)}")
+                logging.exception("An unexpected error occurred in the main application:")
+
+    # The last generated document stays on screen across reruns (e.g. download clicks) while its inputs are unchanged
+    found, result = get_stage_output("generation", generation_key)
+    if found:
+        reuse = st.session_state.get("near_duplicate_reuse")
+        if reuse and reuse["generation_key"] == generation_key:
+            st.caption(
+                f"Reused a cached document: source estimated {reuse['source_similarity']:.0%} similar, "
+                f"instructions {reuse['instruction_similarity']:.0%} similar."
+            )
+        display_generated_document(result, publication_type, analysis_type, [dataset["chart"] for dataset in survival_datasets], output_formats)
+    elif "generation" in st.session_state.get("pipeline_stages", {}) and st.session_state.get("near_duplicate_offer", {}).get("generation_key") != generation_key:
+        st.info("The inputs or settings changed since the last generation. Press Generate to update the document.")
 
 if __name__ == '__main__':
     logging.debug("Entering main block")
@@ -0,0 +1,231 @@
+"""
+Headless batch generation for Publication Copilot.
+
+Generates every selected publication type x analysis type combination for a directory of
+source files, writing DOCX/PDF/Markdown/JSON outputs per job plus a run summary with per-job timings.
+Completed jobs are skipped when the command is re-run, so an interrupted run can be resumed.
+
+Usage:
+    python batch_generate.py --sources ./study_docs --output ./readout --workers 4 --rpm 30 --tpm 150000
+
+The OpenAI API key is read from .streamlit/secrets.toml, as for the Streamlit app.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import mimetypes
+import threading
+from io import BytesIO
+from typing import Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Copilot import (
+    PUBLICATION_TYPES,
+    ANALYSIS_TYPES,
+    combine_uploaded_files,
+    generate_document_cached,
+    assess_content_quality,
+    export_documents,
+    is_generation_error,
+    get_request_scheduler,
+    request_priority,
+    PRIORITY_BATCH,
+    OPENAI_TOKENS_PER_MINUTE,
+)
+
+# MIME types reported by Streamlit's file uploader, which combine_uploaded_files dispatches on
+SOURCE_MIME_TYPES = {
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".txt": "text/plain",
+    ".xls": "application/vnd.ms-excel",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv",
+}
+
+OUTPUT_FORMATS = ["docx", "pdf", "md", "json"]
+# Document formats by file extension, as accepted by export_documents
+DOCUMENT_FORMATS = {"docx": "word", "pdf": "pdf", "md": "markdown"}
+
+
+class LocalUploadedFile(BytesIO):
+    """
+    A file from disk exposing the parts of Streamlit's UploadedFile interface used by the extractors.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+        extension = os.path.splitext(path)[1].lower()
+        self.type = SOURCE_MIME_TYPES.get(extension) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def slugify(value: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in value.lower()).strip("_")
+
+
+def load_sources(source_dir: str) -> List[LocalUploadedFile]:
+    """
+    Loads all supported source files from source_dir in a stable (sorted) order.
+    """
+    files = []
+    for name in sorted(os.listdir(source_dir)):
+        path = os.path.join(source_dir, name)
+        if os.path.isfile(path) and os.path.splitext(name)[1].lower() in SOURCE_MIME_TYPES:
+            files.append(LocalUploadedFile(path))
+    return files
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def run_job(publication_type: str, analysis_type: str, user_input: str, additional_instructions: str, job_dir: str, formats: List[str], export_lock: threading.Lock, skip_quality: bool) -> Dict[str, Any]:
+    """
+    Generates, assesses and exports one publication type x analysis type combination.
+    Model requests go through the shared request scheduler at batch priority.
+
+    Returns:
+    - Dict[str, Any]: The job record with status, per-stage timings and output files.
+    """
+    record = {
+        "publication_type": publication_type,
+        "analysis_type": analysis_type,
+        "status": "failed",
+        "timings": {},
+        "outputs": [],
+    }
+    job_start = time.perf_counter()
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+
+        stage_start = time.perf_counter()
+        with request_priority(PRIORITY_BATCH):
+            result = generate_document_cached(publication_type, analysis_type, user_input, additional_instructions)
+        record["timings"]["generation"] = time.perf_counter() - stage_start
+        if is_generation_error(result):
+            record["error"] = result["content"] if result and (result.get("content") or "").strip() else "No content was generated."
+            return record
+
+        quality = None
+        if not skip_quality:
+            stage_start = time.perf_counter()
+            with request_priority(PRIORITY_BATCH):
+                quality = assess_content_quality(result["content"], publication_type, analysis_type)
+            record["timings"]["quality"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        document_formats = [DOCUMENT_FORMATS[output_format] for output_format in formats if output_format in DOCUMENT_FORMATS]
+        artifacts = {}
+        if document_formats:
+            # All formats are built together from one parse; charts render in a process pool, and one
+            # export at a time keeps concurrent jobs from oversubscribing the CPU
+            with export_lock:
+                artifacts = export_documents(result["content"], result["charts"], document_formats)
+        for output_format in formats:
+            path = os.path.join(job_dir, f"document.{output_format}")
+            if output_format == "json":
+                payload = {"publication_type": publication_type, "analysis_type": analysis_type, **result, "quality_assessment": quality}
+                write_atomic(path, json.dumps(payload, indent=2, ensure_ascii=False).encode("utf-8"))
+            else:
+                artifact = artifacts[DOCUMENT_FORMATS[output_format]]
+                if "error" in artifact:
+                    raise RuntimeError(f"{output_format} export failed: {artifact['error']}")
+                write_atomic(path, artifact["data"])
+            record["outputs"].append(path)
+        record["timings"]["export"] = time.perf_counter() - stage_start
+        record["status"] = "completed"
+    except Exception as e:
+        logging.exception(f"Batch job {publication_type} / {analysis_type} failed:")
+        record["error"] = str(e)
+    finally:
+        record["timings"]["total"] = time.perf_counter() - job_start
+    return record
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a publication type x analysis type matrix from a directory of source files.")
+    parser.add_argument("--sources", required=True, help="Directory containing PDF, DOCX, TXT, XLS(X) or CSV source files.")
+    parser.add_argument("--output", required=True, help="Directory for generated documents and the run summary.")
+    parser.add_argument("--publication-types", nargs="+", default=list(PUBLICATION_TYPES), choices=list(PUBLICATION_TYPES), metavar="TYPE", help="Publication types to generate (default: all).")
+    parser.add_argument("--analysis-types", nargs="+", default=list(ANALYSIS_TYPES), choices=list(ANALYSIS_TYPES), metavar="TYPE", help="Analysis types to generate (default: all).")
+    parser.add_argument("--instructions", default="", help="Additional instructions passed to every generation.")
+    parser.add_argument("--formats", nargs="+", default=OUTPUT_FORMATS, choices=OUTPUT_FORMATS, help="Output formats (default: all).")
+    parser.add_argument("--workers", type=int, default=4, help="Number of jobs run concurrently.")
+    parser.add_argument("--rpm", type=float, default=30, help="Global limit on model requests per minute across all workers (0 disables).")
+    parser.add_argument("--tpm", type=float, default=OPENAI_TOKENS_PER_MINUTE, help="Global limit on model tokens per minute across all workers (default: PUBLICATION_OPENAI_TPM or 300000; 0 disables).")
+    parser.add_argument("--skip-quality", action="store_true", help="Skip the content quality assessment.")
+    parser.add_argument("--force", action="store_true", help="Re-run jobs that already completed in a previous run.")
+    parser.add_argument("--log-level", default="INFO", help="Logging level (default: INFO).")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(args.log_level.upper())
+    os.makedirs(args.output, exist_ok=True)
+    run_start = time.perf_counter()
+
+    files = load_sources(args.sources)
+    if not files:
+        logging.error(f"No supported source files found in {args.sources}")
+        return 1
+    stage_start = time.perf_counter()
+    user_input = combine_uploaded_files(files)
+    extraction_seconds = time.perf_counter() - stage_start
+    logging.info(f"Extracted {len(user_input):,} characters from {len(files)} file(s) in {extraction_seconds:.1f}s")
+
+    scheduler = get_request_scheduler()
+    scheduler.configure(args.rpm, args.tpm)
+    export_lock = threading.Lock()
+    records = []
+    pending = []
+    for publication_type in args.publication_types:
+        for analysis_type in args.analysis_types:
+            job_dir = os.path.join(args.output, f"{slugify(publication_type)}__{slugify(analysis_type)}")
+            record_path = os.path.join(job_dir, "job.json")
+            if not args.force and os.path.exists(record_path):
+                with open(record_path, encoding="utf-8") as f:
+                    previous = json.load(f)
+                if previous.get("status") == "completed":
+                    previous["resumed"] = True
+                    records.append(previous)
+                    continue
+            pending.append((publication_type, analysis_type, job_dir, record_path))
+
+    logging.info(f"{len(pending)} job(s) to run, {len(records)} already completed")
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(run_job, publication_type, analysis_type, user_input, args.instructions, job_dir, args.formats, export_lock, args.skip_quality): record_path
+            for publication_type, analysis_type, job_dir, record_path in pending
+        }
+        for future in as_completed(futures):
+            record = future.result()
+            # The job record is written last so that only fully exported jobs are skipped on resume
+            write_atomic(futures[future], json.dumps(record, indent=2).encode("utf-8"))
+            records.append(record)
+            logging.info(f"[{record['status']}] {record['publication_type']} / {record['analysis_type']} in {record['timings']['total']:.1f}s")
+
+    summary = {
+        "sources": [f.name for f in files],
+        "extraction_seconds": extraction_seconds,
+        "total_seconds": time.perf_counter() - run_start,
+        "completed": sum(1 for record in records if record["status"] == "completed"),
+        "failed": sum(1 for record in records if record["status"] != "completed"),
+        "request_scheduler": scheduler.stats(),
+        "jobs": sorted(records, key=lambda record: (record["publication_type"], record["analysis_type"])),
+    }
+    write_atomic(os.path.join(args.output, "run_summary.json"), json.dumps(summary, indent=2).encode("utf-8"))
+    logging.info(f"Run finished: {summary['completed']} completed, {summary['failed']} failed in {summary['total_seconds']:.1f}s")
+    return 0 if summary["failed"] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
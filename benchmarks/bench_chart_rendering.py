@@ -0,0 +1,70 @@
+"""
+Benchmark: chart rendering time for a multi-chart Subgroup Analysis style document.
+
+Renders Kaplan-Meier curves, heatmaps, box plots and bar charts with ensure_chart_images,
+sequentially and in the shared worker pool (warmed up first, as it lives as long as the server),
+then exports the document to check that the export reuses the cached renders.
+
+Usage:
+    python benchmarks/bench_chart_rendering.py --charts 12 --workers 4
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Copilot import ensure_chart_images, get_chart_image_cache, generate_word_document
+
+
+def build_charts(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    charts = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            data = [{"Months": round(rng.expovariate(1 / 14), 1), "Event": int(rng.random() < 0.7), "Arm": rng.choice(["Drug", "Placebo"])} for _ in range(400)]
+            charts.append({"type": "Kaplan-Meier Curve", "title": f"PFS subgroup {i}", "x_label": "Months", "y_label": "Survival probability", "data_series": ["Months", "Event", "Arm"], "data": data})
+        elif kind == 1:
+            data = [{"Subgroup": f"S{a}", "Visit": f"V{b}", "Change": round(rng.gauss(0, 1), 2)} for a in range(8) for b in range(8)]
+            charts.append({"type": "Heatmap", "title": f"Change from baseline {i}", "x_label": "Visit", "y_label": "Subgroup", "data_series": ["Subgroup", "Visit", "Change"], "data": data})
+        elif kind == 2:
+            data = [{"Region": rng.choice(["EU", "NA", "APAC", "LATAM"]), "Age": rng.randint(18, 85)} for _ in range(300)]
+            charts.append({"type": "Box Plot", "title": f"Age by region {i}", "x_label": "Region", "y_label": "Age", "data_series": ["Region", "Age"], "data": data})
+        else:
+            data = [{"Subgroup": f"Subgroup {a}", "Drug": rng.randint(20, 60), "Placebo": rng.randint(10, 40)} for a in range(6)]
+            charts.append({"type": "Bar Chart", "title": f"Response rate {i}", "x_label": "Subgroup", "y_label": "ORR (%)", "data_series": ["Drug", "Placebo"], "data": data})
+    return charts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--charts", type=int, default=12, help="Number of charts in the document.")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes for the parallel run.")
+    args = parser.parse_args()
+
+    charts = build_charts(args.charts)
+    cache = get_chart_image_cache()
+    print(f"{len(charts)} charts, {os.cpu_count()} CPU(s) available")
+
+    ensure_chart_images(build_charts(args.workers * 2, seed=1), max_workers=args.workers)
+    timings = {}
+    for label, workers in [("sequential", 1), (f"{args.workers} worker processes", args.workers)]:
+        cache.clear()
+        start = time.perf_counter()
+        errors = ensure_chart_images(charts, max_workers=workers)
+        timings[label] = time.perf_counter() - start
+        print(f"{label:<24} {timings[label]:6.2f}s  ({len(errors)} failed)")
+    sequential, parallel = timings.values()
+    print(f"Speedup: {sequential / parallel:.2f}x")
+
+    start = time.perf_counter()
+    generate_word_document("## Results\nSee figures.\n", charts, output_format="pdf")
+    stats = cache.stats()
+    print(f"PDF export with cached charts: {time.perf_counter() - start:.2f}s, {stats['misses']} chart renders during export")
+
+
+if __name__ == "__main__":
+    main()
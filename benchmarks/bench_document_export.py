@@ -0,0 +1,76 @@
+"""
+Benchmark: Word and PDF export time for a manuscript with many tables.
+
+Builds a Markdown manuscript with the given number of sections, each with paragraphs, a
+nested list and a results table, then times parsing into document blocks and both writers.
+Export time should grow linearly with the document size, so the run is repeated at twice the size.
+
+Usage:
+    python benchmarks/bench_document_export.py --sections 40 --rows 25
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Copilot import parse_markdown_blocks, generate_word_document
+
+
+def build_manuscript(sections: int, rows: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    parts = ["# Efficacy and safety of drug X versus placebo", ""]
+    for i in range(sections):
+        parts += [
+            f"## Section {i + 1}",
+            f"Patients were randomized 2:1 to **drug X** or *placebo*; the hazard ratio was {rng.uniform(0.5, 0.9):.2f} "
+            f"(95% CI {rng.uniform(0.4, 0.6):.2f} to {rng.uniform(0.8, 1.0):.2f}, `p < 0.001`).",
+            "",
+            "- Primary endpoint: progression-free survival",
+            "  - Assessed by blinded independent central review",
+            "- Secondary endpoints: overall survival and ***objective response***",
+            "",
+            "| Subgroup | Drug X (n) | Placebo (n) | HR (95% CI) |",
+            "|---|---:|---:|---|",
+        ]
+        for row in range(rows):
+            hr = rng.uniform(0.4, 1.1)
+            parts.append(f"| Subgroup {row + 1} | {rng.randint(20, 200)} | {rng.randint(10, 100)} | {hr:.2f} ({hr - 0.15:.2f} to {hr + 0.2:.2f}) |")
+        parts.append("")
+    return "\n".join(parts)
+
+
+def time_export(content: str) -> dict:
+    timings = {}
+    start = time.perf_counter()
+    blocks = parse_markdown_blocks(content)
+    timings["parse"] = time.perf_counter() - start
+    for output_format in ("word", "pdf"):
+        start = time.perf_counter()
+        generate_word_document(content, [], output_format=output_format)
+        timings[output_format] = time.perf_counter() - start
+    timings["blocks"] = len(blocks)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=40, help="Sections (one table each) in the manuscript.")
+    parser.add_argument("--rows", type=int, default=25, help="Rows per table.")
+    args = parser.parse_args()
+
+    results = []
+    for sections in (args.sections, 2 * args.sections):
+        content = build_manuscript(sections, args.rows)
+        timings = time_export(content)
+        results.append(timings)
+        print(f"{sections} tables, {len(content):,} characters, {timings['blocks']} blocks: "
+              f"parse {timings['parse'] * 1000:.1f} ms, Word {timings['word']:.2f}s, PDF {timings['pdf']:.2f}s")
+    small, large = results
+    print(f"Scaling at 2x size: parse {large['parse'] / small['parse']:.2f}x, Word {large['word'] / small['word']:.2f}x, PDF {large['pdf'] / small['pdf']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark: sequential vs process-pool text extraction for a multi-file upload.
+
+Builds a synthetic upload of several text-heavy PDFs (CSR, protocol, SAP, TLF listings) and
+compares extract_files with one worker against the shared worker pool. The pool lives as long as
+the server, so it is started and warmed up before timing.
+
+Usage:
+    python benchmarks/bench_extraction.py --files 6 --pages 120
+"""
+import os
+import sys
+import time
+import argparse
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+from Copilot import extract_files, EXTRACTION_MAX_WORKERS
+
+SENTENCE = "Patients randomized to the study drug showed a reduction in the primary endpoint (HR 0.72; 95% CI 0.61-0.85; p<0.001). "
+
+
+def build_pdf(pages: int) -> bytes:
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+    for page in range(pages):
+        text = pdf.beginText(40, 750)
+        for line in range(60):
+            text.textLine(f"{page + 1}.{line + 1} {SENTENCE[:90]}")
+        pdf.drawText(text)
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=6)
+    parser.add_argument("--pages", type=int, default=120)
+    parser.add_argument("--workers", type=int, default=EXTRACTION_MAX_WORKERS)
+    args = parser.parse_args()
+
+    pdf = build_pdf(args.pages)
+    jobs = [("application/pdf", pdf)] * args.files
+    print(f"Upload: {args.files} PDFs x {args.pages} pages ({len(pdf) * args.files / 1e6:.1f} MB), {args.workers} workers")
+
+    extract_files(jobs[:2], args.workers)
+    sequential, sequential_seconds = timed(extract_files, jobs, 1)
+    parallel, parallel_seconds = timed(extract_files, jobs, args.workers)
+    assert [text for text, _ in sequential] == [text for text, _ in parallel]
+
+    print(f"Sequential: {sequential_seconds:.2f}s (per file: {', '.join(f'{s:.2f}s' for _, s in sequential)})")
+    print(f"Parallel:   {parallel_seconds:.2f}s (per file: {', '.join(f'{s:.2f}s' for _, s in parallel)})")
+    print(f"Speedup:    {sequential_seconds / parallel_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark: cold import time of Copilot.py, as paid by every new Streamlit server, container or
+batch worker before it can serve anything.
+
+Imports the module in fresh interpreters with `python -X importtime`, reports the median wall
+time and the slowest top-level imports, checks that the heavy libraries are not imported
+eagerly, and exits with status 1 when the median exceeds the budget.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 5 --budget 1.5
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries that Copilot.py imports on first use only
+LAZY_MODULES = ["matplotlib", "seaborn", "lifelines", "networkx", "reportlab", "docx", "PyPDF2", "pdfplumber", "openpyxl", "textstat", "openai"]
+
+CHECK_LAZY = f"import sys, Copilot; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+
+
+def import_once() -> tuple:
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import Copilot"], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, completed.stderr
+
+
+def slowest_imports(importtime_log: str, count: int = 8) -> list:
+    # Top-level imports of Copilot.py are indented by exactly two spaces in the -X importtime tree
+    imports = []
+    for line in importtime_log.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].startswith("   ") and not parts[2].startswith("    "):
+            imports.append((int(parts[1]) / 1e6, parts[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to time.")
+    parser.add_argument("--budget", type=float, default=1.5, help="Maximum median import time in seconds.")
+    args = parser.parse_args()
+
+    import_once()  # Warm the filesystem cache and the bytecode cache
+    timings = []
+    log = ""
+    for _ in range(args.runs):
+        seconds, log = import_once()
+        timings.append(seconds)
+    median = statistics.median(timings)
+    print(f"import Copilot: median {median:.2f}s over {args.runs} runs (min {min(timings):.2f}s, max {max(timings):.2f}s)")
+    print("Slowest top-level imports (cumulative):")
+    for seconds, module in slowest_imports(log):
+        print(f"  {module:<32} {seconds:6.3f}s")
+
+    eager = subprocess.run([sys.executable, "-c", CHECK_LAZY], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    if eager:
+        print(f"Imported eagerly: {eager}")
+    status = 0 if median <= args.budget and not eager else 1
+    print(f"Budget {args.budget:.2f}s: {'OK' if status == 0 else 'EXCEEDED'}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
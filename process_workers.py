@@ -0,0 +1,28 @@
+"""
+Entry points for Publication Copilot's worker processes.
+
+Streamlit executes Copilot.py as __main__, and functions defined there cannot be unpickled by
+forkserver or spawn workers. Tasks are therefore submitted through these importable wrappers,
+which import Copilot as a plain module (without running the app) in each worker.
+"""
+from typing import Dict, Any, Optional, Tuple
+
+
+def warm_up() -> None:
+    """
+    Imports Copilot, the parsers and the plotting libraries, so the first real task does not pay for them.
+    """
+    import Copilot
+    import PyPDF2  # noqa: F401
+    import docx  # noqa: F401
+    Copilot.import_chart_libraries()
+
+
+def extract_text_from_bytes(file_type: str, data: bytes, options: Optional[Dict[str, Any]] = None) -> Tuple[str, float]:
+    import Copilot
+    return Copilot.extract_text_from_bytes(file_type, data, options)
+
+
+def render_chart_safely(chart_info: Dict[str, Any]) -> Tuple[Optional[Dict[int, bytes]], Optional[str]]:
+    import Copilot
+    return Copilot.render_chart_safely(chart_info)
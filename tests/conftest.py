@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Importing Copilot opens its caches, so keep them out of the user's cache directory
+os.environ.setdefault("PUBLICATION_CACHE_DIR", tempfile.mkdtemp(prefix="publication_copilot_tests_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from Copilot import downsample_series, lttb_indices
+
+
+@pytest.fixture
+def series():
+    x = np.arange(10_000, dtype=float)
+    y = np.sin(x / 500)
+    y[4321] = 50.0  # A single spike that downsampling must keep
+    return x, y
+
+
+@pytest.mark.parametrize("threshold", [3, 10, 500, 9_999])
+def test_lttb_keeps_endpoints_and_output_length(series, threshold):
+    x, y = series
+    indices = lttb_indices(x, y, threshold)
+    assert len(indices) == threshold
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lttb_keeps_peaks(series):
+    x, y = series
+    assert 4321 in lttb_indices(x, y, 100)
+
+
+@pytest.mark.parametrize("threshold", [2, 10_000, 20_000])
+def test_lttb_returns_every_point_when_nothing_to_drop(series, threshold):
+    x, y = series
+    assert np.array_equal(lttb_indices(x, y, threshold), np.arange(len(x)))
+
+
+def test_downsample_series_skips_missing_values(series):
+    x, y = series
+    y = y.copy()
+    y[:10] = np.nan
+    indices = downsample_series(x, y, 200)
+    assert len(indices) == 200
+    assert indices[0] == 10 and indices[-1] == len(x) - 1
+    assert np.isfinite(y[indices]).all()
@@ -0,0 +1,65 @@
+import types
+
+import pytest
+
+import Copilot
+from Copilot import GenerationCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Copilot reads time.time() for entry ages and last access; a fake clock makes both deterministic
+    now = [1_000_000.0]
+    fake_time = types.SimpleNamespace(time=lambda: now[0], perf_counter=Copilot.time.perf_counter, monotonic=Copilot.time.monotonic)
+    monkeypatch.setattr(Copilot, "time", fake_time)
+    return now
+
+
+def document(text, size=100):
+    return {"content": text * size, "charts": []}
+
+
+def test_round_trip_and_counters(tmp_path, clock):
+    cache = GenerationCache(str(tmp_path / "cache.sqlite3"))
+    assert cache.get("missing") is None
+    cache.set("key", document("a"))
+    assert cache.get("key") == document("a")
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_expired_entries_are_misses(tmp_path, clock):
+    cache = GenerationCache(str(tmp_path / "cache.sqlite3"), max_age_seconds=60)
+    cache.set("key", document("a"))
+    clock[0] += 59
+    assert cache.get("key") is not None
+    clock[0] += 2
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, clock):
+    size = len(Copilot.json.dumps(document("a")))
+    cache = GenerationCache(str(tmp_path / "cache.sqlite3"), max_bytes=2 * size)
+    cache.set("a", document("a"))
+    clock[0] += 1
+    cache.set("b", document("b"))
+    clock[0] += 1
+    assert cache.get("a") is not None  # "b" is now the least recently used
+    clock[0] += 1
+    cache.set("c", document("c"))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["size_bytes"] <= 2 * size
+
+
+def test_fingerprints_follow_their_target_entry(tmp_path, clock):
+    cache = GenerationCache(str(tmp_path / "cache.sqlite3"), max_age_seconds=60)
+    signature = Copilot.generation_fingerprint("the median overall survival was 18 months " * 20, "")
+    cache.set("document", document("a"))
+    cache.add_fingerprint("fingerprint", "namespace", signature, target="document")
+    assert [(key, target) for key, target, _ in cache.find_similar("namespace", signature, 0.9)] == [("fingerprint", "document")]
+    assert cache.stats()["similar_hits"] == 0  # Only reuse is counted, see record_similar_hit
+    clock[0] += 61
+    cache.set("other", document("b"))  # Writing evicts the expired target
+    assert cache.find_similar("namespace", signature, 0.9) == []
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from Copilot import parse_inline_markdown, parse_markdown_blocks
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def plain(runs):
+    return "".join(text for text, _, _, _ in runs)
+
+
+@pytest.fixture
+def load_fixture():
+    def load(name):
+        with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+            return parse_markdown_blocks(f.read())
+    return load
+
+
+def test_nested_lists(load_fixture):
+    heading, bullets, numbered = load_fixture("nested_lists.md")
+    assert heading["type"] == "heading" and heading["level"] == 2 and plain(heading["runs"]) == "Key Points"
+
+    assert bullets["type"] == "list" and not bullets["ordered"]
+    first, second = bullets["items"]
+    assert plain(first["runs"]) == "Primary endpoint met"
+    (nested,) = first["children"]
+    assert not nested["ordered"]
+    assert [plain(item["runs"]) for item in nested["items"]] == ["Median OS 18.2 vs 14.1 months", "HR 0.72 (95% CI 0.61 to 0.85)"]
+    assert plain(second["runs"]) == "Safety consistent with prior studies continued on the next line"
+
+    assert numbered["type"] == "list" and numbered["ordered"]
+    assert [plain(item["runs"]) for item in numbered["items"]] == ["First step", "Second step"]
+    (detail,) = numbered["items"][1]["children"]
+    assert plain(detail["items"][0]["runs"]) == "detail under the second step"
+
+
+def test_tables(load_fixture):
+    blocks = load_fixture("tables.md")
+    assert [block["type"] for block in blocks] == ["paragraph", "table", "paragraph", "paragraph"]
+    table = blocks[1]
+    assert [plain(cell) for cell in table["header"]] == ["Event", "Arm A", "Arm B"]
+    assert [[plain(cell) for cell in row] for row in table["rows"]] == [
+        ["Nausea", "12 (10%)", "15 (13%)"],
+        ["Fatigue", "8", ""],
+        ["a | b", "1", "2"],
+    ]
+    assert table["rows"][0][2] == [("15 (13%)", True, False, False)]
+
+
+def test_table_needs_matching_separator(load_fixture):
+    blocks = load_fixture("tables.md")
+    # A one-cell "---" under a two-cell line, and a three-cell separator under a two-cell
+    # header, are not tables
+    assert plain(blocks[2]["runs"]) == "Response rate | 45% vs 30%"
+    assert plain(blocks[3]["runs"]) == "Arm | n ---|---|---"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("plain", [("plain", False, False, False)]),
+    ("**bold** and *italic*", [("bold", True, False, False), (" and ", False, False, False), ("italic", False, True, False)]),
+    ("***both***", [("both", True, True, False)]),
+    ("__bold _nested_ text__", [("bold ", True, False, False), ("nested", True, True, False), (" text", True, False, False)]),
+    ("snake_case_name stays", [("snake_case_name stays", False, False, False)]),
+    ("use `**raw**` code", [("use ", False, False, False), ("**raw**", False, False, True), (" code", False, False, False)]),
+    ("\\*not italic\\*", [("*", False, False, False), ("not italic", False, False, False), ("*", False, False, False)]),
+    ("see [the protocol](https://example.org)", [("see ", False, False, False), ("the protocol", False, False, False)]),
+])
+def test_parse_inline_markdown(text, expected):
+    assert parse_inline_markdown(text) == expected
@@ -0,0 +1,22 @@
+import pytest
+
+from Copilot import parse_page_ranges
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ("1-5, 20-30, 42", [(1, 5), (20, 30), (42, 42)]),
+    ("7", [(7, 7)]),
+    ("3-3", [(3, 3)]),
+    (" 2 - 4 ,", [(2, 4)]),
+    ("10-12,1-2", [(10, 12), (1, 2)]),
+    ("", None),
+    (" , ,", None),
+])
+def test_valid_page_ranges(spec, expected):
+    assert parse_page_ranges(spec) == expected
+
+
+@pytest.mark.parametrize("spec", ["0", "0-3", "5-2", "a", "1-", "-4", "1-3-5", "1.5", "2;4"])
+def test_invalid_page_ranges(spec):
+    with pytest.raises(ValueError):
+        parse_page_ranges(spec)
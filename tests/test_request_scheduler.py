@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from Copilot import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    RequestScheduler,
+    SchedulerQueueFullError,
+)
+
+
+def wait_for_queue(scheduler, size, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while scheduler.stats()["queued"] < size:
+        assert time.monotonic() < deadline, "requests did not queue"
+        time.sleep(0.005)
+
+
+def test_unlimited_scheduler_admits_immediately():
+    scheduler = RequestScheduler(requests_per_minute=0, tokens_per_minute=0)
+    assert scheduler.acquire(10_000) < 0.1
+    assert scheduler.stats()["granted_by_priority"] == {"interactive": 1}
+
+
+def test_waiting_requests_are_admitted_by_priority():
+    # 10 requests per second with an empty bucket, so all three queue before the first is admitted
+    scheduler = RequestScheduler(requests_per_minute=600, tokens_per_minute=0)
+    scheduler.requests.level = 0
+    order = []
+
+    def request(priority):
+        scheduler.acquire(1, priority)
+        order.append(priority)
+
+    threads = [threading.Thread(target=request, args=(priority,)) for priority in (PRIORITY_BATCH, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == [PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, PRIORITY_BATCH]
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_full_queue_rejects_requests():
+    # One request per ten minutes, so the first request keeps waiting
+    scheduler = RequestScheduler(requests_per_minute=0.1, tokens_per_minute=0, max_queued=1)
+    scheduler.requests.level = 0
+    waiting = threading.Thread(target=scheduler.acquire, args=(1,))
+    waiting.start()
+    wait_for_queue(scheduler, 1)
+    with pytest.raises(SchedulerQueueFullError):
+        scheduler.acquire(1)
+    assert scheduler.stats()["rejected"] == 1
+    scheduler.configure(0, 0)  # Lifting the limit releases the waiting request
+    waiting.join(timeout=5)
+    assert not waiting.is_alive()
+    assert scheduler.stats()["granted"] == 1
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Copilot import TABULAR_PROFILE_MIN_ROWS, profile_table_chunks
+
+
+@pytest.fixture
+def subjects():
+    count = 300
+    return pd.DataFrame({
+        "ARM": ["Drug", "Placebo"] * (count // 2),
+        "AGE": np.arange(count) % 50 + 20,
+        "SEX": ["F", "M", "M"] * (count // 3),
+    })
+
+
+def test_profile_is_computed_across_chunks(subjects):
+    text = profile_table_chunks("ADSL", iter([subjects.iloc[:100], subjects.iloc[100:]]), "auto")
+    lines = text.split("\n")
+    assert lines[0] == "### Sheet: ADSL — statistical profile of 300 rows x 3 columns ###"
+    assert "- ARM (categorical, 2 distinct): n=300; Drug 150 (50.0%), Placebo 150 (50.0%)" in lines
+    assert "- AGE (numeric): n=300; mean 44.50 (95% CI 42.86 to 46.14), SD 14.45; median 44.50 (IQR 32 to 57); range 20 to 69" in lines
+    assert "- SEX (categorical, 2 distinct): n=300; M 200 (66.7%), F 100 (33.3%)" in lines
+    assert "By ARM (2 groups):" in lines
+    assert not any(line.startswith("Drug,") for line in lines)
+
+
+def test_small_sheets_are_sent_as_uploaded():
+    rows = pd.DataFrame({"a": [1.0, None, 3.5], "b": ["x", None, "<0.001"]})
+    assert len(rows) <= TABULAR_PROFILE_MIN_ROWS
+    assert profile_table_chunks("", iter([rows]), "auto") == "a,b\n1.0,x\n,\n3.5,<0.001\n"
+
+
+def test_profile_mode_appends_raw_rows_within_budget(subjects):
+    text = profile_table_chunks("", iter([subjects]), "profile", raw_rows_tokens=30)
+    assert text.startswith("### Statistical profile of 300 rows x 3 columns ###")
+    header, rows = text.split("First ", 1)[1].split("\n", 1)
+    shown = int(header.split(" of ")[0])
+    assert 0 < shown < len(subjects)
+    assert rows.split("\n")[:3] == ["ARM,AGE,SEX", "Drug,20,F", "Placebo,21,M"]
+    assert len(rows.strip().split("\n")) == shown + 1
+    assert "First " not in profile_table_chunks("", iter([subjects]), "profile")